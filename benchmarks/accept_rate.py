@@ -0,0 +1,175 @@
+""" New connections per second against an AsyncServer.
+
+The server runs in its own process, client processes open non-blocking
+connections at a fixed total rate (or as fast as they can) and reset
+them as soon as the handshake completes. Reports established
+connections per second, connections accepted by the server per second
+and connect latency; SYNs dropped by a full listen queue show up as
+~1s retransmits in the tail::
+
+    python benchmarks/accept_rate.py --rate 20000 -d 5
+    python benchmarks/accept_rate.py --rate 20000 --backlog 1 --budget 4
+
+"""
+
+import argparse
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, async_server  # noqa: E402
+
+
+class CountingServer(async_server.AsyncServer):
+    def __init__(self, loop, address, accept_budget, counter):
+        super(CountingServer, self).__init__(loop, address, accept_budget)
+        self.counter = counter
+
+    def connection_made(self):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+    def on_connection(self, conn):
+        conn.read()
+
+
+def serve(port, backlog, budget, counter):
+    loop = ioloop.IOLoop(num_backends=4)
+    server = CountingServer(loop, ("127.0.0.1", port), budget, counter)
+    # resets are logged as errors, keep stderr out of the measure.
+    loop.setloglevel(logging.CRITICAL)
+    server.listen(backlog)
+
+
+def connect_worker(port, rate, duration, concurrency, results):
+    epoller = select.epoll()
+    pending = {}
+    linger = struct.pack("ii", 1, 0)
+    latencies = []
+    errors = 0
+    interval = 1.0 / rate if rate else 0
+    start = time.perf_counter()
+    deadline = start + duration
+    sent = 0
+    while True:
+        now = time.perf_counter()
+        if now >= deadline and not pending:
+            break
+        # open new connections on schedule
+        while now < deadline and len(pending) < concurrency:
+            intended = start + sent * interval if interval else now
+            if intended > now:
+                break
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+            err = sock.connect_ex(("127.0.0.1", port))
+            if err not in (0, errno.EINPROGRESS):
+                errors += 1
+                sock.close()
+            else:
+                pending[sock.fileno()] = (sock, intended)
+                epoller.register(sock.fileno(), select.EPOLLOUT)
+            sent += 1
+        timeout = 0.001 if now < deadline else 0.1
+        for fd, events in epoller.poll(timeout):
+            sock, intended = pending.pop(fd)
+            epoller.unregister(fd)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - intended)
+            sock.close()
+        if time.perf_counter() > deadline + 5:
+            # give up on connections stuck in SYN retransmits.
+            errors += len(pending)
+            break
+    results.put((latencies, errors, time.perf_counter() - start))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops accept rate benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18900)
+    parser.add_argument("-r", "--rate", type=float, default=20000, help="0 is max")
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("-w", "--workers", type=int, default=2)
+    parser.add_argument("-c", "--concurrency", type=int, default=256)
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN)
+    parser.add_argument("--budget", type=int, default=128)
+    args = parser.parse_args(argv)
+
+    counter = multiprocessing.Value("l", 0)
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.backlog, args.budget, counter)
+    )
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=connect_worker,
+            args=(
+                args.port,
+                args.rate / args.workers,
+                args.duration,
+                args.concurrency,
+                results,
+            ),
+        )
+        for _ in range(args.workers)
+    ]
+    for w in workers:
+        w.start()
+    latencies, errors, elapsed = [], 0, 0
+    for _ in workers:
+        lat, err, el = results.get()
+        latencies.extend(lat)
+        errors += err
+        elapsed = max(elapsed, el)
+    for w in workers:
+        w.join()
+    time.sleep(0.2)
+    server.terminate()
+
+    latencies.sort()
+
+    def pct(p):
+        if not latencies:
+            return 0.0
+        return round(latencies[int(p / 100.0 * (len(latencies) - 1))] * 1000, 3)
+
+    print(
+        json.dumps(
+            {
+                "rate": args.rate or None,
+                "backlog": args.backlog,
+                "accept_budget": args.budget,
+                "established": len(latencies),
+                "errors": errors,
+                "established_per_second": round(len(latencies) / elapsed, 1),
+                "accepted_per_second": round(counter.value / elapsed, 1),
+                "connect_latency_ms": {
+                    "p50": pct(50),
+                    "p99": pct(99),
+                    "p999": pct(99.9),
+                    "max": pct(100),
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+""" Poll settings of IOLoop.tune, their latency against their CPU cost.
+
+* maxevents : one poll over --fds ready sockets, microseconds per poll
+  and nanoseconds per event for each maxevents.
+* busy : echo round trips on one connection with --think microseconds
+  between them, so the server goes back to polling each time. RTT
+  percentiles and server CPU for each busy_poll window.
+* level : bursts of --burst connections on a listener with a small
+  accept budget, edge against level triggered. Polls per connection
+  and server CPU.
+* exclusive : --workers processes sharing one listening socket, one
+  connection at a time. Polls and accept wakeups per connection, the
+  useless ones (nothing left to accept) and the CPU of all the
+  workers, with and without EPOLLEXCLUSIVE.
+
+Busy polling pays off with a CPU to spare: on a single one the
+spinning loop thread holds the GIL the executor threads wait for::
+
+    python benchmarks/epoll.py
+    python benchmarks/epoll.py busy --busy-poll 0 0.0005 0.005 -n 5000
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, restart  # noqa: E402
+from whoops.async_server import AsyncServer  # noqa: E402
+
+
+class Echo(AsyncServer):
+    def on_connection(self, conn):
+        data = conn.read(65536)
+        if data:
+            conn.write(data)
+        elif conn.at_eof():
+            self.ioloop.unregister(conn.conn.fileno())
+            conn.close()
+
+    def on_write(self, conn):
+        pass
+
+    def on_close(self):
+        pass
+
+
+def serve(address, settings, pipe, inherit=None):
+    if inherit is not None:
+        # the listening socket of the parent, see whoops.restart.
+        os.environ[restart.LISTEN_FDS] = json.dumps({str(inherit): list(address)})
+    loop = ioloop.IOLoop(num_backends=2)
+    server = Echo(loop, address, accept_budget=settings.get("accept_budget", 128))
+    loop.setloglevel(logging.CRITICAL)
+    loop.tune(
+        busy_poll=settings.get("busy_poll", 0),
+        exclusive_accept=settings.get("exclusive", False),
+    )
+    if settings.get("level"):
+        loop.set_level_triggered(server.acceptor.fileno())
+
+    stats = {"polls": 0, "accept_calls": 0, "accepted": 0, "useless": 0}
+    poll = loop._impl.poll
+    accept = server.acceptor.accept
+    on_accept = server.acceptor.on_accept_callback
+
+    def counting_poll(timeout):
+        stats["polls"] += 1
+        return poll(timeout)
+
+    def counting_accept():
+        result = accept()
+        stats["accepted"] += 1
+        return result
+
+    def counting_on_accept(conn):
+        before = stats["accepted"]
+        stats["accept_calls"] += 1
+        try:
+            return on_accept(conn)
+        finally:
+            if stats["accepted"] == before:
+                stats["useless"] += 1
+
+    loop._impl.poll = counting_poll
+    server.acceptor.accept = counting_accept
+    server.acceptor.on_accept_callback = counting_on_accept
+
+    threading.Thread(target=server.listen, daemon=True).start()
+    pipe.send("ready")
+    pipe.recv()
+    start = os.times()
+    pipe.recv()
+    end = os.times()
+    stats["cpu"] = (end.user + end.system) - (start.user + start.system)
+    pipe.send(stats)
+
+
+class Servers(object):
+
+    """ Server processes, measured between begin and end. """
+
+    def __init__(self, count, address, settings, inherit=None):
+        self.pipes = []
+        self.processes = []
+        for _ in range(count):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve, args=(address, settings, child, inherit), daemon=True
+            )
+            process.start()
+            self.pipes.append(parent)
+            self.processes.append(process)
+        for pipe in self.pipes:
+            pipe.recv()
+
+    def begin(self):
+        for pipe in self.pipes:
+            pipe.send("begin")
+
+    def end(self):
+        for pipe in self.pipes:
+            pipe.send("end")
+        stats = [pipe.recv() for pipe in self.pipes]
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        return stats
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_maxevents(args):
+    pairs = [socket.socketpair() for _ in range(args.fds)]
+    results = []
+    for maxevents in args.maxevents:
+        epoller = select.epoll()
+        for a, b in pairs:
+            b.send(b"x")
+            # level triggered, every poll sees them all ready.
+            epoller.register(a.fileno(), select.EPOLLIN)
+        polls = max(1, 200000 // args.fds)
+        events = 0
+        start = time.perf_counter()
+        for _ in range(polls):
+            events += len(epoller.poll(0, maxevents))
+        elapsed = time.perf_counter() - start
+        epoller.close()
+        results.append(
+            {
+                "maxevents": maxevents,
+                "events_per_poll": events // polls,
+                "us_per_poll": round(elapsed / polls * 1e6, 1),
+                "ns_per_event": round(elapsed / events * 1e9, 1),
+            }
+        )
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return results
+
+
+def bench_busy(args):
+    results = []
+    for busy_poll in args.busy_poll:
+        address = ("127.0.0.1", args.port)
+        servers = Servers(1, address, {"busy_poll": busy_poll})
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message = b"x" * 64
+        rtts = []
+        servers.begin()
+        start = time.perf_counter()
+        for _ in range(args.number):
+            time.sleep(args.think / 1e6)
+            sent = time.perf_counter()
+            sock.sendall(message)
+            received = 0
+            while received < len(message):
+                received += len(sock.recv(4096))
+            rtts.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        (stats,) = servers.end()
+        sock.close()
+        results.append(
+            {
+                "busy_poll": busy_poll,
+                "rtt_p50_us": round(percentile(rtts, 0.5) * 1e6, 1),
+                "rtt_p99_us": round(percentile(rtts, 0.99) * 1e6, 1),
+                "polls_per_request": round(stats["polls"] / args.number, 1),
+                "server_cpu_percent": round(stats["cpu"] / elapsed * 100, 1),
+            }
+        )
+        args.port += 1
+    return results
+
+
+def connect_burst(address, count):
+    socks = [socket.create_connection(address) for _ in range(count)]
+    for sock in socks:
+        sock.sendall(b"x")
+    for sock in socks:
+        sock.recv(16)
+        sock.close()
+
+
+def bench_level(args):
+    results = []
+    for level in (False, True):
+        address = ("127.0.0.1", args.port)
+        servers = Servers(1, address, {"level": level, "accept_budget": 4})
+        servers.begin()
+        start = time.perf_counter()
+        for _ in range(args.bursts):
+            connect_burst(address, args.burst)
+        elapsed = time.perf_counter() - start
+        (stats,) = servers.end()
+        connections = args.bursts * args.burst
+        results.append(
+            {
+                "mode": "level" if level else "edge",
+                "connections_per_second": round(connections / elapsed, 1),
+                "polls_per_connection": round(stats["polls"] / connections, 2),
+                "server_cpu_percent": round(stats["cpu"] / elapsed * 100, 1),
+            }
+        )
+        args.port += 1
+    return results
+
+
+def bench_exclusive(args):
+    results = []
+    for exclusive in (False, True):
+        address = ("127.0.0.1", args.port)
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen(1024)
+        servers = Servers(
+            args.workers, address, {"exclusive": exclusive}, inherit=listener.fileno()
+        )
+        latencies = []
+        servers.begin()
+        start = time.perf_counter()
+        for _ in range(args.connections):
+            began = time.perf_counter()
+            sock = socket.create_connection(address)
+            sock.sendall(b"x")
+            sock.recv(16)
+            latencies.append(time.perf_counter() - began)
+            sock.close()
+        elapsed = time.perf_counter() - start
+        stats = servers.end()
+        listener.close()
+        results.append(
+            {
+                "exclusive": exclusive,
+                "workers": args.workers,
+                # the kernel drops the event of a listener with nothing
+                # left to accept, a woken worker may return empty handed.
+                "polls_per_connection": round(
+                    sum(s["polls"] for s in stats) / args.connections, 2
+                ),
+                "wakeups_per_connection": round(
+                    sum(s["accept_calls"] for s in stats) / args.connections, 2
+                ),
+                "useless_per_connection": round(
+                    sum(s["useless"] for s in stats) / args.connections, 2
+                ),
+                "connect_p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+                "connect_p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+                "workers_cpu_percent": round(
+                    sum(s["cpu"] for s in stats) / elapsed * 100, 1
+                ),
+            }
+        )
+        args.port += 1
+    return results
+
+
+BENCHES = {
+    "maxevents": bench_maxevents,
+    "busy": bench_busy,
+    "level": bench_level,
+    "exclusive": bench_exclusive,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops poll settings benchmark")
+    parser.add_argument("bench", nargs="*", help=", ".join(sorted(BENCHES)))
+    parser.add_argument("-p", "--port", type=int, default=19000)
+    parser.add_argument("--fds", type=int, default=4096)
+    parser.add_argument("--maxevents", type=int, nargs="+", default=[-1, 1024, 64])
+    parser.add_argument(
+        "--busy-poll", type=float, nargs="+", default=[0, 0.0005, 0.005]
+    )
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    parser.add_argument("--think", type=float, default=200, help="microseconds")
+    parser.add_argument("--bursts", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=64)
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("-c", "--connections", type=int, default=500)
+    args = parser.parse_args(argv)
+    for name in args.bench:
+        if name not in BENCHES:
+            parser.error("unknown benchmark %r" % name)
+
+    results = {}
+    for name in args.bench or sorted(BENCHES):
+        results[name] = BENCHES[name](args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+""" Broadcast fan-out throughput.
+
+An AsyncServer in its own process publishes M messages to one topic
+with N subscribed connections, opened by a client process that reads
+and counts what it receives. Reports the publish side rate in messages
+times subscribers per second, the deliveries that reached the clients,
+and what happened to slow subscribers: --slow K of the connections
+never read, they are skipped or disconnected (--policy) once their
+backlog passes --max-backlog bytes::
+
+    python benchmarks/fanout.py -n 20000 -m 100 --size 100
+    python benchmarks/fanout.py -n 1000 --slow 100 --policy disconnect
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, async_server, broadcast  # noqa: E402
+
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class PubSubServer(async_server.AsyncServer):
+    def __init__(self, loop, address, subscribed):
+        super(PubSubServer, self).__init__(loop, address)
+        self.subscribed = subscribed
+
+    def on_connection(self, conn):
+        data = conn.read()
+        if not data:
+            if conn.at_eof():
+                self.ioloop.unregister(conn.conn.fileno())
+                conn.close()
+        elif data.startswith(b"SUB"):
+            self.subscribe("bench", conn)
+            with self.subscribed.get_lock():
+                self.subscribed.value += 1
+
+
+def serve(port, args, subscribed, results):
+    raise_nofile()
+    loop = ioloop.IOLoop(num_backends=4)
+    server = PubSubServer(loop, ("127.0.0.1", port), subscribed)
+    server.broadcaster = broadcast.Broadcaster(loop, args.max_backlog, args.policy)
+    loop.setloglevel(logging.CRITICAL)
+
+    def publisher():
+        while subscribed.value < args.subscribers:
+            time.sleep(0.05)
+        message = b"x" * (args.size - 1) + b"\n"
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            server.publish("bench", message)
+        elapsed = time.perf_counter() - start
+        results.put((elapsed, server.broadcaster.stats()))
+
+    threading.Thread(target=publisher, daemon=True).start()
+    server.listen()
+
+
+def subscribe(port, n, slow, size, expected, results):
+    raise_nofile()
+    epoller = select.epoll()
+    socks = {}
+    idle = []
+    for i in range(n):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.send(b"SUB\n")
+        if i < slow:
+            # never read, the server backlog grows.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            idle.append(sock)
+            continue
+        sock.setblocking(False)
+        socks[sock.fileno()] = sock
+        epoller.register(sock.fileno(), select.EPOLLIN)
+    received = 0
+    # publishing starts once the server has seen every subscription.
+    last = time.time() + 30
+    start = None
+    while time.time() - last < 2 and received < expected * size:
+        events = epoller.poll(0.1)
+        for fd, _ in events:
+            try:
+                while True:
+                    data = socks[fd].recv(262144)
+                    if not data:
+                        break
+                    received += len(data)
+            except BlockingIOError:
+                pass
+        if events:
+            if start is None:
+                start = time.perf_counter()
+            last = time.time()
+    elapsed = time.perf_counter() - start if start else 0
+    results.put((received // size, elapsed))
+    for sock in idle:
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops broadcast fan-out benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18970)
+    parser.add_argument("-n", "--subscribers", type=int, default=20000)
+    parser.add_argument("-m", "--messages", type=int, default=100)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument(
+        "--slow", type=int, default=0, help="subscribers that never read"
+    )
+    parser.add_argument("--max-backlog", type=int, default=1 << 20)
+    parser.add_argument(
+        "--policy",
+        choices=(broadcast.Broadcaster.SKIP, broadcast.Broadcaster.DISCONNECT),
+        default=broadcast.Broadcaster.SKIP,
+    )
+    args = parser.parse_args(argv)
+
+    limit = raise_nofile()
+    if 2 * args.subscribers + 64 > limit:
+        parser.error(
+            "RLIMIT_NOFILE %d is too low for %d subscribers" % (limit, args.subscribers)
+        )
+
+    subscribed = multiprocessing.Value("l", 0)
+    server_results = multiprocessing.Queue()
+    client_results = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args, subscribed, server_results)
+    )
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    expected = (args.subscribers - args.slow) * args.messages
+    client = multiprocessing.Process(
+        target=subscribe,
+        args=(
+            args.port,
+            args.subscribers,
+            args.slow,
+            args.size,
+            expected,
+            client_results,
+        ),
+    )
+    client.start()
+    publish_time, stats = server_results.get()
+    delivered, receive_time = client_results.get()
+    client.join()
+    server.terminate()
+
+    fanout = args.messages * args.subscribers
+    print(
+        json.dumps(
+            {
+                "subscribers": args.subscribers,
+                "messages": args.messages,
+                "size": args.size,
+                "slow": args.slow,
+                "policy": args.policy,
+                "publish_seconds": round(publish_time, 3),
+                "fanout_per_second": round(fanout / publish_time, 1),
+                "written": stats["delivered"],
+                "skipped": stats["skipped"],
+                "disconnected": stats["disconnected"],
+                "received": delivered,
+                "received_per_second": (
+                    round(delivered / receive_time, 1) if receive_time else None
+                ),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
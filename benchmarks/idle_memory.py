@@ -0,0 +1,127 @@
+""" Server RSS per idle connection.
+
+Starts an AsyncServer in its own process, opens N idle connections to
+it and reports the growth of the server's resident set size divided by
+N, for each N::
+
+    python benchmarks/idle_memory.py 10000 50000 100000
+
+Client sockets are spread over several loopback source addresses to
+stay clear of the ephemeral port range. Both processes raise their
+open files limit to the hard limit; counts that do not fit are skipped.
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, async_server  # noqa: E402
+
+PER_SOURCE_ADDRESS = 25000
+
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class IdleServer(async_server.AsyncServer):
+    def __init__(self, loop, address, counter):
+        super(IdleServer, self).__init__(loop, address)
+        self.counter = counter
+
+    def connection_made(self):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+    def on_connection(self, conn):
+        conn.read()
+
+
+def serve(port, counter):
+    raise_nofile()
+    loop = ioloop.IOLoop(num_backends=4)
+    server = IdleServer(loop, ("127.0.0.1", port), counter)
+    loop.setloglevel(logging.CRITICAL)
+    server.listen()
+
+
+def measure(port, n, subnet):
+    counter = multiprocessing.Value("l", 0)
+    server = multiprocessing.Process(target=serve, args=(port, counter))
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    base = rss(server.pid)
+
+    clients = []
+    try:
+        for i in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # reset on close, no TIME_WAIT left behind for the next run.
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            sock.bind(("127.%d.%d.1" % (subnet, 1 + i // PER_SOURCE_ADDRESS), 0))
+            sock.connect(("127.0.0.1", port))
+            clients.append(sock)
+        deadline = time.time() + 60
+        while counter.value < n and time.time() < deadline:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        used = rss(server.pid) - base
+        return {
+            "connections": counter.value,
+            "base_rss": base,
+            "rss_growth": used,
+            "bytes_per_connection": round(used / float(max(1, counter.value)), 1),
+        }
+    finally:
+        for sock in clients:
+            sock.close()
+        server.terminate()
+        server.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops idle connection memory")
+    parser.add_argument("counts", nargs="*", type=int, default=[10000, 50000, 100000])
+    parser.add_argument("-p", "--port", type=int, default=18950)
+    parser.add_argument(
+        "--subnet", type=int, default=10, help="clients bind to 127.<subnet>.x.1"
+    )
+    args = parser.parse_args(argv)
+
+    limit = raise_nofile()
+    results = []
+    for i, n in enumerate(args.counts):
+        if n + 64 > limit:
+            results.append({"connections": n, "skipped": "RLIMIT_NOFILE %d" % limit})
+            continue
+        results.append(measure(args.port + i, n, args.subnet + i))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+""" Microbenchmarks for the whoops hot path.
+
+Every benchmark runs one component in isolation on synthetic input,
+over socketpairs where the component does I/O, and reports the best
+nanoseconds per operation over a few rounds. Baselines are stored per
+machine, a run fails when a component got slower than the baseline by
+more than the threshold::
+
+    python benchmarks/microbench.py --save          # record a baseline
+    python benchmarks/microbench.py                 # compare, exit 1 on regression
+    python benchmarks/microbench.py -k http -t 0.1  # some of them, 10% threshold
+
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import select
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, datagram, broadcast, ratelimit  # noqa: E402
+from whoops.httplib.http_server import HttpServer  # noqa: E402
+from whoops.wsgilib.wsgi_server import WSGIServer  # noqa: E402
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+REQUEST = (
+    b"GET /index.html?key=whoops&count=4 HTTP/1.1\r\n"
+    b"Host: 127.0.0.1:8888\r\n"
+    b"User-Agent: whoops-microbench\r\n"
+    b"Accept: text/html,application/xhtml+xml\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+)
+
+benchmarks = []
+
+
+def benchmark(f):
+    benchmarks.append(f)
+    return f
+
+
+class NullExecutor(object):
+
+    """ Swallows submitted callbacks, only the dispatch is measured. """
+
+    def submit(self, fn, *args, **kwargs):
+        pass
+
+
+def socketpair():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    return a, b
+
+
+def drain(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except socket.error:
+        pass
+
+
+def make_loop():
+    loop = ioloop.IOLoop(num_backends=1)
+    loop.setloglevel(logging.WARNING)
+    return loop
+
+
+def make_server(cls):
+    loop = make_loop()
+    server = cls(loop, ("127.0.0.1", 0))
+    loop.setloglevel(logging.WARNING)
+    return server
+
+
+@benchmark
+def transport_read(n):
+    # 16 KB pending on the socket, read until EAGAIN.
+    a, b = socketpair()
+    transport = ioloop.Transport(a, None)
+    payload = b"x" * 16384
+    start = time.perf_counter()
+    for _ in range(n):
+        b.send(payload)
+        transport.read()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    return elapsed
+
+
+@benchmark
+def datagram_drain(n):
+    # 64 datagrams of 64 bytes queued per batch, handler does nothing.
+    class Sink(datagram.DatagramEndpoint):
+        def datagrams_received(self, datagrams):
+            pass
+
+    loop = make_loop()
+    endpoint = Sink(loop, ("127.0.0.1", 0), rcvbuf=1 << 20)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(endpoint.address)
+    payload = b"x" * 64
+    rounds = max(1, n // 64)
+    elapsed = 0
+    for _ in range(rounds):
+        for _ in range(64):
+            sender.send(payload)
+        start = time.perf_counter()
+        endpoint.on_readable(endpoint.transport)
+        elapsed += time.perf_counter() - start
+    sender.close()
+    endpoint.close()
+    return elapsed * n / (rounds * 64)
+
+
+@benchmark
+def broadcast_publish(n):
+    # one 100 byte message to 256 subscribers, per subscriber.
+    loop = make_loop()
+    broadcaster = broadcast.Broadcaster(loop)
+    pairs = [socketpair() for _ in range(256)]
+    for a, _ in pairs:
+        broadcaster.subscribe("topic", ioloop.Transport(a, None))
+    message = b"x" * 100
+    rounds = max(1, n // 256)
+    elapsed = 0
+    for i in range(rounds):
+        start = time.perf_counter()
+        broadcaster.publish("topic", message)
+        elapsed += time.perf_counter() - start
+        if i % 64 == 63:
+            for _, b in pairs:
+                drain(b)
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return elapsed * n / (rounds * 256)
+
+
+@benchmark
+def http_parse_request(n):
+    server = make_server(HttpServer)
+    a, b = socketpair()
+    server.connection = ioloop.Transport(a, None)
+    start = time.perf_counter()
+    for _ in range(n):
+        b.send(REQUEST)
+        server.parse_request()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    server.acceptor.close()
+    return elapsed
+
+
+@benchmark
+def http_send_headers(n):
+    server = make_server(HttpServer)
+    a, b = socketpair()
+    server.connection = ioloop.Transport(a, None)
+    start = time.perf_counter()
+    for i in range(n):
+        server.send_response(200)
+        server.send_header("Content-type", "text/html")
+        server.send_header("Content-Length", 48)
+        server.send_header("Date", "Mon, 19 Oct 2026 16:00:00 GMT")
+        server.end_headers()
+        if i % 64 == 0:
+            drain(b)
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    server.acceptor.close()
+    return elapsed
+
+
+@benchmark
+def wsgi_setup_environ(n):
+    server = make_server(WSGIServer)
+    a, b = socketpair()
+    server.connection = ioloop.Transport(a, None)
+    b.send(REQUEST)
+    server.parse_request()
+    start = time.perf_counter()
+    for _ in range(n):
+        server.setup_environ()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    server.acceptor.close()
+    return elapsed
+
+
+@benchmark
+def ratelimit_churn(n):
+    # accept, request and release from a new address each time, the
+    # client table full and evicting.
+    limiter = ratelimit.RateLimiter(
+        max_connections=8, connection_rate=10, request_rate=100, max_clients=1024
+    )
+    addresses = [
+        ("10.%d.%d.%d" % (i >> 16, (i >> 8) & 255, i & 255), 80) for i in range(n)
+    ]
+    start = time.perf_counter()
+    for i, address in enumerate(addresses):
+        limiter.accept(i, address)
+        limiter.request(i)
+        limiter.release(i)
+    return time.perf_counter() - start
+
+
+@benchmark
+def ioloop_process_events(n):
+    # 1000 ready fds per wakeup, reads and writes.
+    loop = make_loop()
+    loop.executor = NullExecutor()
+    revents = []
+    for fd in range(1000):
+        loop.connections[fd] = ioloop.Transport(None, None)
+        revents.append((fd, loop._READ if fd % 2 else loop._READ | loop._WRITE))
+    rounds = max(1, n // 1000)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        loop._process_events(revents)
+    elapsed = time.perf_counter() - start
+    return elapsed * n / (rounds * 1000)
+
+
+@benchmark
+def kqueue_poll(n):
+    # result building of _Kqueue.poll over synthetic kevents.
+    if not hasattr(select, "kqueue"):
+        return None
+
+    class FakeKqueue(object):
+        def __init__(self, events):
+            self.events = events
+
+        def control(self, changelist, max_events, timeout):
+            return self.events
+
+    events = []
+    for fd in range(1000):
+        events.append(select.kevent(fd, select.KQ_FILTER_READ))
+        if fd % 2:
+            events.append(select.kevent(fd, select.KQ_FILTER_WRITE))
+    poller = ioloop._Kqueue()
+    real, poller._kqueue = poller._kqueue, FakeKqueue(events)
+    rounds = max(1, n // 1000)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        list(poller.poll(0))
+    elapsed = time.perf_counter() - start
+    real.close()
+    return elapsed * n / (rounds * 1000)
+
+
+def run(f, number, rounds):
+    # best of rounds, in nanoseconds per operation.
+    f(max(1, number // 10))
+    best = None
+    for _ in range(rounds):
+        gc.disable()
+        try:
+            elapsed = f(number)
+        finally:
+            gc.enable()
+        if elapsed is None:
+            return None
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / number
+
+
+def baseline_path(directory):
+    name = "%s-%s-py%d%d.json" % (
+        platform.node() or "unknown",
+        platform.machine(),
+        sys.version_info[0],
+        sys.version_info[1],
+    )
+    return os.path.join(directory, name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops microbenchmarks")
+    parser.add_argument("-k", dest="pattern", help="only run matching benchmarks")
+    parser.add_argument("-n", "--number", type=int, default=20000)
+    parser.add_argument("-r", "--rounds", type=int, default=7)
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="allowed slowdown, 0.2 = 20%%",
+    )
+    parser.add_argument("--save", action="store_true", help="store as the baseline")
+    parser.add_argument("--baseline-dir", default=BASELINE_DIR)
+    args = parser.parse_args(argv)
+
+    path = baseline_path(args.baseline_dir)
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    for f in benchmarks:
+        if args.pattern and args.pattern not in f.__name__:
+            continue
+        ns = run(f, args.number, args.rounds)
+        if ns is None:
+            print("%-24s skipped" % f.__name__)
+            continue
+        results[f.__name__] = ns
+        line = "%-24s %12.1f ns/op" % (f.__name__, ns)
+        if f.__name__ in baseline:
+            change = ns / baseline[f.__name__] - 1
+            line += "  %+6.1f%%" % (change * 100)
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(f.__name__)
+        print(line)
+
+    if args.save:
+        baseline.update(results)
+        if not os.path.isdir(args.baseline_dir):
+            os.makedirs(args.baseline_dir)
+        with open(path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline saved to %s" % path)
+        return 0
+
+    if regressions:
+        print(
+            "regressed beyond %d%%: %s" % (args.threshold * 100, ", ".join(regressions))
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+""" Process pool handoff cost, shared memory against pickling.
+
+Sends payloads of each --size to a worker process through an Offloader
+and back, once with payloads of 512 KB and more in shared memory and
+once with everything pickled through the pool's pipe. The function
+only returns its argument, the time is the handoff::
+
+    python benchmarks/offload.py
+    python benchmarks/offload.py --size 1024 1048576 -n 50
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop  # noqa: E402
+from whoops.offload import Offloader  # noqa: E402
+
+
+def echo(data):
+    return data
+
+
+def measure(offloader, payload, number):
+    # best of 3 rounds, milliseconds per round trip.
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(number):
+            offloader.submit(None, echo, payload).result()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops offload handoff benchmark")
+    parser.add_argument(
+        "--size", type=int, nargs="+", default=[1024, 65536, 1 << 20, 16 << 20]
+    )
+    parser.add_argument("-n", "--number", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    loop = ioloop.IOLoop(num_backends=1)
+    shared = Offloader(loop, max_workers=1)
+    pickled = Offloader(loop, max_workers=1, threshold=float("inf"))
+    shared.start()
+    pickled.start()
+
+    results = []
+    for size in args.size:
+        payload = os.urandom(size)
+        results.append(
+            {
+                "size": size,
+                "shared_ms": measure(shared, payload, args.number),
+                "pickled_ms": measure(pickled, payload, args.number),
+            }
+        )
+    shared.close()
+    pickled.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+""" Reverse proxy throughput and latency.
+
+Starts -u stand-in upstreams, HttpServers answering GET / with a body
+of --size bytes, and a ProxyServer balancing over them, each in its own
+process. The whoops load generator then runs the same HTTP keep-alive
+workload against one upstream directly and through the proxy, the
+difference is the cost of the proxy hop. Also reports how the proxy
+spread the requests over the upstreams::
+
+    python benchmarks/proxy.py -u 2 -c 32 -d 5
+    python benchmarks/proxy.py --balance least_connections --size 65536
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop  # noqa: E402
+from whoops.bench import Bench, HttpWorkload  # noqa: E402
+from whoops.httplib.http_server import HttpServer  # noqa: E402
+from whoops.httplib.proxy import ProxyServer, BALANCERS  # noqa: E402
+
+
+def upstream(port, size):
+    loop = ioloop.IOLoop(num_backends=4)
+    server = HttpServer(loop, ("127.0.0.1", port))
+    loop.setloglevel(logging.CRITICAL)
+    body = "x" * size
+
+    @server.route("/")
+    def index(server):
+        return body
+
+    server.listen()
+
+
+def proxy(port, upstreams, args, counts):
+    loop = ioloop.IOLoop(num_backends=8)
+    server = ProxyServer(
+        loop,
+        ("127.0.0.1", port),
+        [("127.0.0.1", p) for p in upstreams],
+        balance=args.balance,
+        pool_size=args.connections,
+    )
+    loop.setloglevel(logging.CRITICAL)
+
+    def report():
+        for i, stats in enumerate(server.stats()):
+            counts[i] = stats["requests"]
+        loop.call_later(0.1, report)
+
+    loop.call_later(0.1, report)
+    server.listen()
+
+
+def run(port, args):
+    bench = Bench(
+        ("127.0.0.1", port),
+        HttpWorkload("127.0.0.1", "/", True),
+        connections=args.connections,
+        duration=args.duration,
+        warmup=args.warmup,
+    )
+    result = bench.run()
+    return {
+        "rps": result["rps"],
+        "errors": result["errors"],
+        "latency_ms": result["latency_ms"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops reverse proxy benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18990)
+    parser.add_argument("-u", "--upstreams", type=int, default=2)
+    parser.add_argument("-c", "--connections", type=int, default=32)
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--size", type=int, default=1024, help="response body size")
+    parser.add_argument("--balance", choices=sorted(BALANCERS), default="round_robin")
+    args = parser.parse_args(argv)
+
+    ports = [args.port + 1 + i for i in range(args.upstreams)]
+    counts = multiprocessing.Array("l", args.upstreams)
+    processes = [
+        multiprocessing.Process(target=upstream, args=(p, args.size)) for p in ports
+    ]
+    processes.append(
+        multiprocessing.Process(target=proxy, args=(args.port, ports, args, counts))
+    )
+    for process in processes:
+        process.daemon = True
+        process.start()
+    time.sleep(1)
+
+    direct = run(ports[0], args)
+    proxied = run(args.port, args)
+    for process in processes:
+        process.terminate()
+
+    print(
+        json.dumps(
+            {
+                "upstreams": args.upstreams,
+                "balance": args.balance,
+                "connections": args.connections,
+                "size": args.size,
+                "direct": direct,
+                "proxied": proxied,
+                "upstream_requests": list(counts),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
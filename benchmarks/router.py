@@ -0,0 +1,106 @@
+""" Route lookup cost against the number of routes.
+
+Builds routers of 10 to 5000 routes, half of them static and half with
+typed parameters, and reports nanoseconds per `Router.resolve` for
+static hits, parameter hits and misses. A linear list of compiled
+regular expressions, the usual framework router, is measured on the
+same routes for comparison (--no-regex skips it)::
+
+    python benchmarks/router.py
+    python benchmarks/router.py 10 100 1000 5000 20000
+
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops.httplib.router import Router, RouteNotFound  # noqa: E402
+
+
+def handler(server, **params):
+    pass
+
+
+def build(n):
+    router = Router()
+    regexes = []
+    static, dynamic = [], []
+    for i in range(n):
+        if i % 2:
+            pattern = "/api/v1/resource%d/items/<int:id>" % i
+            regex = r"^/api/v1/resource%d/items/(?P<id>\d+)$" % i
+            dynamic.append("/api/v1/resource%d/items/%d" % (i, i * 7))
+        else:
+            pattern = "/api/v1/resource%d/list" % i
+            regex = r"^/api/v1/resource%d/list$" % i
+            static.append(pattern)
+        router.add("GET", pattern, handler)
+        regexes.append((re.compile(regex), handler))
+    return router, regexes, static, dynamic
+
+
+def regex_resolve(regexes, path):
+    for regex, h in regexes:
+        m = regex.match(path)
+        if m is not None:
+            return h, m.groupdict()
+    raise RouteNotFound(path)
+
+
+def measure(resolve, paths, number):
+    # best of 5 rounds, ns per lookup.
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for i in range(number):
+            try:
+                resolve("GET", paths[i % len(paths)])
+            except RouteNotFound:
+                pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1e9 / number, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops router benchmark")
+    parser.add_argument("counts", nargs="*", type=int, default=[10, 100, 1000, 5000])
+    parser.add_argument("-n", "--number", type=int, default=100000)
+    parser.add_argument("--no-regex", action="store_true")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(42)
+    results = []
+    for n in args.counts:
+        router, regexes, static, dynamic = build(n)
+        static = [rng.choice(static) for _ in range(1024)]
+        dynamic = [rng.choice(dynamic) for _ in range(1024)] if dynamic else static
+        missing = ["/api/v1/resource%d/missing" % rng.randrange(n) for _ in range(1024)]
+        result = {
+            "routes": n,
+            "static_ns": measure(router.resolve, static, args.number),
+            "param_ns": measure(router.resolve, dynamic, args.number),
+            "miss_ns": measure(router.resolve, missing, args.number),
+        }
+        if not args.no_regex:
+            # linear: fewer lookups, the big tables take a while.
+            number = max(1000, args.number // max(1, n // 10))
+
+            def linear(method, path):
+                return regex_resolve(regexes, path)
+
+            result["regex_static_ns"] = measure(linear, static, number)
+            result["regex_param_ns"] = measure(linear, dynamic, number)
+        results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
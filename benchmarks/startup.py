@@ -0,0 +1,162 @@
+""" Startup cost of short-lived workers, every run in a fresh interpreter.
+
+* import : wall time of importing each module, median of -n runs, and
+  the modules costing the most by `python -X importtime`, leaving out
+  those the bare interpreter loads anyway.
+* construct : an IOLoop and --servers HttpServers made, nothing served.
+* heavy : the stdlib modules that are loaded on first use only and must
+  not be after the imports and construction above.
+* handlers : stream handlers on each whoops logger after making as many
+  loops and servers, one at most.
+
+Exits 1 when a median import or construction is over --budget
+milliseconds, a heavy module is loaded or a handler duplicated::
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --budget 60 -n 20
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+MODULES = (
+    "whoops.ioloop",
+    "whoops.async_server",
+    "whoops.httplib.http_server",
+    "whoops.wsgilib.wsgi_server",
+)
+
+# loaded with the first request, profile, upgrade, restart or callback.
+HEAVY = (
+    "http.client",
+    "email",
+    "ssl",
+    "json",
+    "uuid",
+    "subprocess",
+    "tempfile",
+    "concurrent.futures",
+    "whoops.profiler",
+    "whoops.httplib.websocket",
+)
+
+CHILD = """
+import logging, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+__import__(sys.argv[2])
+imported = time.perf_counter() - start
+
+from whoops import ioloop
+from whoops.httplib.http_server import HttpServer
+start = time.perf_counter()
+loops = [ioloop.IOLoop(num_backends=4) for _ in range(int(sys.argv[3]))]
+for loop in loops:
+    loop.logger.debug("made")
+servers = [HttpServer(loop, ("127.0.0.1", 0)) for loop in loops]
+constructed = time.perf_counter() - start
+
+heavy = [name for name in sys.argv[4].split(",") if name in sys.modules]
+handlers = {}
+for name, logger in logging.Logger.manager.loggerDict.items():
+    if name.startswith("whoops") and isinstance(logger, logging.Logger):
+        handlers[name] = len(logger.handlers)
+
+import json
+print(json.dumps([imported, constructed, heavy, handlers]))
+"""
+
+
+def run(module, servers):
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, ROOT, module, str(servers), ",".join(HEAVY)],
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output)
+
+
+def importtime(code):
+    # {module: (self, cumulative)} in microseconds.
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def costliest(module, top):
+    baseline = importtime("pass")
+    times = importtime("import sys; sys.path.insert(0, %r); import %s" % (ROOT, module))
+    own = [(t[0], name) for name, t in times.items() if name not in baseline]
+    return [
+        {"module": name, "self_ms": round(us / 1000, 2)}
+        for us, name in sorted(own, reverse=True)[:top]
+    ]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops startup benchmark")
+    parser.add_argument("modules", nargs="*", default=list(MODULES))
+    parser.add_argument("-n", "--number", type=int, default=10)
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--budget", type=float, default=50, help="milliseconds")
+    parser.add_argument("--top", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    results = {}
+    failures = []
+    for module in args.modules:
+        runs = [run(module, args.servers) for _ in range(args.number)]
+        imported = median(r[0] for r in runs) * 1000
+        constructed = median(r[1] for r in runs) * 1000
+        _, _, heavy, handlers = runs[-1]
+        results[module] = {
+            "import_ms": round(imported, 2),
+            "construct_ms": round(constructed, 2),
+            "heavy": heavy,
+            "handlers": handlers,
+            "costliest": costliest(module, args.top),
+        }
+        if imported > args.budget:
+            failures.append(
+                "%s: import %.1f ms > %.1f ms" % (module, imported, args.budget)
+            )
+        if constructed > args.budget:
+            failures.append(
+                "%s: construct %.1f ms > %.1f ms" % (module, constructed, args.budget)
+            )
+        if heavy:
+            failures.append("%s: loads %s" % (module, ", ".join(heavy)))
+        for name, count in handlers.items():
+            if count > 1:
+                failures.append("%s: %d handlers on %r" % (module, count, name))
+
+    print(json.dumps({"budget_ms": args.budget, "results": results}, indent=2))
+    if failures:
+        print("\n".join(failures), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
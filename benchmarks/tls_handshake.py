@@ -0,0 +1,197 @@
+""" TLS handshakes per second and session resumption rate.
+
+Generates a throwaway self-signed certificate with the openssl command
+line tool, runs a TLS echo AsyncServer in its own process and opens
+connections with AsyncClient as fast as possible: handshake, one
+round trip, close, repeat. With --resume (the default) clients share a
+SessionCache and resume sessions through tickets::
+
+    python benchmarks/tls_handshake.py -c 16 -d 5
+    python benchmarks/tls_handshake.py --no-resume
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, async_server, async_client, tls  # noqa: E402
+
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+class EchoServer(async_server.AsyncServer):
+    def on_connection(self, conn):
+        data = conn.read()
+        if data:
+            conn.write(data)
+
+
+def serve(port, certfile, keyfile, stats):
+    loop = ioloop.IOLoop(num_backends=8)
+    server = EchoServer(
+        loop, ("127.0.0.1", port), ssl_context=tls.server_context(certfile, keyfile)
+    )
+    loop.setloglevel(logging.CRITICAL)
+    handshaker = server.acceptor.handshaker
+
+    def report():
+        stats[0], stats[1], stats[2] = (
+            handshaker.handshakes,
+            handshaker.resumed,
+            handshaker.failed,
+        )
+        loop.call_later(0.1, report)
+
+    loop.call_later(0.1, report)
+    server.listen()
+
+
+class Bench(object):
+    def __init__(self, port, concurrency, duration, resume):
+        self.remote = ("127.0.0.1", port)
+        self.concurrency = concurrency
+        self.duration = duration
+        self.context = tls.client_context(verify=False)
+        self.sessions = tls.SessionCache() if resume else None
+        self.loop = ioloop.IOLoop(num_backends=concurrency)
+        self.loop.setloglevel(logging.CRITICAL)
+        self.lock = threading.Lock()
+        self.done = 0
+        self.resumed = 0
+        self.stopping = False
+
+    def spawn(self):
+        if not self.stopping:
+            Client(self)
+
+    def finished(self, client):
+        with self.lock:
+            self.done += 1
+            if client.connector.connect_socket.session_reused:
+                self.resumed += 1
+        client.close()
+        self.spawn()
+
+    def run(self):
+        threading.Thread(target=self.loop.start, daemon=True).start()
+        for _ in range(self.concurrency):
+            self.spawn()
+        time.sleep(self.duration)
+        self.stopping = True
+        return self.done, self.resumed
+
+
+class Client(async_client.AsyncClient):
+    def __init__(self, bench):
+        self.bench = bench
+        self.answered = False
+        super(Client, self).__init__(
+            bench.loop,
+            bench.remote,
+            ssl_context=bench.context,
+            server_hostname="localhost",
+            session_cache=bench.sessions,
+        )
+
+    def connection_made(self):
+        self.connector.transport.write(b"ping")
+
+    def on_write(self, conn):
+        pass
+
+    def on_connection(self, conn):
+        # reading also takes the TLS 1.3 tickets in.
+        if conn.read() and not self.answered:
+            self.answered = True
+            self.bench.finished(self)
+
+    def on_close(self):
+        if not self.answered:
+            self.bench.spawn()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops TLS handshake benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18990)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("--no-resume", action="store_true")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="whoops-tls-")
+    try:
+        certfile, keyfile = make_certificate(directory)
+        stats = multiprocessing.Array("l", 3)
+        server = multiprocessing.Process(
+            target=serve, args=(args.port, certfile, keyfile, stats)
+        )
+        server.daemon = True
+        server.start()
+        time.sleep(0.5)
+
+        bench = Bench(args.port, args.concurrency, args.duration, not args.no_resume)
+        done, resumed = bench.run()
+        time.sleep(0.3)
+        server.terminate()
+    finally:
+        shutil.rmtree(directory)
+
+    print(
+        json.dumps(
+            {
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "resume": not args.no_resume,
+                "handshakes": done,
+                "handshakes_per_second": round(done / args.duration, 1),
+                "resumed_rate": round(resumed / float(max(1, done)), 3),
+                "server": {
+                    "handshakes": stats[0],
+                    "resumed": stats[1],
+                    "failed": stats[2],
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+""" UDP datagrams per second into a DatagramServer.
+
+The server runs in its own process with a single executor thread,
+client processes send small datagrams as fast as they can (or at a
+fixed total rate) for the duration. Reports datagrams sent, received
+by the server, per second and the average batch size; with --reply the
+server answers every batch with `send_batch` and the replies received
+by the clients are counted too::
+
+    python benchmarks/udp_ingest.py -d 5 --size 64
+    python benchmarks/udp_ingest.py -w 2 --rate 300000 --reply
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop, datagram  # noqa: E402
+
+
+class CountingServer(datagram.DatagramServer):
+    def __init__(self, loop, address, batch, reply, stats):
+        super(CountingServer, self).__init__(loop, address, batch=batch, rcvbuf=8 << 20)
+        self.reply = reply
+        self.stats = stats
+
+    def datagrams_received(self, datagrams):
+        if self.reply:
+            self.send_batch(datagrams)
+        self.stats[0] = self.received
+        self.stats[1] = self.batches
+        self.stats[2] = self.dropped
+
+
+def serve(port, batch, reply, stats):
+    loop = ioloop.IOLoop(num_backends=1)
+    server = CountingServer(loop, ("127.0.0.1", port), batch, reply, stats)
+    loop.setloglevel(logging.CRITICAL)
+    server.listen()
+
+
+def send_worker(port, rate, duration, size, reply, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    sock.connect(("127.0.0.1", port))
+    sock.setblocking(False)
+    payload = b"x" * size
+    interval = 1.0 / rate if rate else 0
+    sent = replies = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        # bursts of 64 between clock reads and reply drains.
+        for _ in range(64):
+            if interval and start + sent * interval > now:
+                break
+            try:
+                sock.send(payload)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+            sent += 1
+        if reply:
+            try:
+                while sock.recv(65536):
+                    replies += 1
+            except (BlockingIOError, ConnectionRefusedError):
+                pass
+    if reply:
+        time.sleep(0.2)
+        try:
+            while sock.recv(65536):
+                replies += 1
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+    results.put((sent, replies))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops UDP ingest benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18980)
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-r", "--rate", type=float, default=0, help="0 is max")
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--reply", action="store_true")
+    args = parser.parse_args(argv)
+
+    stats = multiprocessing.Array("l", 3, lock=False)
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.batch, args.reply, stats)
+    )
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=send_worker,
+            args=(
+                args.port,
+                args.rate / args.workers,
+                args.duration,
+                args.size,
+                args.reply,
+                results,
+            ),
+        )
+        for _ in range(args.workers)
+    ]
+    for w in workers:
+        w.start()
+    sent = replies = 0
+    for _ in workers:
+        s, r = results.get()
+        sent += s
+        replies += r
+    for w in workers:
+        w.join()
+    time.sleep(0.3)
+    received, batches, dropped = stats[0], stats[1], stats[2]
+    server.terminate()
+
+    report = {
+        "rate": args.rate or None,
+        "size": args.size,
+        "batch": args.batch,
+        "sent": sent,
+        "received": received,
+        "received_per_second": round(received / args.duration, 1),
+        "loss": round(1 - received / float(max(1, sent)), 4),
+        "average_batch": round(received / float(max(1, batches)), 1),
+    }
+    if args.reply:
+        report["replies"] = replies
+        report["replies_dropped"] = dropped
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+""" WebSocket echo frames per second.
+
+An HttpServer in its own process echoes every message of its WebSocket
+connections. The client opens -c connections and keeps -w masked frames
+in flight on each, every echo received sends the next frame. Reports
+echoed frames and payload megabytes per second for each --size, and
+the cost of unmasking a payload in one big integer XOR next to a byte
+by byte loop::
+
+    python benchmarks/websocket.py
+    python benchmarks/websocket.py --size 100 65536 -c 8 -w 16 --deflate
+
+"""
+
+import argparse
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from whoops import ioloop  # noqa: E402
+from whoops.httplib.http_server import HttpServer  # noqa: E402
+from whoops.httplib.websocket import (  # noqa: E402
+    WebSocket,
+    BINARY,
+    apply_mask,
+    encode_frame,
+)
+
+
+def serve(port):
+    loop = ioloop.IOLoop(num_backends=8)
+    server = HttpServer(loop, ("127.0.0.1", port))
+    loop.setloglevel(logging.CRITICAL)
+
+    @server.websocket("/echo")
+    class Echo(WebSocket):
+        def on_message(self, message):
+            self.send(message)
+
+    server.listen()
+
+
+def connect(port, deflate):
+    sock = socket.create_connection(("127.0.0.1", port))
+    request = (
+        "GET /echo HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+        "Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+        "Sec-WebSocket-Key: %s\r\n" % base64.b64encode(os.urandom(16)).decode()
+    )
+    if deflate:
+        request += "Sec-WebSocket-Extensions: permessage-deflate\r\n"
+    sock.sendall((request + "\r\n").encode("latin-1"))
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += sock.recv(4096)
+    if not response.startswith(b"HTTP/1.1 101"):
+        raise RuntimeError(response.split(b"\r\n", 1)[0])
+    sock.setblocking(False)
+    return sock
+
+
+def frames(buf):
+    # the number of whole frames in buf, removed from it.
+    count = 0
+    pos = 0
+    end = len(buf)
+    while end - pos >= 2:
+        length = buf[pos + 1] & 0x7F
+        start = pos + 2
+        if length == 126:
+            if end - pos < 4:
+                break
+            (length,) = struct.unpack_from("!H", buf, start)
+            start += 2
+        elif length == 127:
+            if end - pos < 10:
+                break
+            (length,) = struct.unpack_from("!Q", buf, start)
+            start += 8
+        if end - start < length:
+            break
+        pos = start + length
+        count += 1
+    del buf[:pos]
+    return count
+
+
+def run(port, size, args):
+    payload = os.urandom(size)
+    if args.deflate:
+        # compressible, half of it repeats.
+        payload = payload[: size // 2] * 2 + payload[: size % 2]
+    if args.deflate:
+        import zlib
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        frame = encode_frame(BINARY, data[:-4], rsv1=True, mask=os.urandom(4))
+    else:
+        frame = encode_frame(BINARY, payload, mask=os.urandom(4))
+
+    epoller = select.epoll()
+    socks = {}
+    bufs = {}
+    for _ in range(args.connections):
+        sock = connect(port, args.deflate)
+        socks[sock.fileno()] = sock
+        bufs[sock.fileno()] = bytearray()
+        epoller.register(sock.fileno(), select.EPOLLIN)
+        sock.sendall(frame * args.window)
+
+    echoed = 0
+    start = time.perf_counter()
+    deadline = start + args.duration
+    while time.perf_counter() < deadline:
+        for fd, _ in epoller.poll(0.1):
+            sock = socks[fd]
+            buf = bufs[fd]
+            try:
+                while True:
+                    data = sock.recv(1 << 20)
+                    if not data:
+                        raise RuntimeError("server closed the connection")
+                    buf += data
+            except BlockingIOError:
+                pass
+            n = frames(buf)
+            if n:
+                echoed += n
+                sock.setblocking(True)
+                sock.sendall(frame * n)
+                sock.setblocking(False)
+    elapsed = time.perf_counter() - start
+    for sock in socks.values():
+        sock.close()
+    return {
+        "size": size,
+        "frames_per_second": round(echoed / elapsed, 1),
+        "mb_per_second": round(echoed * size / elapsed / 1e6, 2),
+    }
+
+
+def unmask_cost(size, number=200):
+    # microseconds per payload, whole buffer XOR and byte by byte.
+    data = os.urandom(size)
+    mask = os.urandom(4)
+    start = time.perf_counter()
+    for _ in range(number):
+        apply_mask(data, mask)
+    xor = (time.perf_counter() - start) / number
+    number = max(1, number // 10)
+    start = time.perf_counter()
+    for _ in range(number):
+        bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    loop = (time.perf_counter() - start) / number
+    return {"unmask_us": round(xor * 1e6, 2), "bytewise_us": round(loop * 1e6, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="whoops WebSocket benchmark")
+    parser.add_argument("-p", "--port", type=int, default=18980)
+    parser.add_argument("--size", type=int, nargs="+", default=[100, 65536])
+    parser.add_argument("-c", "--connections", type=int, default=4)
+    parser.add_argument("-w", "--window", type=int, default=16, help="frames in flight")
+    parser.add_argument("-d", "--duration", type=float, default=5)
+    parser.add_argument("--deflate", action="store_true")
+    args = parser.parse_args(argv)
+
+    server = multiprocessing.Process(target=serve, args=(args.port,))
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+
+    results = []
+    for size in args.size:
+        result = run(args.port, size, args)
+        result.update(unmask_cost(size))
+        results.append(result)
+    server.terminate()
+    print(json.dumps({"deflate": args.deflate, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
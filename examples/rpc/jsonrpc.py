@@ -47,18 +47,27 @@
 # ]
 # --> {"jsonrpc": "2.0", "method": 1, "params": "bar"}
 # <-- {"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": null}
+# Procedure call with a deadline, seconds from its arrival (an extension,
+# the server's request_timeout applies when shorter):
+
+# --> {"jsonrpc": "2.0", "method": "report", "timeout": 0.5, "id": 11}
+# <-- {"jsonrpc": "2.0", "error": {"code": -32000, "message": "Deadline exceeded."}, "id": 11}
 
 import json
+import threading
 import uuid
 import socket
 
 from whoops import async_server
 from whoops import async_client
+from whoops.deadline import Deadline, parse_timeout
+from whoops.offload import Offloader
 
 JSONRPC_CODES = {
     -32600: "Invalid Request.",
     -32601: "JSON-RPC Version Not Supported.",
-    -32603: "Parse error.",
+    -32603: "Internal error.",
+    -32000: "Deadline exceeded.",
 }
 
 
@@ -70,8 +79,63 @@ class JSONRPCServer(async_server.AsyncServer):
 
     method_dict = {}
 
+    # names of the methods run in worker processes
+    cpu_bound = set()
+
+    _offloader = None
+
+    # seconds a call may take from its arrival, None: no limit.
+    request_timeout = None
+
+    def __init__(self, *args, **kwargs):
+        # transport -> deadline cancelled when its client hangs up,
+        # dropped with the connection.
+        self._hangups = {}
+        # the request and call being processed by this thread
+        self._local = threading.local()
+        super(JSONRPCServer, self).__init__(*args, **kwargs)
+
+    @property
+    def offloader(self):
+        if self._offloader is None:
+            self._offloader = Offloader(self.ioloop)
+        return self._offloader
+
+    @property
+    def deadline(self):
+        # of the call a method runs for, see whoops.deadline.
+        return getattr(self._local, "deadline", None)
+
+    def on_hangup(self, conn):
+        # the read submitted with the hangup finds it cancelled and
+        # drops the entry, see on_connection.
+        self._hangups.setdefault(conn, Deadline()).cancel()
+
     def on_connection(self, conn):
-        data = conn.read().decode("utf-8")
+        if conn.closed:
+            self._hangups.pop(conn, None)
+            return
+        # when the ioloop saw the request, the read below moves it.
+        arrived = conn.last_active
+        hangup = self._hangups.setdefault(conn, Deadline())
+        try:
+            data = conn.read()
+            if data:
+                self._local.request = (
+                    hangup.child(self.request_timeout, arrived),
+                    arrived,
+                )
+                self.process_request(conn, data.decode("utf-8"))
+            elif conn.at_eof():
+                hangup.cancel()
+        finally:
+            if hangup.cancelled or conn.closed:
+                # the client is gone, so are its entry and transport.
+                self._hangups.pop(conn, None)
+                self.ioloop.unregister(conn.conn.fileno())
+                conn.close()
+
+    def process_request(self, conn, data):
         print(data)
         jsonobj = None
         result = {
@@ -90,22 +154,68 @@ class JSONRPCServer(async_server.AsyncServer):
             return
 
         if isinstance(jsonobj, list):
-            for obj in jsonobj:
-                conn.write(json.dumps(self.process_single_request(obj)))
-                conn.write("\n")
+            self.write_results(conn, [self.process_single_request(o) for o in jsonobj])
             return
 
         if isinstance(jsonobj, dict):
-            conn.write(json.dumps(self.process_single_request(jsonobj)))
-            conn.write("\n")
+            self.write_results(conn, [self.process_single_request(jsonobj)])
             return
 
         result["error"] = self.process_error(-32600)
         conn.write(json.dumps(result))
         conn.write("\n")
 
+    def write_results(self, conn, results):
+        # offloaded calls fill their result in later, the batch is
+        # written in order once the last one is done.
+        pending = [r for r in results if "_params" in r]
+        request = self._local.request[0]
+        if not pending:
+            # nobody left to answer.
+            if request.cancelled:
+                return
+            for result in results:
+                conn.write(json.dumps(result))
+                conn.write("\n")
+            return
+        lock = threading.Lock()
+        left = [len(pending)]
+
+        def done(result, method, value, error):
+            if error is not None:
+                # a response has a result or an error.
+                self.ioloop.logger.error("%s failed: %r", method, error)
+                result["error"] = self.process_error(-32603)
+            elif value:
+                result["result"] = value
+            with lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            if request.cancelled:
+                return
+            for r in results:
+                conn.write(json.dumps(r))
+                conn.write("\n")
+
+        for result in pending:
+            method, params = result.pop("_method"), result.pop("_params")
+            deadline = result.pop("_deadline")
+            if deadline.expired:
+                # dropped before it runs.
+                result["error"] = self.process_error(-32000)
+                done(result, method, None, None)
+                continue
+            args, kwargs = (
+                (params, {}) if isinstance(params, list) else ((), params or {})
+            )
+            callback = lambda value, error, result=result, method=method: done(
+                result, method, value, error
+            )
+            self.offloader.submit(callback, self.method_dict[method], *args, **kwargs)
+
     def process_error(self, error_code=-1):
-        error = self.base_error
+        error = dict(self.base_error)
         error["code"] = error_code
         error["message"] = JSONRPC_CODES[error_code]
         return error
@@ -161,7 +271,23 @@ class JSONRPCServer(async_server.AsyncServer):
                 result["message"] = "Parse error."
                 return result
 
-        re = self.process_method(method, params)
+        request, arrived = self._local.request
+        deadline = request.child(parse_timeout(jsonobj.get("timeout")), arrived)
+        if deadline.expired:
+            result["error"] = self.process_error(-32000)
+            return result
+
+        if method in self.cpu_bound:
+            # run by write_results, without self.
+            result["_method"], result["_params"] = method, params
+            result["_deadline"] = deadline
+            return result
+
+        self._local.deadline = deadline
+        try:
+            re = self.process_method(method, params)
+        finally:
+            self._local.deadline = None
         if re and not isinstance(re, Exception):
             result["result"] = re
         return result
@@ -178,8 +304,15 @@ class JSONRPCServer(async_server.AsyncServer):
             return e
 
     @classmethod
-    def jsonrpc_method(self, f):
+    def jsonrpc_method(self, f=None, cpu_bound=False):
+        # cpu_bound methods run in a worker process as f(*params), they
+        # stay in the class as static methods to be pickled by name.
+        if f is None:
+            return lambda f: self.jsonrpc_method(f, cpu_bound)
         self.method_dict[f.__name__] = f
+        if cpu_bound:
+            self.cpu_bound.add(f.__name__)
+            return staticmethod(f)
 
         def wrapper(self, *args, **kwds):
             return f(self, *args, **kwds)
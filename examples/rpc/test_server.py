@@ -7,6 +7,11 @@ class MyServer(JSONRPCServer):
     def subtract(self, a, b):
         return a - b
 
+    @JSONRPCServer.jsonrpc_method(cpu_bound=True)
+    def fib(n):
+        # CPU-bound, runs in a worker process.
+        return n if n < 2 else MyServer.fib(n - 1) + MyServer.fib(n - 2)
+
     def foobar(self):
         pass
 
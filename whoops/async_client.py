@@ -1,56 +1,246 @@
+import errno
 import socket
+import threading
+import time
 
+from collections import deque
+
+from . import unix
 from .ioloop import IOLoop, Transport
 
 
 class Connector(object):
-    def __init__(self, remote):
+
+    # connector states
+    _DISCONNECTED = 0
+    _CONNECTING = 1
+    _CONNECTED = 2
+
+    def __init__(
+        self,
+        remote,
+        timeout=30,
+        ssl_context=None,
+        server_hostname=None,
+        session_cache=None,
+    ):
+        if unix.is_unix_address(remote):
+            # a Unix socket path, nothing to resolve.
+            family, type_, proto = socket.AF_UNIX, socket.SOCK_STREAM, 0
+            sockaddr = unix.sockaddr(remote)
+        else:
+            # resolve once, connect(2) itself must never block the caller.
+            family, type_, proto, _, sockaddr = socket.getaddrinfo(
+                remote[0], remote[1], 0, socket.SOCK_STREAM
+            )[0]
+
         # connect socket file
-        self.connect_socket = socket.create_connection(address=remote, timeout=30)
-        self.connect_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.connect_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_socket = socket.socket(family, type_, proto)
+        if family != socket.AF_UNIX:
+            self.connect_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.connect_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.connect_socket.setblocking(False)
+        self.fd = self.connect_socket.fileno()
 
         # ioloop
         self.ioloop = None
 
         # remote server/client address
         self.remote = remote
+        self.sockaddr = sockaddr
+
+        # connect timeout in seconds
+        self.timeout = timeout
+        self.state = self._DISCONNECTED
+        self._timer = None
+        self._on_write_cb = None
+        self._on_connection_cb = None
+
+        # TLS, the handshake is part of connecting.
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.session_cache = session_cache
 
         # transport
-        self.transport = Transport(self.connect_socket, self.remote)
+        if ssl_context is not None:
+            from .tls import TLSTransport
+
+            self.transport = TLSTransport(self.connect_socket, self.remote)
+        else:
+            self.transport = Transport(self.connect_socket, self.remote)
         self.transport.events = (
             IOLoop._EPOLLIN | IOLoop._EPOLLOUT | IOLoop._EPOLLERR | IOLoop._EPOLLET
         )
 
+    @property
+    def connected(self):
+        return self.state == self._CONNECTED and not self.transport.closed
+
     def connect(self):
-        self.connect_socket.connect(self.remote)
+        # connect once, the handshake completes with EPOLLOUT.
+        if self.state != self._DISCONNECTED:
+            return
+        self.state = self._CONNECTING
+        self._on_write_cb = self.transport.on_write_cb
+        self.transport.on_write_cb = self.on_connect_callback
+        if self.ioloop and self.timeout:
+            self._timer = self.ioloop.call_later(self.timeout, self.on_connect_timeout)
+
+        err = self.connect_socket.connect_ex(self.sockaddr)
+        if self.connect_socket.family == socket.AF_UNIX and err == errno.EAGAIN:
+            # a full listen queue, a Unix connect is not left in progress.
+            self.on_connect_error(err)
+            return
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            self.on_connect_error(err)
+            return
+        # a socket polls as EPOLLHUP until connect(2) is issued,
+        # so it is handed to the poller only now.
+        if self.ioloop:
+            self.ioloop.register(self.fd, self.transport.events)
+
+    def on_connect_callback(self, conn):
+        # first EPOLLOUT: the handshake finished, one way or the other.
+        if self.state != self._CONNECTING or self.transport.closed:
+            return
+        try:
+            err = self.connect_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        except OSError as e:
+            err = e.errno
+        if err:
+            self.on_connect_error(err)
+            return
+        try:
+            self.connect_socket.getpeername()
+        except OSError:
+            # a stale event for a previous socket with the same fd,
+            # the handshake is still in progress.
+            return
+
+        if self.ssl_context is not None:
+            self.start_tls()
+            return
+        self.on_connected(conn)
+
+    def start_tls(self):
+        session = None
+        if self.session_cache is not None:
+            session = self.session_cache.get(self.remote)
+        server_hostname = self.server_hostname
+        if server_hostname is None and not unix.is_unix_address(self.remote):
+            server_hostname = self.remote[0]
+        self.connect_socket = self.ssl_context.wrap_socket(
+            self.connect_socket,
+            server_hostname=server_hostname,
+            do_handshake_on_connect=False,
+            session=session,
+        )
+        self.transport.conn = self.connect_socket
+        # every event drives the handshake until it is done.
+        self._on_connection_cb = self.transport.on_connection_cb
+        self.transport.on_connection_cb = self.on_handshake
+        self.transport.on_write_cb = self.on_handshake
+        self.on_handshake(self.transport)
+
+    def on_handshake(self, conn):
+        from . import tls
+
+        with self.transport._lock():
+            if self.state != self._CONNECTING or self.transport.closed:
+                return
+            try:
+                if not tls.handshake(self.transport):
+                    return
+            except (tls.ssl.SSLError, OSError) as e:
+                self.on_connect_error(e)
+                return
+            if self.session_cache is not None:
+                self.session_cache.put(self.remote, self.connect_socket.session)
+            self.transport.on_connection_cb = self._on_connection_cb
+        self.on_connected(conn)
+        # records already decrypted by the handshake are not in the kernel.
+        if self.connect_socket.pending() and self._on_connection_cb:
+            self._on_connection_cb(conn)
+
+    def on_connected(self, conn):
+        self.state = self._CONNECTED
+        if self._timer:
+            self._timer.cancel()
+        self.transport.on_write_cb = self._on_write_cb
+        if self.transport.connection_made_cb:
+            try:
+                self.transport.connection_made_cb()
+            except NotImplementedError:
+                pass
+        # edge triggered, the socket is writable right now and
+        # there will be no other EPOLLOUT until the buffer fills.
+        if self._on_write_cb:
+            self._on_write_cb(conn)
+
+    def on_connect_timeout(self):
+        if self.state == self._CONNECTING:
+            self.on_connect_error(errno.ETIMEDOUT)
+
+    def on_connect_error(self, err):
+        self.state = self._DISCONNECTED
+        if self._timer:
+            self._timer.cancel()
+        if self.ioloop:
+            self.ioloop.logger.error(
+                "connect to %s failed: %s", self.remote, errno.errorcode.get(err, err)
+            )
+        self.close()
 
     def close(self):
-        self.connect_socket.close()
+        # TLS 1.3 tickets arrive after the handshake, keep the latest.
+        if self.session_cache is not None and self.connected:
+            self.session_cache.put(self.remote, self.connect_socket.session)
+        if self.ioloop:
+            self.ioloop.unregister(self.fd)
+        self.transport.close()
 
     def fileno(self):
-        return self.connect_socket.fileno()
+        return self.fd
 
 
 class AsyncClient(object):
-    def __init__(self, ioloop, remote):
+    def __init__(
+        self,
+        ioloop,
+        remote,
+        timeout=30,
+        ssl_context=None,
+        server_hostname=None,
+        session_cache=None,
+    ):
         self.ioloop = ioloop
 
-        self.connector = Connector(remote=remote)
-
-        # register
-        self.ioloop.register_connector(self.connector)
+        self.connector = Connector(
+            remote=remote,
+            timeout=timeout,
+            ssl_context=ssl_context,
+            server_hostname=server_hostname,
+            session_cache=session_cache,
+        )
 
         # register ioloop callbacks
         self.connector.transport.on_connection_cb = self.on_connection
-        self.connector.transport.connection_made = self.connection_made
+        self.connector.transport.connection_made_cb = self.connection_made
         self.connector.transport.on_write_cb = self.on_write
         self.connector.transport.on_close_cb = self.on_close
 
+        # register
+        self.ioloop.register_connector(self.connector)
+
+        # non-blocking connect
+        self.connector.connect()
+
     def connect(self):
         self.connector.connect()
 
+    def close(self):
+        self.connector.close()
+
     def shutdown(self):
         self.connector.close()
         self.ioloop.stop()
@@ -66,3 +256,113 @@ class AsyncClient(object):
 
     def on_close(self):
         raise NotImplementedError()
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    """ Keyed pool of warm outbound connections.
+
+    Connections are kept per remote address. `acquire` hands out an
+    idle connection if a healthy one exists, otherwise opens a new one
+    with `client_class(ioloop, remote)` while the remote is below
+    `max_size`. `release` gives the connection back; idle connections
+    older than `idle_timeout` seconds are closed by an ioloop timer.
+
+    """
+
+    def __init__(self, ioloop, client_class, max_size=64, idle_timeout=60):
+        self.ioloop = ioloop
+        self.client_class = client_class
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+
+        # remote -> deque of (released at, client)
+        self.idle = {}
+        # remote -> number of open clients, idle or in use
+        self.size = {}
+        self._lock = threading.Lock()
+
+        self._timer = None
+        if idle_timeout:
+            self._timer = self.ioloop.call_later(idle_timeout, self.evict_idle)
+
+    def acquire(self, remote):
+        while True:
+            with self._lock:
+                idle = self.idle.get(remote)
+                client = idle.pop()[1] if idle else None
+                if client is None:
+                    if self.size.get(remote, 0) >= self.max_size:
+                        raise PoolExhausted(remote)
+                    self.size[remote] = self.size.get(remote, 0) + 1
+                    break
+            # most recently used first, the warmest connection.
+            if self.healthy(client):
+                return client
+            self.discard(client)
+
+        try:
+            return self.client_class(self.ioloop, remote)
+        except Exception:
+            with self._lock:
+                self.size[remote] -= 1
+            raise
+
+    def release(self, client):
+        if not self.healthy(client):
+            self.discard(client)
+            return
+        remote = client.connector.remote
+        with self._lock:
+            self.idle.setdefault(remote, deque()).append((time.monotonic(), client))
+
+    def discard(self, client):
+        remote = client.connector.remote
+        client.close()
+        with self._lock:
+            if self.size.get(remote, 0) > 0:
+                self.size[remote] -= 1
+
+    def healthy(self, client):
+        # a connecting client is fine, it is not broken (yet).
+        connector = client.connector
+        if connector.transport.closed:
+            return False
+        if connector.state != Connector._CONNECTED:
+            return connector.state == Connector._CONNECTING
+        # idle peers must not talk, EAGAIN means alive and silent.
+        try:
+            # the raw socket, under TLS too.
+            data = socket.socket.recv(connector.connect_socket, 1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        # b'' is EOF, anything else is an unexpected response, except
+        # for TLS where it may be session tickets.
+        return bool(data) and connector.ssl_context is not None
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._lock:
+            for idle in self.idle.values():
+                while idle and idle[0][0] <= deadline:
+                    expired.append(idle.popleft()[1])
+        # closing calls user callbacks, keep them off the ioloop thread.
+        for client in expired:
+            self.ioloop.executor.submit(self.discard, client)
+        self._timer = self.ioloop.call_later(self.idle_timeout, self.evict_idle)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        with self._lock:
+            clients = [client for idle in self.idle.values() for _, client in idle]
+            self.idle.clear()
+        for client in clients:
+            self.discard(client)
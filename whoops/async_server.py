@@ -1,49 +1,123 @@
+import errno
+import os
 import socket
+import time
 
-
-from .ioloop import IOLoop, Transport
+from . import restart, unix
+from .broadcast import Broadcaster
+from .ioloop import IOLoop, Handler, Transport
 
 
 class Acceptor(object):
-    def __init__(self):
+    def __init__(self, accept_budget=128, family=socket.AF_INET, unix_mode=None):
         # single thread accept socket
-        self.accept_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.accept_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.accept_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.accept_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.accept_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.accept_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.accept_socket.setblocking(False)
 
+        # permissions of a Unix socket file, and the file we bound
+        self.unix_mode = unix_mode
+        self._unix_file = None
+
         # ioloop
         self.ioloop = None
 
+        # callbacks shared by the accepted transports
+        self.handler = None
+
+        # tls.ServerHandshaker, for TLS listeners
+        self.handshaker = None
+
+        # connections accepted per ioloop wakeup at most, an accept
+        # storm must not starve the established connections.
+        self.accept_budget = accept_budget
+
+        # ratelimit.RateLimiter, refused connections are reset
+        self.limiter = None
+
     def transport(self):
         self.transport = Transport(self.accept_socket, self.address)
         self.transport.on_connection_cb = self.on_accept_callback
         return self.transport
 
     def on_accept_callback(self, conn):
+        # called on the ioloop thread, returns True if the budget ran
+        # out before the listen queue did.
+        ioloop = self.ioloop
+        handler = self.handler
+        limiter = self.limiter
+        made = 0
         try:
-            while True:
-                conn, address = self.accept()
-                conn.setblocking(False)
-                self.ioloop.register(conn.fileno(), IOLoop._READ | IOLoop._EPOLLET)
-                transport = Transport(conn, address)
-                transport.events = IOLoop._READ
-                transport.on_connection_cb = self.ioloop.on_connection_cb
-                transport.on_write_cb = self.ioloop.on_write_cb
-                transport.on_close_cb = self.ioloop.on_close_cb
-                transport.connection_made_cb = self.ioloop.connection_made_cb
-                self.ioloop.connections[conn.fileno()] = transport
-                # connection_made callback
-                self.ioloop.executor.submit(transport.connection_made_cb)
-        except socket.error:
-            pass
+            for _ in range(self.accept_budget):
+                try:
+                    conn, address = self.accept()
+                except (BlockingIOError, InterruptedError):
+                    return False
+                except socket.error as e:
+                    if e.errno in (errno.ECONNABORTED, errno.EPROTO):
+                        continue
+                    # EMFILE, ENFILE, ENOBUFS...
+                    ioloop.logger.error("accept failed: %s", e)
+                    return False
+                if limiter is not None and not limiter.accept(conn.fileno(), address):
+                    limiter.refuse(conn)
+                    continue
+                made += self.add(conn)
+            return True
+        finally:
+            # one executor job for the whole batch.
+            if made and handler.connection_made_cb:
+                ioloop.executor.submit(
+                    self.connections_made, handler.connection_made_cb, made
+                )
+
+    def add(self, conn):
+        # returns the number of connections made right away.
+        conn.setblocking(False)
+        fd = conn.fileno()
+        made = 0
+        if self.handshaker:
+            # connection made once the handshake is done.
+            transport = self.handshaker.wrap(conn)
+        else:
+            # no address tuple per idle connection, the transport
+            # asks the socket when needed.
+            transport = Transport(conn, None, self.handler)
+            # hangups while a request runs cancel its deadline.
+            transport.events = IOLoop._READ | IOLoop._EPOLLRDHUP
+            made = 1
+        # known to the ioloop before the poller may report it.
+        self.ioloop.connections[fd] = transport
+        self.ioloop.register(fd, transport.events | IOLoop._EPOLLET)
+        return made
+
+    def connections_made(self, callback, count):
+        for _ in range(count):
+            try:
+                callback()
+            except NotImplementedError:
+                pass
 
     def fileno(self):
         return self.accept_socket.fileno()
 
     def bind(self, address):
         self.address = address
-        self.accept_socket.bind(address)
+        sock = restart.inherited(address)
+        if sock is not None:
+            # handed over by the previous process, bound and listening.
+            self.accept_socket.close()
+            self.accept_socket = sock
+            if sock.family == socket.AF_UNIX and not unix.is_abstract(address):
+                st = os.stat(unix.sockaddr(address))
+                self._unix_file = st.st_dev, st.st_ino
+            return
+        if self.accept_socket.family == socket.AF_UNIX:
+            self._unix_file = unix.bind(self.accept_socket, address, self.unix_mode)
+        else:
+            self.accept_socket.bind(address)
 
     def accept(self):
         return self.accept_socket.accept()
@@ -51,29 +125,135 @@ class Acceptor(object):
     def listen(self, backlog):
         self.accept_socket.listen(backlog)
 
-    def close(self):
+    def close(self, unlink=True):
+        # a handed over Unix socket keeps its file.
         self.accept_socket.close()
+        if self._unix_file and unlink:
+            unix.unlink(self.address, self._unix_file)
+        self._unix_file = None
 
 
 class AsyncServer(object):
-    def __init__(self, ioloop, address):
+    def __init__(
+        self, ioloop, address, accept_budget=128, ssl_context=None, unix_mode=None
+    ):
         self.ioloop = ioloop
 
-        # acceptor include a listened socket file.
-        self.acceptor = Acceptor()
+        # acceptor include a listened socket file, a string address
+        # is a Unix socket path.
+        self.acceptor = Acceptor(accept_budget, unix.address_family(address), unix_mode)
         self.acceptor.bind(address)
         # register
         self.ioloop.register_acceptor(self.acceptor)
 
-        # register ioloop callbacks
-        self.ioloop.on_connection_cb = self.on_connection
-        self.ioloop.connection_made = self.connection_made
-        self.ioloop.on_write_cb = self.on_write
-        self.ioloop.on_close_cb = self.on_close
+        # callbacks, shared by all the accepted transports
+        self.handler = Handler(ioloop)
+        self.handler.on_connection_cb = self.on_connection
+        self.handler.on_write_cb = self.on_write
+        self.handler.on_close_cb = self.on_close
+        # no executor job per new connection unless it is overridden.
+        if type(self).connection_made is not AsyncServer.connection_made:
+            self.handler.connection_made_cb = self.connection_made
+        if type(self).on_hangup is not AsyncServer.on_hangup:
+            self.handler.on_hangup_cb = self.on_hangup
+        self.acceptor.handler = self.handler
+
+        # TLS, handshakes are driven on the executor.
+        self.ssl_context = ssl_context
+        if ssl_context is not None:
+            from . import tls
+
+            self.acceptor.handshaker = tls.ServerHandshaker(self.acceptor, ssl_context)
+            self.acceptor.handshaker.bind(ioloop)
+
+        # topic fan-out, replace it to change the backlog policy.
+        self.broadcaster = Broadcaster(ioloop)
+
+        # set by shutdown
+        self.draining = False
+
+    def adopt(self, conn):
+        """ Serves a connection accepted somewhere else, a socket or a
+        descriptor received with `unix.recv_fds`.
+
+        """
+        if isinstance(conn, int):
+            conn = socket.socket(fileno=conn)
+        if self.acceptor.add(conn) and self.handler.connection_made_cb:
+            self.acceptor.connections_made(self.handler.connection_made_cb, 1)
 
-    def listen(self, backlog=1):
+    def set_limiter(self, limiter):
+        """ Limits the connections and requests of each client with a
+        `ratelimit.RateLimiter`, None removes the limits.
+
+        """
+        self.acceptor.limiter = limiter
+        self.ioloop.limiter = limiter
+
+    def shutdown(self, timeout=30, handoff=False):
+        """ Stops gracefully: no new connections, idle connections are
+        closed as soon as they are idle, the ioloop stops once none is
+        left or after `timeout` seconds and `listen` returns. Safe to
+        call from any thread or a signal handler.
+
+        With `handoff` another process serves the listening socket, a
+        Unix socket file is kept.
+
+        """
+        if self.draining:
+            return
+        self.draining = True
+        # add_callback takes no lock a signal could interrupt.
+        self.ioloop.add_callback(self._drain, time.monotonic() + timeout, handoff)
+
+    def _drain(self, deadline, handoff=None):
+        # on the ioloop thread, until nothing is left.
+        ioloop = self.ioloop
+        if handoff is not None:
+            ioloop.stop_accepting(unlink=not handoff)
+        self.close_idle()
+        if ioloop.connections and time.monotonic() < deadline:
+            ioloop.call_later(0.05, self._drain, deadline)
+            return
+        if ioloop.connections:
+            ioloop.logger.warning(
+                "shutdown timeout, closing %d busy connections", len(ioloop.connections)
+            )
+        ioloop.stop()
+
+    def close_idle(self):
+        for fd, transport in list(self.ioloop.connections.items()):
+            if self.idle(transport):
+                self.ioloop.unregister(fd)
+                transport.close()
+
+    def idle(self, transport):
+        """ True if a shutdown may close `transport`: a connection of
+        this server with nothing to write and nothing unread. Servers
+        tracking requests in flight refine it.
+
+        """
+        return (
+            transport.handler is self.handler
+            and not transport.pending
+            and not transport.unread()
+        )
+
+    def subscribe(self, topic, conn):
+        self.broadcaster.subscribe(topic, conn)
+
+    def unsubscribe(self, topic, conn):
+        self.broadcaster.unsubscribe(topic, conn)
+
+    def publish(self, topic, message):
+        # encoded once, shared by every subscriber's write queue.
+        return self.broadcaster.publish(topic, message)
+
+    def listen(self, backlog=socket.SOMAXCONN):
         # backlog
         self.ioloop.acceptor.listen(backlog)
+        # a restarting previous process drains from now on.
+        restart.notify_ready()
         self.ioloop.start()
 
     def connection_made(self):
@@ -87,3 +267,7 @@ class AsyncServer(object):
 
     def on_close(self):
         raise NotImplementedError()
+
+    def on_hangup(self, conn):
+        # on the ioloop thread, the peer closed or reset conn.
+        raise NotImplementedError()
@@ -0,0 +1,401 @@
+""" Load generator for whoops servers.
+
+Drives an echo, HTTP GET or JSON-RPC workload over N concurrent
+`AsyncClient` connections, either as fast as possible (closed loop) or
+at a fixed request rate (open loop), and prints a JSON report::
+
+    python -m whoops.bench --workload http -c 100 -d 10 127.0.0.1 8888
+    python -m whoops.bench --workload echo -c 50 --rate 20000 127.0.0.1 8888
+    python -m whoops.bench --workload http -c 100 /run/app.sock
+
+At a fixed rate every request has an intended send time on a schedule.
+Latency is measured from that time and not from the actual send, so a
+stalled server is charged for the requests it held back (coordinated
+omission correction). In closed loop mode there is no schedule and the
+reported latencies are plain service times.
+
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+
+import whoops
+
+from whoops import ioloop, async_client
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Workload(object):
+
+    """ Builds requests and tells when a response is complete. """
+
+    name = None
+
+    def request(self):
+        raise NotImplementedError()
+
+    def response_length(self, buffer):
+        # length of the first complete response in buffer, or None.
+        raise NotImplementedError()
+
+
+class EchoWorkload(Workload):
+
+    name = "echo"
+
+    def __init__(self, size=64):
+        self.message = b"x" * size
+
+    def request(self):
+        return self.message
+
+    def response_length(self, buffer):
+        if len(buffer) >= len(self.message):
+            return len(self.message)
+        return None
+
+
+class HttpWorkload(Workload):
+
+    name = "http"
+
+    def __init__(self, host, path="/", keepalive=True):
+        self.keepalive = keepalive
+        self.message = (
+            "GET %s HTTP/1.1\r\nHost: %s\r\nConnection: %s\r\n\r\n"
+            % (path, host, "keep-alive" if keepalive else "close")
+        ).encode("latin-1")
+
+    def request(self):
+        return self.message
+
+    def response_length(self, buffer):
+        end = buffer.find(b"\r\n\r\n")
+        if end < 0:
+            return None
+        content_length = 0
+        for line in buffer[:end].split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                content_length = int(value)
+        length = end + 4 + content_length
+        if len(buffer) >= length:
+            return length
+        return None
+
+
+class JSONRPCWorkload(Workload):
+
+    name = "jsonrpc"
+
+    def __init__(self, method="echo", params=None):
+        self.method = method
+        self.params = params if params is not None else []
+
+    def request(self):
+        return json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": self.method,
+                "params": self.params,
+                "id": str(uuid.uuid4()),
+            }
+        ).encode("utf-8")
+
+    def response_length(self, buffer):
+        # whoops JSON-RPC servers terminate responses with a newline.
+        end = buffer.find(b"\n")
+        if end < 0:
+            return None
+        return end + 1
+
+
+class BenchClient(async_client.AsyncClient):
+
+    """ One benchmark connection, one request in flight at a time. """
+
+    def __init__(self, bench, remote, queue=None):
+        self.bench = bench
+        self.lock = threading.Lock()
+        self.buffer = b""
+        self.latencies = []
+        self.errors = 0
+        # intended send times of requests not yet answered, the
+        # first one is in flight.
+        self.queue = queue if queue is not None else []
+        self.in_flight = False
+        self.finished = False
+        super(BenchClient, self).__init__(bench.ioloop, remote)
+
+    def connection_made(self):
+        self.bench.on_client_ready(self)
+
+    def on_write(self, conn):
+        pass
+
+    def on_close(self):
+        with self.lock:
+            if self.queue and not self.finished:
+                self.errors += 1
+            self.finished = True
+        self.bench.on_client_closed(self)
+
+    def enqueue(self, intended):
+        with self.lock:
+            if self.finished:
+                return
+            self.queue.append(intended)
+            if not self.in_flight and self.connector.connected:
+                self._send()
+
+    def kick(self):
+        # start sending once connected and the bench is running.
+        with self.lock:
+            if self.finished or self.in_flight:
+                return
+            if not self.queue and self.bench.closed_loop:
+                self.queue.append(None)
+            if self.queue:
+                self._send()
+
+    def _send(self):
+        self.in_flight = True
+        if self.queue[0] is None:
+            # closed loop: the request starts now.
+            self.queue[0] = time.perf_counter()
+        self.connector.transport.write(self.bench.workload.request())
+
+    def on_connection(self, conn):
+        data = conn.read()
+        with self.lock:
+            self.buffer += data
+            while self.in_flight:
+                length = self.bench.workload.response_length(self.buffer)
+                if length is None:
+                    break
+                self.buffer = self.buffer[length:]
+                now = time.perf_counter()
+                self.latencies.append(now - self.queue.pop(0))
+                self.in_flight = False
+                if self.bench.closed_loop and not self.bench.stopping:
+                    self.queue.append(None)
+                if self.bench.reconnect:
+                    break
+                if self.queue:
+                    self._send()
+        if not data:
+            return
+        if self.bench.reconnect and not self.in_flight:
+            self.bench.reopen(self)
+
+
+class Bench(object):
+    def __init__(
+        self,
+        remote,
+        workload,
+        connections=10,
+        duration=10,
+        rate=0,
+        warmup=0,
+        num_backends=64,
+    ):
+        self.remote = remote
+        self.workload = workload
+        self.connections = connections
+        self.duration = duration
+        self.rate = rate
+        self.warmup = warmup
+        self.closed_loop = not rate
+        self.reconnect = isinstance(workload, HttpWorkload) and not workload.keepalive
+        self.stopping = False
+
+        self.ioloop = ioloop.IOLoop(num_backends=num_backends)
+        self.ioloop.setloglevel(logging.WARNING)
+
+        self.lock = threading.Lock()
+        self.clients = []
+        self.retired = []
+        self.connect_errors = 0
+        self.start_time = None
+        self.ready = threading.Event()
+
+    def on_client_ready(self, client):
+        self.ready.set()
+        if self.start_time is not None and not self.stopping:
+            client.kick()
+
+    def on_client_closed(self, client):
+        if client.connector.state == async_client.Connector._DISCONNECTED:
+            with self.lock:
+                self.connect_errors += 1
+
+    def reopen(self, client):
+        # non keep-alive HTTP: a new connection per request, the
+        # pending schedule moves over to the new one.
+        with client.lock:
+            client.finished = True
+            queue = client.queue
+            client.queue = []
+        client.close()
+        fresh = BenchClient(self, self.remote, queue)
+        with self.lock:
+            self.retired.append(client)
+            self.clients[self.clients.index(client)] = fresh
+
+    def schedule(self, index, start, interval, n):
+        # open loop: request n of connection index is due at
+        # start + n * interval, whatever happened to request n - 1.
+        if self.stopping:
+            return
+        intended = start + n * interval
+        with self.lock:
+            client = self.clients[index]
+        client.enqueue(intended)
+        delay = start + (n + 1) * interval - time.perf_counter()
+        self.ioloop.call_later(
+            max(0, delay), self.schedule, index, start, interval, n + 1
+        )
+
+    def run(self):
+        threading.Thread(target=self.ioloop.start, daemon=True).start()
+        for _ in range(self.connections):
+            self.clients.append(BenchClient(self, self.remote))
+        self.ready.wait(10)
+
+        start = time.perf_counter()
+        self.start_time = start
+        if self.closed_loop:
+            for client in list(self.clients):
+                if client.connector.connected:
+                    client.kick()
+        else:
+            interval = self.connections / float(self.rate)
+            for index in range(self.connections):
+                # spread the first requests over one interval.
+                offset = start + interval * index / self.connections
+                self.ioloop.call_later(
+                    max(0, offset - time.perf_counter()),
+                    self.schedule,
+                    index,
+                    offset,
+                    interval,
+                    0,
+                )
+
+        if self.warmup:
+            time.sleep(self.warmup)
+            with self.lock:
+                for client in self.clients + self.retired:
+                    with client.lock:
+                        client.latencies = []
+            start = time.perf_counter()
+        time.sleep(self.duration)
+        elapsed = time.perf_counter() - start
+        self.stopping = True
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latencies = []
+        errors = self.connect_errors
+        backlog = 0
+        with self.lock:
+            clients = self.clients + self.retired
+        for client in clients:
+            with client.lock:
+                latencies.extend(client.latencies)
+                errors += client.errors
+                backlog += len(client.queue)
+        latencies.sort()
+        ms = 1000.0
+        return {
+            "whoops_version": whoops.__version__,
+            "workload": self.workload.name,
+            "remote": (
+                self.remote if isinstance(self.remote, str) else "%s:%s" % self.remote
+            ),
+            "connections": self.connections,
+            "duration": round(elapsed, 3),
+            "rate": self.rate or None,
+            "keepalive": not self.reconnect,
+            "corrected": not self.closed_loop,
+            "requests": len(latencies),
+            "errors": errors,
+            "unanswered": backlog,
+            "rps": round(len(latencies) / elapsed, 1),
+            "latency_ms": {
+                "mean": (
+                    round(ms * sum(latencies) / len(latencies), 3) if latencies else 0.0
+                ),
+                "p50": round(ms * percentile(latencies, 50), 3),
+                "p90": round(ms * percentile(latencies, 90), 3),
+                "p99": round(ms * percentile(latencies, 99), 3),
+                "p999": round(ms * percentile(latencies, 99.9), 3),
+                "max": round(ms * latencies[-1], 3) if latencies else 0.0,
+            },
+        }
+
+
+def make_workload(args):
+    if args.workload == "echo":
+        return EchoWorkload(args.size)
+    if args.workload == "http":
+        host = args.host if args.port is not None else "localhost"
+        return HttpWorkload(host, args.path, not args.no_keepalive)
+    return JSONRPCWorkload(args.method, json.loads(args.params))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m whoops.bench", description="whoops load generator"
+    )
+    parser.add_argument("host", help="host, or a Unix socket path without port")
+    parser.add_argument("port", type=int, nargs="?")
+    parser.add_argument(
+        "-w", "--workload", choices=("echo", "http", "jsonrpc"), default="echo"
+    )
+    parser.add_argument("-c", "--connections", type=int, default=10)
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument(
+        "-r", "--rate", type=float, default=0, help="requests/s, 0 is max throughput"
+    )
+    parser.add_argument("--warmup", type=float, default=0)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--size", type=int, default=64, help="echo message size")
+    parser.add_argument("--path", default="/", help="HTTP path")
+    parser.add_argument("--no-keepalive", action="store_true")
+    parser.add_argument("--method", default="echo", help="JSON-RPC method")
+    parser.add_argument("--params", default="[]", help="JSON-RPC params as JSON")
+    parser.add_argument("-o", "--output", help="write the JSON report to a file")
+    args = parser.parse_args(argv)
+
+    bench = Bench(
+        args.host if args.port is None else (args.host, args.port),
+        make_workload(args),
+        connections=args.connections,
+        duration=args.duration,
+        rate=args.rate,
+        warmup=args.warmup,
+        num_backends=args.threads,
+    )
+    result = json.dumps(bench.run(), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        sys.stdout.write(result + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+""" Topic fan-out to many connections.
+
+`publish` encodes a message once into an immutable bytes object and
+writes it to every subscriber of the topic. Transports only queue
+memoryviews of it, so a backlog of 20k slow subscribers holds one copy
+of the payload and not 20k.
+
+A subscriber with more than `max_backlog` bytes queued is too slow for
+the stream: by default it misses the message (`skip`), with
+`disconnect` it is dropped. Closed subscribers are forgotten on the
+next publish to their topics.
+
+"""
+
+import threading
+
+
+class Broadcaster(object):
+
+    SKIP = "skip"
+    DISCONNECT = "disconnect"
+
+    def __init__(self, ioloop, max_backlog=1 << 20, policy=SKIP):
+        if policy not in (self.SKIP, self.DISCONNECT):
+            raise ValueError("policy must be 'skip' or 'disconnect'")
+        self.ioloop = ioloop
+        self.max_backlog = max_backlog
+        self.policy = policy
+
+        # topic -> {transport: None}, insertion ordered
+        self.topics = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.published = 0
+        self.delivered = 0
+        self.skipped = 0
+        self.disconnected = 0
+
+    def subscribe(self, topic, transport):
+        with self._lock:
+            self.topics.setdefault(topic, {})[transport] = None
+
+    def unsubscribe(self, topic, transport):
+        with self._lock:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.pop(transport, None)
+                if not subscribers:
+                    del self.topics[topic]
+
+    def subscribers(self, topic):
+        with self._lock:
+            return len(self.topics.get(topic, ()))
+
+    def publish(self, topic, message):
+        """ Writes `message` to the subscribers of `topic`, returns the
+        number of subscribers it was written to.
+
+        """
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        elif not isinstance(message, bytes):
+            # one immutable copy, the caller may reuse its buffer.
+            message = bytes(message)
+        with self._lock:
+            subscribers = self.topics.get(topic)
+            if not subscribers:
+                return 0
+            subscribers = list(subscribers)
+
+        max_backlog = self.max_backlog
+        delivered = skipped = 0
+        gone = []
+        slow = []
+        for transport in subscribers:
+            if transport.closed:
+                gone.append(transport)
+            elif transport.pending > max_backlog:
+                slow.append(transport)
+            else:
+                transport.write(message)
+                delivered += 1
+
+        if slow:
+            if self.policy == self.DISCONNECT:
+                gone.extend(slow)
+                self.ioloop.executor.submit(self._disconnect, slow)
+            else:
+                skipped = len(slow)
+        if gone:
+            with self._lock:
+                subscribers = self.topics.get(topic)
+                if subscribers is not None:
+                    for transport in gone:
+                        subscribers.pop(transport, None)
+                    if not subscribers:
+                        del self.topics[topic]
+
+        with self._lock:
+            self.published += 1
+            self.delivered += delivered
+            self.skipped += skipped
+        return delivered
+
+    def _disconnect(self, transports):
+        for transport in transports:
+            if transport.closed:
+                continue
+            with self._lock:
+                self.disconnected += 1
+            self.ioloop.unregister(transport.conn.fileno())
+            transport.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "topics": len(self.topics),
+                "subscriptions": sum(len(s) for s in self.topics.values()),
+                "published": self.published,
+                "delivered": self.delivered,
+                "skipped": self.skipped,
+                "disconnected": self.disconnected,
+            }
@@ -0,0 +1,239 @@
+""" UDP endpoints on the ioloop.
+
+A datagram socket is registered like any other transport. On EPOLLIN
+the endpoint drains the socket on the executor with `recvfrom_into`
+into buffers allocated once, and hands the datagrams to
+`datagrams_received` in batches of up to `batch`, one call per batch
+instead of one executor job per datagram.
+
+Replies go through `sendto` and `send_batch`. Datagrams the socket does
+not take are queued and flushed on EPOLLOUT. Once `max_pending` are
+queued, further datagrams are dropped and counted, the way a full
+socket buffer would drop them.
+
+"""
+
+import socket
+import threading
+
+from collections import deque
+
+from .ioloop import IOLoop, Handler, Transport
+
+
+class DatagramTransport(Transport):
+
+    """ Transport over an unconnected UDP socket.
+
+    The write queue holds `(data, address)` pairs. `address` None sends
+    on a connected socket.
+
+    """
+
+    __slots__ = ("max_pending", "dropped")
+
+    def __init__(self, conn, address, handler=None, max_pending=4096):
+        super(DatagramTransport, self).__init__(conn, address, handler)
+        self.max_pending = max_pending
+        self.dropped = 0
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def pending(self):
+        # datagrams queued and not sent yet.
+        wbuf = self._wbuf
+        return len(wbuf) if wbuf else 0
+
+    def write(self, data):
+        self.send_batch(((data, None),))
+
+    def sendto(self, data, address):
+        self.send_batch(((data, address),))
+
+    def send_batch(self, datagrams):
+        with self._lock():
+            wbuf = self._wbuf
+            if not wbuf:
+                datagrams = self._send(iter(datagrams))
+                if datagrams is None:
+                    return
+                wbuf = self._wbuf = deque()
+                self._modify(self.events | IOLoop._WRITE)
+            for data, address in datagrams:
+                if len(wbuf) >= self.max_pending:
+                    self.dropped += 1
+                else:
+                    # views into the receive buffers are reused.
+                    if isinstance(data, memoryview):
+                        data = data.tobytes()
+                    wbuf.append((data, address))
+
+    def _send(self, datagrams):
+        # send until the socket is full, returns the unsent rest or None.
+        conn = self.conn
+        for data, address in datagrams:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            try:
+                if address is None:
+                    conn.send(data)
+                else:
+                    conn.sendto(data, address)
+            except self._retry:
+                return _chain((data, address), datagrams)
+            except socket.error:
+                # ICMP errors from earlier datagrams, EMSGSIZE...
+                self.dropped += 1
+        return None
+
+    def flush(self):
+        # called by the ioloop on EPOLLOUT.
+        with self._lock():
+            wbuf = self._wbuf
+            if wbuf:
+                rest = self._send(iter(wbuf))
+                if rest is not None:
+                    self._wbuf = deque(rest)
+                    return
+            self._wbuf = None
+            self._modify(self.events)
+
+
+def _chain(first, rest):
+    yield first
+    for item in rest:
+        yield item
+
+
+class DatagramEndpoint(object):
+
+    """ A UDP socket bound to `address` and registered with `ioloop`.
+
+    Subclasses implement `datagrams_received(datagrams)`, `datagrams` is
+    a list of `(data, address)` where `data` is a memoryview into the
+    receive buffers: it is only valid during the call, copy it with
+    `bytes(data)` to keep it.
+
+    """
+
+    def __init__(
+        self,
+        ioloop,
+        address=("0.0.0.0", 0),
+        batch=64,
+        bufsize=2048,
+        rcvbuf=None,
+        max_pending=4096,
+        family=socket.AF_INET,
+    ):
+        self.ioloop = ioloop
+
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf:
+            # bursts wait in the kernel while a batch is handled.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.socket.setblocking(False)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+
+        # receive buffers, allocated once and reused for every batch.
+        self.batch = batch
+        self.bufsize = bufsize
+        self._buffer = bytearray(batch * bufsize)
+        view = memoryview(self._buffer)
+        self._views = [view[i * bufsize : (i + 1) * bufsize] for i in range(batch)]
+
+        # a single reader at a time owns the buffers, a readable event
+        # arriving meanwhile makes it drain once more.
+        self._reading = threading.Lock()
+        self._again = False
+
+        # counters
+        self.received = 0
+        self.batches = 0
+
+        self.handler = Handler(ioloop)
+        self.handler.on_connection_cb = self.on_readable
+        self.handler.on_close_cb = self.on_close
+
+        self.transport = DatagramTransport(
+            self.socket, self.address, self.handler, max_pending
+        )
+        self.transport.events = IOLoop._READ
+        self.ioloop.register_datagram(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def on_readable(self, transport):
+        self._again = True
+        while self._again:
+            if not self._reading.acquire(False):
+                # the reader holding the lock sees _again.
+                return
+            try:
+                self._again = False
+                self._drain()
+            finally:
+                self._reading.release()
+
+    def _drain(self):
+        recvfrom_into = self.socket.recvfrom_into
+        views = self._views
+        bufsize = self.bufsize
+        batch = self.batch
+        while True:
+            datagrams = []
+            while len(datagrams) < batch:
+                view = views[len(datagrams)]
+                try:
+                    n, address = recvfrom_into(view, bufsize)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error:
+                    # ICMP errors reported on the socket, keep reading.
+                    continue
+                datagrams.append((view[:n], address))
+            if not datagrams:
+                return
+            self.received += len(datagrams)
+            self.batches += 1
+            try:
+                self.datagrams_received(datagrams)
+            except Exception as e:
+                self.ioloop.logger.error(
+                    "datagrams_received failed on %s: %r", self.address, e
+                )
+            if len(datagrams) < batch:
+                # stopped on EAGAIN, the socket is drained.
+                return
+
+    def sendto(self, data, address):
+        self.transport.sendto(data, address)
+
+    def send_batch(self, datagrams):
+        # datagrams: iterable of (data, address).
+        self.transport.send_batch(datagrams)
+
+    @property
+    def dropped(self):
+        return self.transport.dropped
+
+    def close(self):
+        self.ioloop.unregister(self.fileno())
+        self.transport.close()
+
+    def datagrams_received(self, datagrams):
+        raise NotImplementedError()
+
+    def on_close(self):
+        pass
+
+
+class DatagramServer(DatagramEndpoint):
+    def listen(self):
+        self.ioloop.start()
@@ -0,0 +1,102 @@
+""" Request deadlines.
+
+A request stops mattering when its time is up or its client is gone.
+Servers give every request a `Deadline`: `HttpServer` handlers find it
+in `server.deadline`, WSGI applications in `environ["whoops.deadline"]`,
+JSON-RPC methods in `server.deadline`. It starts when the ioloop saw
+the request arrive, time spent queued for an executor thread counts.
+
+The timeout is the server's `request_timeout` or the one the request
+asks for, the shorter one. The ioloop cancels the deadlines of a
+connection when the client hangs up (EPOLLRDHUP, EPOLLHUP), shutting
+down only its sending side after the request counts as gone. Expired
+requests are answered `503` before their handler runs; long handlers
+check `expired` now and then, or call `check`, to give up early.
+
+"""
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def parse_timeout(value):
+    """ Seconds from a header or request member, None if invalid. """
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return None
+    return timeout if timeout >= 0 else None
+
+
+class Deadline(object):
+
+    """ Expires at `expires`, a `time.monotonic` time or None for never,
+    or when it or its parent is cancelled.
+
+    """
+
+    __slots__ = ("expires", "_cancelled", "parent")
+
+    def __init__(self, expires=None, parent=None):
+        self.expires = expires
+        self._cancelled = False
+        self.parent = parent
+
+    @classmethod
+    def after(cls, timeout, start=None):
+        """ A deadline `timeout` seconds after `start`, now by default.
+        None never expires.
+
+        """
+        if timeout is None:
+            return cls()
+        if start is None:
+            start = time.monotonic()
+        return cls(start + timeout)
+
+    def child(self, timeout=None, start=None):
+        """ A deadline cancelled with this one, expiring with it or
+        `timeout` seconds after `start`, whichever comes first.
+
+        """
+        expires = self.expires
+        if timeout is not None:
+            if start is None:
+                start = time.monotonic()
+            if expires is None or start + timeout < expires:
+                expires = start + timeout
+        return Deadline(expires, self)
+
+    @property
+    def cancelled(self):
+        deadline = self
+        while deadline is not None:
+            if deadline._cancelled:
+                return True
+            deadline = deadline.parent
+        return False
+
+    @property
+    def expired(self):
+        if self.cancelled:
+            return True
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def remaining(self):
+        """ Seconds left, None without a time limit, 0 once expired. """
+        if self.cancelled:
+            return 0
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.monotonic())
+
+    def cancel(self):
+        self._cancelled = True
+
+    def check(self):
+        """ Raises DeadlineExceeded once expired. """
+        if self.expired:
+            raise DeadlineExceeded("cancelled" if self.cancelled else "expired")
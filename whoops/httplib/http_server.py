@@ -1,23 +1,72 @@
 import logging
+import threading
 import time
 
-from http.client import parse_headers
 from io import BytesIO
+from urllib.parse import parse_qs
 
-from whoops import ioloop, async_server, logger
+from whoops import ioloop, async_server, introspect, logger, unix
+from whoops.deadline import Deadline, parse_timeout
+from whoops.httplib.router import Router, RouteNotFound, MethodNotAllowed
 
 
 class HTTPLogger(logger.BaseLogger):
     def __init__(self, address):
         super(HTTPLogger, self).__init__()
-        self.logger = logging.getLogger("whoops http server")
-        self.logger.setLevel(logging.INFO)
-        self.extra.setdefault("address", address)
-        self.FORMAT = "%(address)s %(asctime)-15s %(message)s"
-        ch = logging.StreamHandler()
-        formatter = logging.Formatter(self.FORMAT)
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
+        parent = logging.getLogger("whoops http server")
+        parent.setLevel(logging.INFO)
+        # one logger per address, its handler has the address baked
+        # into the format, no extra dict per record.
+        self.logger = parent.getChild(str(address))
+        # a Unix socket path may contain "%".
+        prefix = str(address).replace("%", "%%")
+        self.FORMAT = "%s %%(asctime)-15s %%(message)s" % prefix
+        logger.add_stream_handler(self.logger, self.FORMAT)
+
+
+# http.client imports email and ssl, loaded with the first request.
+_parse_headers = None
+
+
+def parse_headers(fp):
+    global _parse_headers
+    if _parse_headers is None:
+        from http.client import parse_headers as _parse_headers
+    return _parse_headers(fp)
+
+
+class RequestState(object):
+
+    """ Server attribute holding per request state.
+
+    Requests of one server run concurrently on the ioloop executor,
+    one request per thread at a time, so request state lives in a
+    thread local of the server instead of the server itself.
+
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+
+    def __get__(self, server, owner):
+        if server is None:
+            return self
+        local = server._request_local
+        try:
+            return getattr(local, self.name)
+        except AttributeError:
+            value = self.default() if self.default else None
+            setattr(local, self.name, value)
+            return value
+
+    def __set__(self, server, value):
+        setattr(server._request_local, self.name, value)
+
+
+# returned by handlers that took the connection over or answer later,
+# nothing is sent.
+SWITCHED = object()
 
 
 responses = {
@@ -61,6 +110,7 @@ responses = {
     415: ("Unsupported Media Type", "Entity body in unsupported format."),
     416: ("Requested Range Not Satisfiable", "Cannot satisfy request range."),
     417: ("Expectation Failed", "Expect condition could not be satisfied."),
+    426: ("Upgrade Required", "The client should switch to another protocol."),
     428: (
         "Precondition Required",
         "The origin server requires the request to be conditional.",
@@ -91,43 +141,433 @@ responses = {
 }
 
 
+class _BodyReader(object):
+
+    """ Reads the rest of a request body across wakeups.
+
+    The connection gets a handler of its own until `length` bytes are
+    in, then goes back to the server handler and the request is
+    dispatched with the whole body in `rfile`. The ioloop runs one
+    callback of a transport at a time, bytes arriving before the switch
+    are read by this handler's callback.
+
+    """
+
+    def __init__(self, server, body, length):
+        self.server = server
+        self.conn = server.connection
+        self.raw_requestline = server.raw_requestline
+        self.header = server.header
+        self.deadline = server.deadline
+        self.chunks = [body]
+        self.left = length - len(body)
+        self.length = length
+
+        self.handler = ioloop.Handler(server.ioloop)
+        self.handler.on_connection_cb = self.on_readable
+        self.handler.on_write_cb = server.handler.on_write_cb
+        self.handler.on_close_cb = server.handler.on_close_cb
+        self.conn.handler = self.handler
+        # edge triggered, more may have arrived meanwhile.
+        self.on_readable(self.conn)
+
+    def on_readable(self, conn):
+        server = self.server
+        if self.left <= 0:
+            return
+        data = conn.read()
+        if not data:
+            if conn.at_eof():
+                server.connection = conn
+                server.close()
+            return
+        self.chunks.append(data)
+        self.left -= len(data)
+        if self.left > 0:
+            return
+        server.enter(conn, self.deadline)
+        conn.handler = server.handler
+        server.connection = conn
+        server.raw_requestline = self.raw_requestline
+        server.header = self.header
+        server.deadline = self.deadline
+        server.request_body = b""
+        server.rfile = BytesIO(b"".join(self.chunks)[: self.length])
+        try:
+            server.do_response()
+        finally:
+            server.leave(conn)
+
+
 class HttpServer(async_server.AsyncServer):
-    def __init__(self, ioloop, address):
 
-        super(HttpServer, self).__init__(ioloop, address)
-        self.host, self.port = address
+    # per request state, see RequestState.
+    rfile = RequestState("rfile")
+    wfile = RequestState("wfile")
+    connection = RequestState("connection")
+    raw_requestline = RequestState("raw_requestline")
+    request_body = RequestState("request_body")
+    header = RequestState("header")
+    headers = RequestState("headers")
+    method = RequestState("method")
+    path = RequestState("path")
+    query_string = RequestState("query_string")
+    deadline = RequestState("deadline")
+    _headers_buffer = RequestState("_headers_buffer", list)
+
+    def __init__(self, ioloop, address, ssl_context=None, unix_mode=None):
+        self._request_local = threading.local()
+
+        super(HttpServer, self).__init__(
+            ioloop, address, ssl_context=ssl_context, unix_mode=unix_mode
+        )
+        if unix.is_unix_address(address):
+            self.host, self.port = address, ""
+        else:
+            self.host, self.port = address
         self.rbufsize = -1
         self.wbufsize = 0
-        self.rfile = None
-        self.wfile = None
-        self.connection = None
-        self.raw_requestline = None
-        self.request_body = None
-        self.headers = None
-        self._headers_buffer = []
 
         self.ioloop.logger = HTTPLogger(self.host)
+        self.access_logger = logger.AccessLogger(self.host)
+
+        # routes, the default page while there are none.
+        self.router = Router()
+
+        # worker processes of cpu_bound routes, on first use.
+        self._offloader = None
+
+        # larger request bodies are refused with 413.
+        self.max_request_body = 64 << 20
+
+        # transport -> requests in flight, a shutdown waits for them.
+        self._busy = {}
+        self._busy_lock = threading.Lock()
+
+        # seconds a request may take from its arrival, None: no limit.
+        # The deadline_header of a request may shorten it, see deadline.
+        self.request_timeout = None
+        self.deadline_header = "X-Request-Timeout"
+        # transport -> deadline of its requests in flight, for on_hangup.
+        self._deadlines = {}
+
+    def route(self, pattern, methods=("GET",), cpu_bound=False):
+        """ Registers `handler(server, **params)` for `pattern`.
+
+        The handler returns the body, `(code, body)` or
+        `(code, headers, body)`; str bodies are sent as UTF-8 HTML.
+
+        A `cpu_bound` handler runs in a worker process (see
+        whoops.offload) as `handler(body, **params)`, without the server;
+        it must be a module level function. Bodies of 512 KB and more
+        are passed through shared memory as a memoryview.
+
+        """
+        if not cpu_bound:
+            return self.router.route(pattern, methods)
+
+        def decorator(handler):
+            def offloaded(server, **params):
+                return server.offload(handler, params)
+
+            self.router.route(pattern, methods)(offloaded)
+            return handler
+
+        return decorator
+
+    @property
+    def offloader(self):
+        if self._offloader is None:
+            from whoops.offload import Offloader
+
+            self._offloader = Offloader(self.ioloop)
+        return self._offloader
+
+    def offload(self, handler, params):
+        # the request state is thread local, keep what the answer needs.
+        connection, method, deadline = self.connection, self.method, self.deadline
+        body = self.request_body + self.rfile.read()
+
+        def done(result, error):
+            self.connection, self.method = connection, method
+            if error is not None:
+                self.ioloop.logger.error("%s failed: %r", handler.__name__, error)
+                result = 500, None
+            try:
+                # nobody left to answer.
+                if not deadline.cancelled:
+                    self.send_result(result)
+            finally:
+                self.leave(connection)
+
+        self.enter(connection, deadline)
+        try:
+            self.offloader.submit(done, handler, body, **params)
+        except BaseException:
+            self.leave(connection)
+            raise
+        return SWITCHED
+
+    def debug_profile(self, pattern="/debug/profile", max_seconds=30):
+        """ Serves collapsed stacks sampled for `seconds` (1 by default)
+        on `pattern`, `idle=0` leaves out the waiting threads.
+
+        The sampling holds one executor thread for its duration.
+
+        """
+
+        from whoops import profiler
+
+        def profile(server):
+            query = parse_qs(server.query_string)
+            try:
+                seconds = float(query.get("seconds", ["1"])[0])
+                interval = float(query.get("interval", ["0.005"])[0])
+            except ValueError:
+                return 400, None
+            if not 0 < seconds <= max_seconds or not 0 < interval <= seconds:
+                return 400, None
+            idle = query.get("idle", ["1"])[0] != "0"
+            stacks = profiler.sample(seconds, interval, idle)
+            return 200, [("Content-type", "text/plain; charset=utf-8")], stacks
+
+        self.route(pattern)(profile)
+
+    def debug_connections(self, pattern="/debug/connections", ioloop=None, max_n=1000):
+        """ Serves `introspect.snapshot` of `ioloop`, the server's by
+        default, as JSON on `pattern`: `?key=pending&n=50`.
+
+        An admin server on a loop of its own still answers when the one
+        it looks at is overloaded.
+
+        """
+
+        import json
+
+        def connections(server):
+            query = parse_qs(server.query_string)
+            key = query.get("key", ["bytes_out"])[0]
+            try:
+                n = int(query.get("n", ["20"])[0])
+            except ValueError:
+                return 400, None
+            if key not in introspect.KEYS or not 0 < n <= max_n:
+                return 400, None
+            snapshot = introspect.snapshot(ioloop or server.ioloop, n, key)
+            return 200, [("Content-type", "application/json")], json.dumps(snapshot)
+
+        self.route(pattern)(connections)
+
+    def websocket(self, pattern, subprotocols=(), deflate=True, **options):
+        """ Decorator registering a `websocket.WebSocket` subclass for
+        `pattern`, it gets the upgraded connections. `options` go to
+        the WebSocket constructor (max_size, compress_min, ...).
+
+        """
+
+        from whoops.httplib import websocket as _websocket
+
+        def decorator(cls):
+            def upgrade(server, **params):
+                error = _websocket.upgrade(
+                    server, cls, params, subprotocols, deflate, **options
+                )
+                return SWITCHED if error is None else error
+
+            self.route(pattern)(upgrade)
+            return cls
+
+        return decorator
 
     def on_connection(self, conn):
         self.connection = conn
-        self.parse_request()
-        self.do_response()
+        # when the ioloop saw the request, the read below moves it.
+        arrived = conn.last_active
+        self.enter(conn)
+        try:
+            if not self.parse_request():
+                if conn.at_eof():
+                    self.close()
+                return
+            self.start_deadline(arrived)
+            if self.read_body():
+                self.do_response()
+        finally:
+            self.leave(conn)
+
+    def enter(self, conn, deadline=None):
+        # a request in flight on conn, until leave.
+        with self._busy_lock:
+            self._busy[conn] = self._busy.get(conn, 0) + 1
+            if deadline is not None:
+                self._deadlines[conn] = deadline
+
+    def leave(self, conn):
+        with self._busy_lock:
+            count = self._busy.pop(conn) - 1
+            if count:
+                self._busy[conn] = count
+            else:
+                self._deadlines.pop(conn, None)
+
+    def start_deadline(self, arrived):
+        # the server timeout, or the shorter one the request asks for.
+        timeout = self.request_timeout
+        if self.deadline_header:
+            requested = parse_timeout(self.header.get(self.deadline_header))
+            if requested is not None and (timeout is None or requested < timeout):
+                timeout = requested
+        deadline = self.deadline = Deadline.after(timeout, arrived)
+        with self._busy_lock:
+            self._deadlines[self.connection] = deadline
+
+    def on_hangup(self, conn):
+        deadline = self._deadlines.get(conn)
+        if deadline is not None:
+            deadline.cancel()
+
+    def deadline_exceeded(self):
+        # the handler never runs; a client still waiting gets a 503.
+        if not self.deadline.cancelled:
+            self.method = None
+            self.send_page(503, headers=[("Connection", "close")])
+        self.close()
+
+    def idle(self, transport):
+        return transport not in self._busy and super(HttpServer, self).idle(transport)
+
+    def read_body(self):
+        # False when the body is still coming, the connection is then
+        # handed to a _BodyReader that calls do_response at the end.
+        length = self.header.get("Content-Length")
+        if not length:
+            return True
+        try:
+            length = int(length)
+        except ValueError:
+            return True
+        if length > self.max_request_body:
+            self.method = None
+            self.send_page(413, headers=[("Connection", "close")])
+            self.close()
+            return False
+        position = self.rfile.tell()
+        have = len(self.request_body) + self.rfile.seek(0, 2) - position
+        self.rfile.seek(position)
+        if have >= length:
+            return True
+        _BodyReader(self, self.request_body + self.rfile.read(), length)
+        return False
 
     def parse_request(self):
+        # False when there is no request, at EOF or on a spurious wakeup.
         data = self.connection.read()
+        if not data:
+            return False
+        limiter = self.ioloop.limiter
+        if limiter is not None:
+            wait = limiter.request(self.connection.conn.fileno())
+            if wait:
+                self.too_many_requests(wait)
+                return False
+        self.connection.requests += 1
         self.rfile = BytesIO(data)
         self.raw_requestline = self.rfile.readline(65537)
         self.header = parse_headers(self.rfile)
         self.request_body = self.rfile.readline(65537)
+        return True
+
+    def too_many_requests(self, wait):
+        # nothing of the request is parsed, its body may still be
+        # coming: the connection is closed.
+        self.method = None
+        self.send_page(
+            429,
+            headers=[
+                ("Retry-After", max(1, int(wait + 0.999))),
+                ("Connection", "close"),
+            ],
+        )
+        self.close()
 
     def do_response(self):
-        body = "<html><body><h2>Hello Whoops</h2></body></html>"
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        if self.deadline.expired:
+            self.deadline_exceeded()
+            return
+        if not self.router:
+            body = "<html><body><h2>Hello Whoops</h2></body></html>"
+            self.send_response(200)
+            self.send_header("Content-type", "text/html")
+            self.send_header("Content-Length", len(body))
+            self.send_header("Date", self.date_string())
+            self.end_headers()
+            self.send_body(body)
+            return
+
+        self.method = None
+        try:
+            method, target, _ = self.raw_requestline.decode("latin-1").split(" ", 2)
+        except ValueError:
+            self.send_page(400)
+            return
+        self.method = method
+        self.path, _, self.query_string = target.partition("?")
+        try:
+            handler, params = self.router.resolve(method, self.path)
+        except RouteNotFound:
+            self.send_page(404)
+            return
+        except MethodNotAllowed as e:
+            self.send_page(405, headers=[("Allow", ", ".join(e.allowed))])
+            return
+        try:
+            result = handler(self, **params)
+        except Exception as e:
+            # the executor would drop it silently and leave the client
+            # waiting, headers the handler queued are dropped.
+            self.ioloop.logger.error("%s failed: %r", handler.__name__, e)
+            self._headers_buffer = []
+            self.send_page(500, headers=[("Connection", "close")])
+            self.close()
+            return
+        if result is not SWITCHED:
+            self.send_result(result)
+
+    def send_result(self, result):
+        if isinstance(result, tuple):
+            if len(result) == 2:
+                self.send_page(result[0], result[1])
+            else:
+                self.send_page(result[0], result[2], result[1])
+        else:
+            self.send_page(200, result)
+
+    def send_page(self, code, body=None, headers=None):
+        if body is None:
+            body = "<html><body><h2>%d %s</h2></body></html>" % (
+                code,
+                responses[code][0],
+            )
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        content_type = True
+        draining = self.draining
+        for key, value in headers or ():
+            lower = key.lower()
+            if lower == "content-type":
+                content_type = False
+            elif draining and lower == "connection":
+                # send_response sent Connection: close already.
+                continue
+            self.send_header(key, value)
+        if content_type:
+            self.send_header("Content-type", "text/html; charset=utf-8")
         self.send_header("Content-Length", len(body))
         self.send_header("Date", self.date_string())
         self.end_headers()
-        self.send_body(body)
+        if self.method != "HEAD":
+            self.send(body)
 
     def send_response(self, code, message=None):
         # self.ioloop.logger.info("%s %d %s\r\n" % ('HTTP/1.1', code, message))
@@ -137,6 +577,9 @@ class HttpServer(async_server.AsyncServer):
             ("%s %d %s\r\n" % ("HTTP/1.1", code, message)).encode("latin-1", "strict")
         )
         self.send_header("Server", "whoops/0.1")
+        if self.draining:
+            # the client reconnects elsewhere, the connection goes idle.
+            self.send_header("Connection", "close")
 
     def send_header(self, key, value):
         self._headers_buffer.append(
@@ -166,6 +609,7 @@ class HttpServer(async_server.AsyncServer):
         self.connection.write(msg)
 
     def close(self):
+        self.ioloop.unregister(self.connection.conn.fileno())
         self.connection.close()
 
 
@@ -0,0 +1,849 @@
+""" HTTP reverse proxy.
+
+`ProxyServer` forwards every request it gets to one of its upstreams
+over keep-alive `AsyncClient` connections taken from a
+`ConnectionPool`, one request at a time per client connection.
+
+Bodies are streamed in both directions as they arrive, in pieces of
+at most `chunk_size` bytes, with their framing (Content-Length or
+chunked) passed through untouched. Flow control is by watermarks: once
+more than `high_water` bytes wait in the write queue of one side, the
+proxy stops reading the other side, and reads again when the queue got
+flushed below `low_water`. The kernel buffers and TCP windows push the
+backpressure further back to the slow peer's sender.
+
+Upstreams are picked round robin or by least connections. Health
+checks are passive: a connect error, a timeout or a connection lost
+before the response head counts as a failure, `max_fails` failures in a
+row take the upstream out for `fail_timeout` seconds. A request
+without a body is retried once on another upstream when it failed
+before anything was sent back.
+
+"""
+
+import logging
+import socket
+import threading
+import time
+
+from functools import partial
+
+from whoops import async_client
+from whoops.ioloop import IOLoop, Handler
+from whoops.httplib.http_server import HttpServer, responses
+
+
+# headers of one connection, not forwarded. Transfer-Encoding is,
+# bodies are passed through with their framing.
+HOP_BY_HOP = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "upgrade",
+    )
+)
+
+MAX_HEAD = 65536
+
+
+class Upstream(object):
+
+    """ A backend address, its in-flight requests and health. """
+
+    def __init__(self, address, max_fails=3, fail_timeout=10):
+        self.address = address
+        self.max_fails = max_fails
+        self.fail_timeout = fail_timeout
+
+        self.active = 0
+        self.fails = 0
+        self.down_until = 0
+
+        # counters
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def available(self):
+        return self.down_until <= time.monotonic()
+
+    def failed(self):
+        self.failures += 1
+        self.fails += 1
+        if self.fails >= self.max_fails:
+            self.down_until = time.monotonic() + self.fail_timeout
+            self.fails = 0
+
+    def succeeded(self):
+        self.fails = 0
+
+
+class RoundRobin(object):
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self.next = 0
+
+    def pick(self, exclude=None):
+        n = len(self.upstreams)
+        for i in range(n):
+            upstream = self.upstreams[(self.next + i) % n]
+            if upstream is not exclude and upstream.available:
+                self.next = (self.next + i + 1) % n
+                return upstream
+        return None
+
+
+class LeastConnections(object):
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self.next = 0
+
+    def pick(self, exclude=None):
+        best = None
+        n = len(self.upstreams)
+        # rotate the start, ties do not always go to the first one.
+        self.next = (self.next + 1) % n
+        for i in range(n):
+            upstream = self.upstreams[(self.next + i) % n]
+            if upstream is exclude or not upstream.available:
+                continue
+            if best is None or upstream.active < best.active:
+                best = upstream
+        return best
+
+
+BALANCERS = {"round_robin": RoundRobin, "least_connections": LeastConnections}
+
+
+class _Framer(object):
+
+    """ Finds the end of a message body without decoding it. """
+
+    NONE = 0
+    LENGTH = 1
+    CHUNKED = 2
+    CLOSE = 3
+
+    # chunked states
+    _SIZE = 0
+    _DATA = 1
+    _DATA_END = 2
+    _TRAILER = 3
+
+    def __init__(self, mode, length=0):
+        self.mode = mode
+        self.remaining = length
+        self.state = self._SIZE
+        self.line = b""
+        self.done = mode == self.NONE or (mode == self.LENGTH and not length)
+
+    def feed(self, data):
+        # the number of bytes of data that belong to the body.
+        if self.done:
+            return 0
+        if self.mode == self.CLOSE:
+            return len(data)
+        if self.mode == self.LENGTH:
+            n = min(len(data), self.remaining)
+            self.remaining -= n
+            self.done = not self.remaining
+            return n
+        i, n = 0, len(data)
+        while i < n and not self.done:
+            if self.state == self._DATA:
+                take = min(n - i, self.remaining)
+                i += take
+                self.remaining -= take
+                if not self.remaining:
+                    self.state = self._DATA_END
+                continue
+            j = data.find(b"\n", i)
+            if j < 0:
+                self.line += data[i:]
+                if len(self.line) > 4096:
+                    raise ValueError("chunk line too long")
+                return n
+            line = (self.line + data[i:j]).strip()
+            self.line = b""
+            i = j + 1
+            if self.state == self._SIZE:
+                size = line.split(b";", 1)[0].rstrip(b" \t")
+                # int() would take signs, blanks, "_" and "0x".
+                if not size or size.strip(b"0123456789abcdefABCDEF"):
+                    raise ValueError("invalid chunk size")
+                size = int(size, 16)
+                if size:
+                    self.remaining = size
+                    self.state = self._DATA
+                else:
+                    self.state = self._TRAILER
+            elif self.state == self._DATA_END:
+                self.state = self._SIZE
+            elif not line:
+                # empty line after the trailers.
+                self.done = True
+        return i
+
+
+def _parse_head(buf):
+    # (first line, [(name, value)], rest) or None while incomplete,
+    # ValueError for a header line the peers could read another way.
+    end = buf.find(b"\r\n\r\n")
+    if end < 0:
+        return None
+    lines = buf[:end].decode("latin-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        # no blank in or around a name, folded lines included.
+        if not colon or not name or " " in name or "\t" in name:
+            raise ValueError("invalid header line")
+        headers.append((name, value.strip()))
+    return lines[0], headers, buf[end + 4 :]
+
+
+def _framing(headers, allow_close):
+    # ValueError when the proxy and a peer could see different bodies:
+    # a length not all digits, several lengths, a length and a coding,
+    # a request coded other than chunked last.
+    length = None
+    codings = []
+    for name, value in headers:
+        lname = name.lower()
+        if lname == "transfer-encoding":
+            codings.extend(t.strip().lower() for t in value.split(","))
+        elif lname == "content-length":
+            # int() would take signs, blanks and "_".
+            if length is not None or not value or value.strip("0123456789"):
+                raise ValueError("invalid Content-Length")
+            length = int(value)
+    if codings:
+        if length is not None:
+            raise ValueError("Content-Length with Transfer-Encoding")
+        if codings[-1] == "chunked":
+            return _Framer(_Framer.CHUNKED)
+        if not allow_close:
+            raise ValueError("request body without chunked coding")
+        return _Framer(_Framer.CLOSE)
+    if length is not None:
+        return _Framer(_Framer.LENGTH, length)
+    return _Framer(_Framer.CLOSE if allow_close else _Framer.NONE)
+
+
+def _tokens(headers, header):
+    tokens = set()
+    for name, value in headers:
+        if name.lower() == header:
+            tokens.update(t.strip().lower() for t in value.split(","))
+    return tokens
+
+
+def _recv(transport, size):
+    # bytes, b"" at EOF, None when there is nothing to read.
+    with transport._lock():
+        try:
+            data = transport.conn.recv(size)
+        except transport._retry:
+            return None
+        except socket.error:
+            return b""
+    if data:
+        transport.bytes_in += len(data)
+        transport.last_active = time.monotonic()
+    return data
+
+
+class UpstreamClient(async_client.AsyncClient):
+
+    """ Pooled upstream connection, events go to the session using it. """
+
+    def __init__(self, ioloop, remote, timeout=5):
+        self.session = None
+        super(UpstreamClient, self).__init__(ioloop, remote, timeout=timeout)
+
+    def connection_made(self):
+        session = self.session
+        if session is not None:
+            session.on_upstream_connected(self)
+
+    def on_write(self, conn):
+        session = self.session
+        if session is not None:
+            session.on_upstream_writable(self)
+
+    def on_connection(self, conn):
+        session = self.session
+        if session is not None:
+            session.read_upstream(self)
+
+    def on_close(self):
+        session = self.session
+        if session is not None:
+            session.on_upstream_close(self)
+
+
+class _Session(object):
+
+    """ One client connection of the proxy.
+
+    The connection gets a handler of its own so its events, close
+    included, reach the session. Callbacks of both sides run on the
+    executor, the session lock serializes them.
+
+    """
+
+    # states
+    HEAD = 0
+    BODY = 1
+    WAIT = 2
+    CLOSED = 3
+
+    def __init__(self, server, transport):
+        self.server = server
+        self.downstream = transport
+        self.lock = threading.RLock()
+
+        self.handler = Handler(server.ioloop)
+        self.handler.on_connection_cb = self.read_downstream
+        self.handler.on_write_cb = self.on_downstream_writable
+        self.handler.on_close_cb = self.on_downstream_close
+        transport.handler = self.handler
+
+        self.state = self.HEAD
+        self.inbuf = b""
+        self.keepalive = True
+        self.closing = False
+        self.paused_down = False
+        self.paused_up = False
+
+        # current request
+        self.method = None
+        self.target = None
+        self.head = None
+        self.request_framer = None
+        self.sent_body = False
+        self.attempts = 0
+
+        # current upstream
+        self.upstream = None
+        self.client = None
+        self.pending_up = []
+        self.timer = None
+
+        # current response
+        self.response_buf = b""
+        self.response_framer = None
+        self.response_started = False
+        self.reusable = True
+
+    # downstream side
+
+    def read_downstream(self, conn=None):
+        server = self.server
+        with self.lock:
+            while self.state != self.CLOSED:
+                if self.state == self.WAIT:
+                    # one request at a time, pipelined ones wait.
+                    return
+                if self.state == self.BODY and self._upstream_full():
+                    self.paused_down = True
+                    return
+                if (
+                    not self.inbuf
+                    or self.state == self.HEAD
+                    and b"\r\n\r\n" not in self.inbuf
+                ):
+                    data = _recv(self.downstream, server.chunk_size)
+                    if data is None:
+                        return
+                    if not data:
+                        self.close()
+                        return
+                    self.inbuf += data
+                if self.state == self.HEAD:
+                    try:
+                        parsed = _parse_head(self.inbuf)
+                    except ValueError:
+                        self.respond_error(400, close=True)
+                        return
+                    if parsed is None:
+                        if len(self.inbuf) > MAX_HEAD:
+                            self.respond_error(431, close=True)
+                        continue
+                    if not self.start_request(*parsed):
+                        return
+                if self.state == self.BODY:
+                    try:
+                        n = self.request_framer.feed(self.inbuf)
+                    except ValueError:
+                        self.respond_error(400, close=True)
+                        return
+                    if n:
+                        self.sent_body = True
+                        self.send_up(self.inbuf[:n])
+                        self.inbuf = self.inbuf[n:]
+                    if self.request_framer.done:
+                        self.state = self.WAIT
+
+    def start_request(self, line, headers, rest):
+        self.inbuf = rest
+        try:
+            method, target, version = line.split(" ", 2)
+            self.request_framer = _framing(headers, allow_close=False)
+        except ValueError:
+            self.respond_error(400, close=True)
+            return False
+        connection = _tokens(headers, "connection")
+        if version == "HTTP/1.1":
+            self.keepalive = "close" not in connection
+        else:
+            self.keepalive = "keep-alive" in connection
+        self.method = method
+        self.target = target
+        self.downstream.requests += 1
+        limiter = self.server.ioloop.limiter
+        if limiter is not None:
+            wait = limiter.request(self.downstream.conn.fileno())
+            if wait:
+                self.respond_error(
+                    429, headers="Retry-After: %d\r\n" % max(1, int(wait + 0.999))
+                )
+                return False
+
+        lines = ["%s %s HTTP/1.1" % (method, target)]
+        forwarded = None
+        for name, value in headers:
+            lname = name.lower()
+            if lname in HOP_BY_HOP or lname in connection:
+                continue
+            if lname == "x-forwarded-for":
+                forwarded = value
+                continue
+            lines.append("%s: %s" % (name, value))
+        address = self.downstream.address
+        if isinstance(address, tuple):
+            client = address[0]
+            lines.append(
+                "X-Forwarded-For: %s"
+                % (forwarded + ", " + client if forwarded else client)
+            )
+        elif forwarded:
+            lines.append("X-Forwarded-For: %s" % forwarded)
+        lines.append("Connection: keep-alive")
+        self.head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        self.sent_body = False
+        self.attempts = 0
+        self.response_buf = b""
+        self.response_framer = None
+        self.response_started = False
+        self.reusable = True
+        self.state = self.BODY
+        return self.connect_upstream()
+
+    def connect_upstream(self, exclude=None):
+        server = self.server
+        with server.balancer_lock:
+            upstream = server.balancer.pick(exclude)
+            if upstream is not None:
+                upstream.active += 1
+                upstream.requests += 1
+        if upstream is None:
+            self.respond_error(502)
+            return False
+        try:
+            client = server.pool.acquire(upstream.address)
+        except async_client.PoolExhausted:
+            with server.balancer_lock:
+                upstream.active -= 1
+            self.respond_error(503)
+            return False
+        self.attempts += 1
+        self.upstream = upstream
+        self.client = client
+        self.pending_up = [self.head]
+        client.session = self
+        if server.timeout:
+            self.timer = server.ioloop.call_later(
+                server.timeout, self.on_timeout, client
+            )
+        if client.connector.transport.closed:
+            # refused before the session was attached.
+            self.upstream_failed(502)
+        elif client.connector.connected:
+            self.on_upstream_connected(client)
+        return True
+
+    def send_up(self, data):
+        if self.pending_up is not None:
+            self.pending_up.append(data)
+        else:
+            self.client.connector.transport.write(data)
+
+    def _upstream_full(self):
+        client = self.client
+        if client is None:
+            return False
+        if self.pending_up is not None:
+            return sum(len(d) for d in self.pending_up) > self.server.high_water
+        return client.connector.transport.pending > self.server.high_water
+
+    def on_downstream_writable(self, conn):
+        with self.lock:
+            if self.downstream.pending > self.server.low_water:
+                return
+            self.downstream.set_events(IOLoop._READ)
+            if self.closing:
+                self.close()
+                return
+            if self.paused_up and self.client is not None:
+                self.paused_up = False
+                client = self.client
+            else:
+                return
+        self.read_upstream(client)
+
+    def on_downstream_close(self):
+        with self.lock:
+            self.state = self.CLOSED
+            if self.client is not None:
+                # in the middle of an exchange, not reusable.
+                self.finish_upstream(discard=True)
+
+    # upstream side
+
+    def on_upstream_connected(self, client):
+        with self.lock:
+            if client is not self.client or self.pending_up is None:
+                return
+            pending, self.pending_up = self.pending_up, None
+            transport = client.connector.transport
+            for data in pending:
+                transport.write(data)
+        self.read_upstream(client)
+
+    def on_upstream_writable(self, client):
+        with self.lock:
+            if client is not self.client or not self.paused_down:
+                return
+            if client.connector.transport.pending > self.server.low_water:
+                return
+            self.paused_down = False
+        self.read_downstream()
+
+    def read_upstream(self, client):
+        server = self.server
+        with self.lock:
+            while client is self.client and self.state != self.CLOSED:
+                if self.downstream.pending > server.high_water:
+                    # resumed by on_downstream_writable.
+                    self.paused_up = True
+                    self.downstream.set_events(IOLoop._READ | IOLoop._WRITE)
+                    return
+                data = _recv(client.connector.transport, server.chunk_size)
+                if data is None:
+                    return
+                if not data:
+                    self.upstream_eof()
+                    return
+                if self.response_framer is None:
+                    self.response_buf += data
+                    while self.response_framer is None:
+                        try:
+                            parsed = _parse_head(self.response_buf)
+                        except ValueError:
+                            self.upstream_failed(502)
+                            return
+                        if parsed is None:
+                            break
+                        if not self.response_head(*parsed):
+                            return
+                    if self.response_framer is None:
+                        if len(self.response_buf) > MAX_HEAD:
+                            self.upstream_failed(502)
+                            return
+                        continue
+                    data, self.response_buf = self.response_buf, b""
+                self.forward_body(data)
+
+    def response_head(self, line, headers, rest):
+        # False when the upstream response was refused.
+        try:
+            version, status = line.split(" ", 2)[:2]
+            status = int(status)
+        except ValueError:
+            self.upstream_failed(502)
+            return False
+        self.response_buf = rest
+        connection = _tokens(headers, "connection")
+
+        lines = [line]
+        for name, value in headers:
+            lname = name.lower()
+            if lname in HOP_BY_HOP or lname in connection:
+                continue
+            lines.append("%s: %s" % (name, value))
+
+        if 100 <= status < 200:
+            # interim, forwarded and followed by the final response.
+            self.downstream.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            return True
+
+        if self.method == "HEAD" or status in (204, 304):
+            framer = _Framer(_Framer.NONE)
+        else:
+            try:
+                framer = _framing(headers, allow_close=True)
+            except ValueError:
+                self.upstream_failed(502)
+                return False
+        if (
+            framer.mode == _Framer.CLOSE
+            or "close" in connection
+            or (version != "HTTP/1.1" and "keep-alive" not in connection)
+        ):
+            self.reusable = False
+        if framer.mode == _Framer.CLOSE:
+            # the end of the body is the end of the connection.
+            self.keepalive = False
+        if not self.keepalive:
+            lines.append("Connection: close")
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        with self.server.balancer_lock:
+            self.upstream.succeeded()
+        self.response_started = True
+        self.response_framer = framer
+        self.downstream.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        self.server.log_request(self, status)
+        return True
+
+    def forward_body(self, data):
+        try:
+            n = self.response_framer.feed(data)
+        except ValueError:
+            self.close()
+            return
+        if n:
+            self.downstream.write(data if n == len(data) else data[:n])
+        if self.response_framer.done:
+            if n < len(data):
+                # bytes past the response, the connection is out of sync.
+                self.reusable = False
+            self.finish_response()
+
+    def upstream_eof(self):
+        if (
+            self.response_framer is not None
+            and self.response_framer.mode == _Framer.CLOSE
+        ):
+            self.reusable = False
+            self.finish_response()
+        elif not self.response_started:
+            self.upstream_failed(502)
+        else:
+            # truncated response.
+            self.finish_upstream(discard=True)
+            self.close()
+
+    def on_upstream_close(self, client):
+        with self.lock:
+            if client is not self.client:
+                return
+            if not self.response_started:
+                self.upstream_failed(502)
+            elif self.state != self.CLOSED:
+                self.finish_upstream(discard=True)
+                self.close()
+
+    def on_timeout(self, client):
+        # ioloop thread, the session work goes to the executor.
+        self.server.ioloop.executor.submit(self._timeout, client)
+
+    def _timeout(self, client):
+        with self.lock:
+            if client is self.client and not self.response_started:
+                self.upstream_failed(504)
+
+    def upstream_failed(self, code):
+        with self.server.balancer_lock:
+            self.upstream.failed()
+        failed = self.upstream
+        self.finish_upstream(discard=True)
+        if self.state == self.CLOSED:
+            return
+        if not self.sent_body and self.attempts < 2 and self.request_framer.done:
+            # nothing of the request body is lost, try another one.
+            self.connect_upstream(exclude=failed)
+            return
+        self.respond_error(code, close=True)
+
+    def finish_response(self):
+        self.finish_upstream(discard=not self.reusable)
+        if not self.keepalive or not self.request_framer.done:
+            # answered before the request body was all read.
+            self.close()
+            return
+        self.state = self.HEAD
+        # edge triggered, what arrived meanwhile has not been read.
+        self.server.ioloop.executor.submit(self.read_downstream)
+
+    def finish_upstream(self, discard):
+        client, self.client = self.client, None
+        upstream, self.upstream = self.upstream, None
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.pending_up = None
+        self.paused_up = False
+        if upstream is not None:
+            with self.server.balancer_lock:
+                upstream.active -= 1
+        if client is None:
+            return
+        client.session = None
+        if discard:
+            self.server.pool.discard(client)
+        else:
+            self.server.pool.release(client)
+
+    # replies of the proxy itself
+
+    def respond_error(self, code, close=False, headers=""):
+        body = "<html><body><h2>%d %s</h2></body></html>" % (code, responses[code][0])
+        head = (
+            "HTTP/1.1 %d %s\r\nServer: whoops/0.1\r\nContent-type: text/html\r\n"
+            "Content-Length: %d\r\n%s" % (code, responses[code][0], len(body), headers)
+        )
+        framer = self.request_framer
+        if framer is not None and not framer.done:
+            # the rest of the request body would be taken for a request.
+            close = True
+        if close or not self.keepalive:
+            head += "Connection: close\r\n"
+            self.keepalive = False
+        self.downstream.write((head + "\r\n" + body).encode("latin-1"))
+        self.server.log_request(self, code)
+        if self.client is not None:
+            self.finish_upstream(discard=True)
+        if not self.keepalive:
+            self.close()
+        else:
+            self.state = self.HEAD
+            self.server.ioloop.executor.submit(self.read_downstream)
+
+    def close(self):
+        # after the queued writes are out.
+        if self.state == self.CLOSED:
+            return
+        if self.downstream.pending:
+            self.closing = True
+            self.state = self.WAIT
+            self.downstream.set_events(IOLoop._READ | IOLoop._WRITE)
+            return
+        self.state = self.CLOSED
+        self.server.ioloop.unregister(self.downstream.conn.fileno())
+        self.downstream.close()
+
+
+class ProxyServer(HttpServer):
+
+    """ Reverse proxy to `upstreams`, addresses or Unix socket paths.
+
+    `balance` is "round_robin" or "least_connections". `timeout` is
+    the time an upstream has to start answering, `connect_timeout` the
+    time to connect to it.
+
+    """
+
+    def __init__(
+        self,
+        ioloop,
+        address,
+        upstreams,
+        balance="round_robin",
+        pool_size=64,
+        idle_timeout=60,
+        max_fails=3,
+        fail_timeout=10,
+        timeout=60,
+        connect_timeout=5,
+        chunk_size=65536,
+        high_water=262144,
+        low_water=65536,
+        ssl_context=None,
+        unix_mode=None,
+    ):
+        super(ProxyServer, self).__init__(
+            ioloop, address, ssl_context=ssl_context, unix_mode=unix_mode
+        )
+        self.upstreams = [Upstream(a, max_fails, fail_timeout) for a in upstreams]
+        self.balancer = BALANCERS[balance](self.upstreams)
+        self.balancer_lock = threading.Lock()
+        self.pool = async_client.ConnectionPool(
+            ioloop,
+            partial(UpstreamClient, timeout=connect_timeout),
+            max_size=pool_size,
+            idle_timeout=idle_timeout,
+        )
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.high_water = high_water
+        self.low_water = low_water
+
+    def on_connection(self, conn):
+        # the first event of a connection, the session takes over. The
+        # ioloop runs one read callback of a transport at a time, the
+        # events after the switch go to the session.
+        if conn.handler is self.handler:
+            _Session(self, conn)
+        conn.handler.on_connection_cb(conn)
+
+    def idle(self, transport):
+        session = getattr(transport.handler.on_connection_cb, "__self__", None)
+        if not isinstance(session, _Session):
+            return super(ProxyServer, self).idle(transport)
+        if not session.lock.acquire(blocking=False):
+            return False
+        try:
+            # between two requests.
+            return (
+                session.state == session.HEAD
+                and not session.inbuf
+                and session.client is None
+                and not transport.pending
+                and not transport.unread()
+            )
+        finally:
+            session.lock.release()
+
+    def close_idle(self):
+        super(ProxyServer, self).close_idle()
+        # the pooled upstream connections too, released ones included.
+        self.pool.close()
+
+    def log_request(self, session, status):
+        if self.access_logger is not None and self.ioloop.logger.enabled(logging.INFO):
+            self.access_logger.log(
+                "%s %s  HTTP/1.1 %d" % (session.method, session.target, status)
+            )
+
+    def stats(self):
+        with self.balancer_lock:
+            return [
+                {
+                    "upstream": u.address,
+                    "active": u.active,
+                    "requests": u.requests,
+                    "failures": u.failures,
+                    "available": u.available,
+                }
+                for u in self.upstreams
+            ]
@@ -0,0 +1,222 @@
+""" URL routing for HttpServer.
+
+Routes are compiled when they are added. A route without parameters
+goes into a dict keyed by the full path, resolving it is one dict
+lookup whatever the number of routes. Routes with parameters go into a
+trie of path segments; at each segment a static child is tried first,
+then the typed parameters in the order int, float, uuid, str, path.
+Both end in a table of handlers per method, the first route matching
+the path with the method of the request wins.
+
+    router.add("GET", "/", index)
+    router.add("GET", "/users/<int:id>", user)
+    router.add("GET", "/files/<path:name>", download)
+
+`<name>` is `<str:name>`, one non-empty segment. `path` takes the rest
+of the path and must come last.
+
+"""
+
+from urllib.parse import unquote
+
+
+class RouteNotFound(Exception):
+    pass
+
+
+class MethodNotAllowed(Exception):
+    def __init__(self, allowed):
+        super(MethodNotAllowed, self).__init__(allowed)
+        self.allowed = allowed
+
+
+def _int(segment):
+    # digits only, int() would also take " 1", "+1" and "1_0".
+    if not segment.isdigit() or not segment.isascii():
+        raise ValueError(segment)
+    return int(segment)
+
+
+def _float(segment):
+    value = float(segment)
+    if value != value or value in (float("inf"), float("-inf")):
+        raise ValueError(segment)
+    return value
+
+
+# uuid imports platform, loaded with the first uuid segment.
+_UUID = None
+
+
+def _uuid(segment):
+    global _UUID
+    if _UUID is None:
+        from uuid import UUID as _UUID
+    return _UUID(segment)
+
+
+def _str(segment):
+    if not segment:
+        raise ValueError(segment)
+    return unquote(segment)
+
+
+# converter name -> (priority, function), path is handled by the trie.
+CONVERTERS = {
+    "int": (0, _int),
+    "float": (1, _float),
+    "uuid": (2, _uuid),
+    "str": (3, _str),
+    "path": (4, None),
+}
+
+
+def _handler(table, method):
+    return table.get(method) or _other(table, method)
+
+
+def _other(table, method, allowed=None):
+    # HEAD is answered by the GET handler unless it has its own, the
+    # methods of a table without the method go to allowed.
+    if method == "HEAD" and "GET" in table:
+        return table["GET"]
+    if allowed is not None:
+        allowed.update(table)
+    return None
+
+
+class _Node(object):
+
+    __slots__ = ("static", "params", "methods")
+
+    def __init__(self):
+        # segment -> _Node
+        self.static = {}
+        # [(priority, kind, name, converter, _Node)], by priority
+        self.params = []
+        # method -> handler, on the node a route ends at
+        self.methods = None
+
+
+class Router(object):
+    def __init__(self):
+        # path -> {method: handler}, routes without parameters
+        self.static = {}
+        self.root = _Node()
+        self.routes = []
+
+    def __len__(self):
+        return len(self.routes)
+
+    def route(self, pattern, methods=("GET",)):
+        """ Decorator form of `add`. """
+
+        def decorator(handler):
+            for method in methods:
+                self.add(method, pattern, handler)
+            return handler
+
+        return decorator
+
+    def add(self, method, pattern, handler):
+        if not pattern.startswith("/"):
+            raise ValueError("route must start with '/': %r" % pattern)
+        method = method.upper()
+        segments = pattern.split("/")[1:]
+        if "<" not in pattern:
+            table = self.static.setdefault(pattern, {})
+        else:
+            table = self._insert(pattern, segments)
+        if method in table:
+            raise ValueError("duplicate route %s %s" % (method, pattern))
+        table[method] = handler
+        self.routes.append((method, pattern, handler))
+
+    def _insert(self, pattern, segments):
+        node = self.root
+        for i, segment in enumerate(segments):
+            if not (segment.startswith("<") and segment.endswith(">")):
+                if "<" in segment:
+                    raise ValueError("parameters take whole segments: %r" % pattern)
+                node = node.static.setdefault(segment, _Node())
+                continue
+            kind, _, name = segment[1:-1].rpartition(":")
+            kind = kind or "str"
+            if kind not in CONVERTERS or not name.isidentifier():
+                raise ValueError("bad parameter %r in %r" % (segment, pattern))
+            if kind == "path" and i != len(segments) - 1:
+                raise ValueError("path parameter must come last: %r" % pattern)
+            for _, k, n, _, child in node.params:
+                if k == kind and n == name:
+                    node = child
+                    break
+            else:
+                priority, converter = CONVERTERS[kind]
+                child = _Node()
+                node.params.append((priority, kind, name, converter, child))
+                node.params.sort(key=lambda param: param[0])
+                node = child
+        if node.methods is None:
+            node.methods = {}
+        return node.methods
+
+    def resolve(self, method, path):
+        """ (handler, params) for a request, raises RouteNotFound or
+        MethodNotAllowed.
+
+        Routes without the method do not hide those with it matching
+        the same path: `/users/new` for GET and `/users/<name>` for
+        POST. MethodNotAllowed lists the methods of all the routes
+        matching the path.
+
+        """
+        table = self.static.get(path)
+        if table is not None:
+            handler = _handler(table, method)
+            if handler is not None:
+                return handler, {}
+        allowed = set(table or ())
+        if self.root.static or self.root.params:
+            params = {}
+            handler = self._match(
+                self.root, path.split("/"), 1, method, params, allowed
+            )
+            if handler is not None:
+                return handler, params
+        if not allowed:
+            raise RouteNotFound(path)
+        raise MethodNotAllowed(sorted(allowed))
+
+    def _match(self, node, segments, i, method, params, allowed):
+        # the handler of the first route matching the rest of the path
+        # with the method, the methods of the others go to allowed.
+        if i == len(segments):
+            table = node.methods
+            if table is None:
+                return None
+            return table.get(method) or _other(table, method, allowed)
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child is not None:
+            handler = self._match(child, segments, i + 1, method, params, allowed)
+            if handler is not None:
+                return handler
+        for _, kind, name, converter, child in node.params:
+            if converter is None:
+                # path: the rest, one segment at least.
+                table = child.methods
+                if table is not None and segment:
+                    handler = table.get(method) or _other(table, method, allowed)
+                    if handler is not None:
+                        params[name] = unquote("/".join(segments[i:]))
+                        return handler
+                continue
+            try:
+                value = converter(segment)
+            except ValueError:
+                continue
+            handler = self._match(child, segments, i + 1, method, params, allowed)
+            if handler is not None:
+                params[name] = value
+                return handler
+        return None
@@ -0,0 +1,564 @@
+""" WebSocket (RFC 6455) for HttpServer.
+
+A `WebSocket` subclass is registered for a path with
+`HttpServer.websocket`; the GET request that asks for the upgrade is
+answered with 101 and the connection is handed over to an instance of
+the class, with a handler of its own.
+
+    @server.websocket("/echo")
+    class Echo(WebSocket):
+        def on_message(self, message):
+            self.send(message)
+
+Text messages arrive as str and binary ones as bytes, fragmented
+messages are reassembled, pings are answered and permessage-deflate
+(RFC 7692) is negotiated when the client offers it.
+
+Client payloads are unmasked a whole buffer at a time, never byte by
+byte in Python: small ones in one XOR of two big integers, large ones
+with a translate table per mask byte applied to the 4 strided slices.
+Frames sent while a read is dispatched, the answers to the messages it
+contained and pongs, are collected and written to the transport in one
+piece when the dispatch is over.
+
+"""
+
+import base64
+import hashlib
+import struct
+import threading
+import zlib
+
+from whoops.ioloop import IOLoop, Handler
+
+
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# close codes
+NORMAL = 1000
+GOING_AWAY = 1001
+PROTOCOL_ERROR = 1002
+NO_STATUS = 1005
+ABNORMAL = 1006
+INVALID_DATA = 1007
+TOO_BIG = 1009
+
+# the end of a flushed deflate block, not sent.
+_DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+
+def accept_key(key):
+    return base64.b64encode(
+        hashlib.sha1(key.encode("latin-1") + GUID).digest()
+    ).decode()
+
+
+# mask byte -> translate table XORing with it, filled on demand.
+_TABLES = {}
+
+# above this, 4 strided translates beat the big integer XOR.
+_TRANSLATE_MIN = 2048
+
+
+def _table(byte):
+    table = _TABLES.get(byte)
+    if table is None:
+        table = _TABLES[byte] = bytes(b ^ byte for b in range(256))
+    return table
+
+
+def apply_mask(data, mask):
+    """ Masks or unmasks `data` with the 4 byte `mask`. """
+    n = len(data)
+    if n < _TRANSLATE_MIN:
+        if not n:
+            return b""
+        key = mask * (n // 4 + 1)
+        return (
+            int.from_bytes(data, "little") ^ int.from_bytes(key[:n], "little")
+        ).to_bytes(n, "little")
+    # every 4th byte is XORed with the same mask byte.
+    data = bytes(data)
+    out = bytearray(n)
+    for i in range(4):
+        out[i::4] = data[i::4].translate(_table(mask[i]))
+    return bytes(out)
+
+
+def encode_header(opcode, length, fin=True, rsv1=False, mask=None):
+    b0 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    b1 = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack("!BB", b0, b1 | length)
+    elif length < 65536:
+        header = struct.pack("!BBH", b0, b1 | 126, length)
+    else:
+        header = struct.pack("!BBQ", b0, b1 | 127, length)
+    return header + mask if mask else header
+
+
+def encode_frame(opcode, payload, fin=True, rsv1=False, mask=None):
+    """ A whole frame, masked with `mask` for the client side. """
+    header = encode_header(opcode, len(payload), fin, rsv1, mask)
+    if mask:
+        payload = apply_mask(payload, mask)
+    return header + payload
+
+
+def _valid_close_code(code):
+    return (
+        1000 <= code <= 1011 and code not in (1004, 1005, 1006)
+    ) or 3000 <= code <= 4999
+
+
+def _parse_deflate(offers):
+    # the first permessage-deflate offer we can take:
+    # (response, server_no_context_takeover, server_max_window_bits)
+    for offer in offers.split(","):
+        params = [p.strip() for p in offer.split(";")]
+        if params[0].lower() != "permessage-deflate":
+            continue
+        response = ["permessage-deflate"]
+        no_context = False
+        bits = 15
+        ok = True
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            name = name.strip().lower()
+            value = value.strip().strip('"')
+            if name == "server_no_context_takeover":
+                no_context = True
+                response.append(name)
+            elif name == "client_no_context_takeover":
+                # the decompressor copes either way.
+                response.append(name)
+            elif name == "server_max_window_bits":
+                # zlib cannot write a window of 8 bits and the answer may
+                # not be larger than the offer: 8 is declined.
+                if not value.isdigit() or not 9 <= int(value) <= 15:
+                    ok = False
+                    break
+                bits = int(value)
+                response.append("%s=%d" % (name, bits))
+            elif name == "client_max_window_bits":
+                # the decompressor takes any window, no answer needed.
+                if value and (not value.isdigit() or not 8 <= int(value) <= 15):
+                    ok = False
+                    break
+            else:
+                ok = False
+                break
+        if ok:
+            return "; ".join(response), no_context, bits
+    return None
+
+
+def upgrade(server, cls, params, subprotocols=(), deflate=True, **options):
+    """ Answers the upgrade request being handled by `server` and hands
+    the connection over to `cls`. Returns None or the (code, headers,
+    body) error to send instead.
+
+    """
+    header = server.header
+    if "websocket" not in (header.get("Upgrade") or "").lower():
+        return 426, [("Upgrade", "websocket"), ("Connection", "Upgrade")], None
+    if "upgrade" not in (header.get("Connection") or "").lower():
+        return 400, None, None
+    if header.get("Sec-WebSocket-Version") != "13":
+        return 426, [("Sec-WebSocket-Version", "13")], None
+    key = header.get("Sec-WebSocket-Key") or ""
+    try:
+        if len(base64.b64decode(key, validate=True)) != 16:
+            raise ValueError(key)
+    except ValueError:
+        return 400, None, None
+
+    server.send_response(101)
+    server.send_header("Upgrade", "websocket")
+    server.send_header("Connection", "Upgrade")
+    server.send_header("Sec-WebSocket-Accept", accept_key(key))
+    negotiated = None
+    extensions = header.get("Sec-WebSocket-Extensions")
+    if deflate and extensions:
+        negotiated = _parse_deflate(extensions)
+        if negotiated is not None:
+            server.send_header("Sec-WebSocket-Extensions", negotiated[0])
+    protocol = None
+    offered = header.get("Sec-WebSocket-Protocol")
+    if offered and subprotocols:
+        for name in (p.strip() for p in offered.split(",")):
+            if name in subprotocols:
+                protocol = name
+                server.send_header("Sec-WebSocket-Protocol", name)
+                break
+    server.end_headers()
+
+    # frames sent right behind the request, if any. Those arriving
+    # later wait for this callback, the ioloop runs one at a time per
+    # transport, and go to the handler _start switches to.
+    rest = server.request_body + server.rfile.read()
+    ws = cls(server.connection, server.path, params, protocol, negotiated, **options)
+    ws._start(rest)
+    return None
+
+
+class WebSocket(object):
+
+    """ One WebSocket connection, subclass and override the `on_*` methods.
+
+    Callbacks run on executor threads, one at a time per connection.
+    `send`, `ping` and `close` may be called from any thread.
+
+    """
+
+    def __init__(
+        self,
+        transport,
+        path,
+        params,
+        protocol=None,
+        deflate=None,
+        max_size=1 << 24,
+        compress_min=128,
+        compress_level=6,
+        close_timeout=5,
+    ):
+        self.transport = transport
+        self.ioloop = transport.handler.ioloop
+        self.path = path
+        self.params = params
+        self.protocol = protocol
+        self.max_size = max_size
+        self.compress_min = compress_min
+        self.close_timeout = close_timeout
+
+        self.handler = Handler(self.ioloop)
+        self.handler.on_connection_cb = self._on_readable
+        self.handler.on_write_cb = self._on_writable
+        self.handler.on_close_cb = self._on_closed
+
+        self._lock = threading.RLock()
+        self._buf = bytearray()
+        # frames of a message being reassembled
+        self._fragments = None
+        self._opcode = None
+        self._compressed = False
+        self._size = 0
+        # frames sent while a read is dispatched
+        self._out = None
+
+        self._compressor = None
+        self._decompressor = None
+        self._no_context = False
+        self._window_bits = 15
+        if deflate is not None:
+            _, self._no_context, self._window_bits = deflate
+            self._compress_level = compress_level
+            self._compressor = self._new_compressor()
+            self._decompressor = zlib.decompressobj(-15)
+
+        self.closed = False
+        self.close_code = None
+        self.close_reason = ""
+        self._close_sent = False
+        self._shutting_down = False
+        self._timer = None
+
+    @property
+    def deflate(self):
+        return self._compressor is not None
+
+    def _new_compressor(self):
+        return zlib.compressobj(self._compress_level, zlib.DEFLATED, -self._window_bits)
+
+    # callbacks
+
+    def on_open(self):
+        pass
+
+    def on_message(self, message):
+        pass
+
+    def on_pong(self, data):
+        pass
+
+    def on_close(self, code, reason):
+        pass
+
+    # sending
+
+    def send(self, message):
+        """ Sends str as a text message, bytes-like as a binary one. """
+        if isinstance(message, str):
+            opcode, payload = TEXT, message.encode("utf-8")
+        else:
+            opcode, payload = BINARY, message
+        with self._lock:
+            if self._close_sent or self.closed:
+                return
+            rsv1 = False
+            if self._compressor is not None and len(payload) >= self.compress_min:
+                compressor = self._compressor
+                payload = compressor.compress(payload) + compressor.flush(
+                    zlib.Z_SYNC_FLUSH
+                )
+                payload = payload[:-4]
+                rsv1 = True
+                if self._no_context:
+                    self._compressor = self._new_compressor()
+            self._write(encode_header(opcode, len(payload), rsv1=rsv1), payload)
+
+    def ping(self, data=b""):
+        with self._lock:
+            if not self._close_sent and not self.closed:
+                self._write(encode_header(PING, len(data)), data)
+
+    def close(self, code=NORMAL, reason=""):
+        """ Starts the closing handshake, the connection is closed when
+        the peer answers or after `close_timeout` seconds.
+
+        """
+        with self._lock:
+            if self._close_sent or self.closed:
+                return
+            self._send_close(code, reason)
+            if self.close_code is not None:
+                # answering the peer's close.
+                self._shutdown()
+            else:
+                self._timer = self.ioloop.call_later(
+                    self.close_timeout, self._on_close_timeout
+                )
+
+    def _send_close(self, code, reason):
+        payload = struct.pack("!H", code) + reason.encode("utf-8") if code else b""
+        self._write(encode_header(CLOSE, len(payload)), payload)
+        self._close_sent = True
+
+    def _write(self, header, payload):
+        if self._out is not None:
+            self._out.append(header)
+            self._out.append(payload)
+        else:
+            self.transport.write(header + payload)
+
+    # reading
+
+    def _start(self, rest):
+        self.transport.handler = self.handler
+        with self._lock:
+            self._out = []
+            try:
+                self.on_open()
+                if rest:
+                    self._buf += rest
+                    self._parse()
+            finally:
+                self._flush()
+        # edge triggered, frames may have arrived during the handshake.
+        self._on_readable(self.transport)
+
+    def _on_readable(self, conn):
+        with self._lock:
+            if self.closed:
+                return
+            data = self.transport.read(65536)
+            if not data:
+                if self.transport.at_eof():
+                    self._close_transport()
+                return
+            if self._shutting_down:
+                # after our close, whatever the peer still sends.
+                return
+            self._buf += data
+            self._out = []
+            try:
+                self._parse()
+            finally:
+                self._flush()
+
+    def _flush(self):
+        out, self._out = self._out, None
+        if out and not self.closed:
+            self.transport.write(out[0] + out[1] if len(out) == 2 else b"".join(out))
+
+    def _parse(self):
+        buf = self._buf
+        pos = 0
+        end = len(buf)
+        while not self._shutting_down and end - pos >= 2:
+            b0 = buf[pos]
+            b1 = buf[pos + 1]
+            length = b1 & 0x7F
+            start = pos + 2
+            if length == 126:
+                if end - pos < 4:
+                    break
+                (length,) = struct.unpack_from("!H", buf, start)
+                start += 2
+            elif length == 127:
+                if end - pos < 10:
+                    break
+                (length,) = struct.unpack_from("!Q", buf, start)
+                start += 8
+            if not b1 & 0x80:
+                # client frames are masked.
+                self._fail(PROTOCOL_ERROR)
+                break
+            if length > self.max_size:
+                self._fail(TOO_BIG)
+                break
+            if end - start < 4 + length:
+                break
+            mask = bytes(buf[start : start + 4])
+            start += 4
+            with memoryview(buf) as view:
+                payload = apply_mask(view[start : start + length], mask)
+            pos = start + length
+            self._frame(b0, payload)
+        del buf[:pos]
+
+    def _frame(self, b0, payload):
+        fin = b0 & 0x80
+        opcode = b0 & 0x0F
+        rsv1 = b0 & 0x40
+        if b0 & 0x30 or (
+            rsv1 and (self._compressor is None or opcode != TEXT and opcode != BINARY)
+        ):
+            self._fail(PROTOCOL_ERROR)
+            return
+        if opcode >= CLOSE:
+            if not fin or len(payload) > 125:
+                self._fail(PROTOCOL_ERROR)
+            elif opcode == CLOSE:
+                self._on_close_frame(payload)
+            elif opcode == PING:
+                if not self._close_sent:
+                    self._write(encode_header(PONG, len(payload)), payload)
+            elif opcode == PONG:
+                self.on_pong(payload)
+            else:
+                self._fail(PROTOCOL_ERROR)
+            return
+        if opcode == CONTINUATION:
+            if self._fragments is None:
+                self._fail(PROTOCOL_ERROR)
+                return
+            self._fragments.append(payload)
+        elif opcode == TEXT or opcode == BINARY:
+            if self._fragments is not None:
+                self._fail(PROTOCOL_ERROR)
+                return
+            self._fragments = [payload]
+            self._opcode = opcode
+            self._compressed = bool(rsv1)
+            self._size = 0
+        else:
+            self._fail(PROTOCOL_ERROR)
+            return
+        self._size += len(payload)
+        if self._size > self.max_size:
+            self._fail(TOO_BIG)
+            return
+        if not fin:
+            return
+
+        fragments, self._fragments = self._fragments, None
+        message = fragments[0] if len(fragments) == 1 else b"".join(fragments)
+        if self._compressed:
+            decompressor = self._decompressor
+            try:
+                message = decompressor.decompress(
+                    message + _DEFLATE_TAIL, self.max_size + 1
+                )
+            except zlib.error:
+                self._fail(INVALID_DATA)
+                return
+            if len(message) > self.max_size or decompressor.unconsumed_tail:
+                self._fail(TOO_BIG)
+                return
+        if self._opcode == TEXT:
+            try:
+                message = message.decode("utf-8")
+            except UnicodeDecodeError:
+                self._fail(INVALID_DATA)
+                return
+        self.transport.requests += 1
+        self.on_message(message)
+
+    def _on_close_frame(self, payload):
+        code, reason = NO_STATUS, ""
+        if len(payload) == 1:
+            self._fail(PROTOCOL_ERROR)
+            return
+        if payload:
+            (code,) = struct.unpack("!H", payload[:2])
+            try:
+                reason = payload[2:].decode("utf-8")
+            except UnicodeDecodeError:
+                self._fail(INVALID_DATA)
+                return
+            if not _valid_close_code(code):
+                self._fail(PROTOCOL_ERROR)
+                return
+        self.close_code, self.close_reason = code, reason
+        if not self._close_sent:
+            # echo the code, the server closes the TCP connection.
+            self._send_close(code if code != NO_STATUS else 0, "")
+        self._shutdown()
+
+    def _fail(self, code):
+        if self.close_code is None:
+            self.close_code = code
+        if not self._close_sent:
+            self._send_close(code, "")
+        self._shutdown()
+
+    def _on_close_timeout(self):
+        # ioloop thread.
+        self.ioloop.executor.submit(self._shutdown_now)
+
+    def _shutdown_now(self):
+        with self._lock:
+            self._close_transport()
+
+    def _shutdown(self):
+        # close the TCP connection once the queued frames are out.
+        self._shutting_down = True
+        if self._out:
+            # the close frame is still in the batch.
+            self._flush()
+            self._out = []
+        if self.transport.pending:
+            self.transport.set_events(IOLoop._READ | IOLoop._WRITE)
+        else:
+            self._close_transport()
+
+    def _on_writable(self, conn):
+        with self._lock:
+            if self._shutting_down and not self.transport.pending:
+                self._close_transport()
+
+    def _close_transport(self):
+        if not self.transport.closed:
+            self.ioloop.unregister(self.transport.conn.fileno())
+            self.transport.close()
+
+    def _on_closed(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._timer:
+                self._timer.cancel()
+            if self.close_code is None:
+                self.close_code = ABNORMAL
+        self.on_close(self.close_code, self.close_reason)
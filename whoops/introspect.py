@@ -0,0 +1,97 @@
+""" Live connection snapshots.
+
+Every `Transport` counts the bytes it read and sent, the requests it
+served and when it last read or wrote. `snapshot` lists the top `n`
+connections of an ioloop by one of `KEYS`, the loop keeps running:
+the connection table is copied in one step and scanned once, only the
+top `n` are described. `HttpServer.debug_connections` serves it as
+JSON.
+
+* `bytes_in`, `bytes_out` : who moves the most data.
+* `pending` : bytes queued for slow readers, stuck writers first.
+* `idle` : seconds since the last read or write.
+* `requests` : requests, or WebSocket messages, served.
+
+UDP endpoints are left out, their `pending` counts datagrams, not
+bytes, and they keep counters of their own.
+
+"""
+
+import heapq
+import time
+
+from whoops.datagram import DatagramTransport
+
+
+KEYS = {
+    "bytes_in": lambda transport, now: transport.bytes_in,
+    "bytes_out": lambda transport, now: transport.bytes_out,
+    "pending": lambda transport, now: transport.pending,
+    "idle": lambda transport, now: now - transport.last_active,
+    "requests": lambda transport, now: transport.requests,
+}
+
+
+def owner(transport):
+    """ What handles the connection: the class of the object its read
+    callback is bound to and that object's `state`, if any.
+
+    """
+    callback = transport.handler.on_connection_cb
+    obj = getattr(callback, "__self__", None)
+    if obj is None:
+        return getattr(callback, "__name__", None), None
+    state = getattr(obj, "state", None)
+    return type(obj).__name__, state if isinstance(state, (int, str)) else None
+
+
+def describe(fd, transport, now):
+    address = transport.address
+    if isinstance(address, tuple):
+        address = "%s:%s" % address[:2]
+    elif isinstance(address, bytes):
+        address = address.decode("latin-1")
+    handler, state = owner(transport)
+    return {
+        "fd": fd,
+        "address": address,
+        "handler": handler,
+        "state": state,
+        "bytes_in": transport.bytes_in,
+        "bytes_out": transport.bytes_out,
+        "pending": transport.pending,
+        "idle": round(now - transport.last_active, 3),
+        "requests": transport.requests,
+    }
+
+
+def snapshot(ioloop, n=20, key="bytes_out"):
+    """ The top `n` connections of `ioloop` by `key`, with totals over
+    all of them.
+
+    """
+    measure = KEYS[key]
+    now = time.monotonic()
+    # one copy under the GIL, the ioloop thread adds and removes meanwhile.
+    items = list(ioloop.connections.items())
+    listening = ioloop.acceptor.fileno() if ioloop.acceptor is not None else None
+    items = [
+        (fd, transport)
+        for fd, transport in items
+        if fd != listening and not isinstance(transport, DatagramTransport)
+    ]
+    pending = 0
+    writing = 0
+    for _, transport in items:
+        if transport.pending:
+            pending += transport.pending
+            writing += 1
+    top = heapq.nlargest(n, items, key=lambda item: measure(item[1], now))
+    return {
+        "time": time.time(),
+        "key": key,
+        "connections": len(items),
+        "writing": writing,
+        "pending": pending,
+        "top": [describe(fd, transport, now) for fd, transport in top],
+    }
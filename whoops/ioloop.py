@@ -1,13 +1,42 @@
+import heapq
+import itertools
+import logging
+import os
 import socket
 import select
 import threading
+import time
 
-from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from .logger import DefaultLogger
 
 
+# striped locks guarding transport write queues and reads, a lock per
+# connection would cost more memory than the rest of the transport.
+_WRITE_LOCKS = tuple(threading.Lock() for _ in range(64))
+
+
+class Handler(object):
+
+    """ Callbacks shared by all the transports of a server or a client.
+
+    Transports only keep a reference to their handler, so the callbacks
+    are stored once per server instead of once per connection.
+
+    """
+
+    def __init__(self, ioloop=None):
+        self.ioloop = ioloop
+
+        self.on_write_cb = None
+        self.connection_made_cb = None
+        self.on_connection_cb = None
+        self.on_close_cb = None
+        # called on the ioloop thread when the peer hangs up, keep it short.
+        self.on_hangup_cb = None
+
+
 class Transport(object):
 
     """ Encapsulation for connection and events.
@@ -15,43 +44,246 @@ class Transport(object):
     transport instance provide read and write methods under
     Edge Trigger(EPOLLET) mode of epoll.
 
-    4 callbacks are bind to the connection instance:
+    4 callbacks are bind to the connection instance through its handler:
 
     * `on write callback` : EPOLLOUT(_WRITE) returned.
     * `on close callback` : ERROR occur or close the connection.
     * `on connection callback` : EPOLLIN(_READ) returned.
     * `on connection made callback`: when connection register to the ioloop.
 
+    Data the socket does not take at once is queued and flushed by the
+    ioloop on EPOLLOUT, the queue only exists while data is pending.
+
+    Bytes read and sent, the time of the last read or write and the
+    requests served are counted for `introspect.snapshot`, servers
+    count their requests.
+
+    The on connection callback runs for one EPOLLIN at a time, an
+    EPOLLIN arriving meanwhile runs it once more when it returns, with
+    the handler of that time: a callback may switch the handler of the
+    transport and leave the rest of the stream to the new one.
+
     """
 
-    def __init__(self, conn, address):
+    __slots__ = (
+        "conn",
+        "_address",
+        "events",
+        "handler",
+        "closed",
+        "_wbuf",
+        "_wlen",
+        "bytes_in",
+        "bytes_out",
+        "last_active",
+        "requests",
+        "_reads",
+    )
+
+    # errors meaning "try again later" for send(2).
+    _retry = (BlockingIOError, InterruptedError)
+
+    def __init__(self, conn, address, handler=None):
         self.conn = conn
-        self.address = address
+        # None: asked to the socket on demand.
+        self._address = address
 
-        self.events = None
+        self.events = 0
 
-        self.on_write_cb = None
-        self.connection_made_cb = None
-        self.on_connection_cb = None
-        self.on_close_cb = None
+        self.handler = handler if handler is not None else Handler()
+
+        self.closed = False
+
+        # pending writes, a deque of memoryviews or None, and their size.
+        self._wbuf = None
+        self._wlen = 0
+
+        # counters
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_active = time.monotonic()
+        self.requests = 0
+
+        # 0: no on connection callback running, 1: one is, 2: and an
+        # EPOLLIN came meanwhile. See begin_read and end_read.
+        self._reads = 0
+
+    @property
+    def address(self):
+        if self._address is None and not self.closed:
+            try:
+                return self.conn.getpeername()
+            except socket.error:
+                pass
+        return self._address
+
+    @address.setter
+    def address(self, address):
+        self._address = address
+
+    @property
+    def on_write_cb(self):
+        return self.handler.on_write_cb
+
+    @on_write_cb.setter
+    def on_write_cb(self, callback):
+        self.handler.on_write_cb = callback
+
+    @property
+    def connection_made_cb(self):
+        return self.handler.connection_made_cb
+
+    @connection_made_cb.setter
+    def connection_made_cb(self, callback):
+        self.handler.connection_made_cb = callback
+
+    @property
+    def on_connection_cb(self):
+        return self.handler.on_connection_cb
+
+    @on_connection_cb.setter
+    def on_connection_cb(self, callback):
+        self.handler.on_connection_cb = callback
+
+    @property
+    def on_close_cb(self):
+        return self.handler.on_close_cb
+
+    @on_close_cb.setter
+    def on_close_cb(self, callback):
+        self.handler.on_close_cb = callback
+
+    @property
+    def pending(self):
+        # bytes queued and not written to the socket yet.
+        return self._wlen
 
     def read(self, bytes=1024, buffer=b""):
+        chunks = [buffer] if buffer else []
+        size = 0
         try:
             while True:
-                buffer += self.conn.recv(bytes)
+                data = self.conn.recv(bytes)
+                if not data:
+                    # EOF, the peer closed the connection.
+                    break
+                chunks.append(data)
+                size += len(data)
         except socket.error:
             pass
-        return buffer
+        if size:
+            self.bytes_in += size
+            self.last_active = time.monotonic()
+        return b"".join(chunks)
+
+    def at_eof(self):
+        # read() returns b"" at EOF and on a wakeup with nothing to
+        # read, only the first closes the connection.
+        try:
+            # the raw socket, under TLS too.
+            return not socket.socket.recv(self.conn, 1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except (socket.error, ValueError):
+            return True
+
+    def unread(self):
+        # data waiting to be read, left in the socket.
+        try:
+            return bool(socket.socket.recv(self.conn, 1, socket.MSG_PEEK))
+        except (socket.error, ValueError):
+            return False
 
     def write(self, data):
         if isinstance(data, str):
             data = data.encode("utf-8")
-        try:
-            self.conn.send(data)
-        except socket.error:
-            pass
+        with self._lock():
+            self.last_active = time.monotonic()
+            if self._wbuf:
+                # keep the order behind what is already queued.
+                self._wbuf.append(memoryview(data))
+                self._wlen += len(data)
+                return
+            try:
+                sent = self.conn.send(data)
+            except self._retry:
+                sent = 0
+            except socket.error:
+                return
+            self.bytes_out += sent
+            if sent < len(data):
+                self._wbuf = deque([memoryview(data)[sent:]])
+                self._wlen = len(data) - sent
+                self._modify(self.events | IOLoop._WRITE)
+
+    def flush(self):
+        # called by the ioloop on EPOLLOUT.
+        with self._lock():
+            wbuf = self._wbuf
+            while wbuf:
+                data = wbuf[0]
+                try:
+                    sent = self.conn.send(data)
+                except self._retry:
+                    return
+                except socket.error:
+                    wbuf.clear()
+                    break
+                self.bytes_out += sent
+                self.last_active = time.monotonic()
+                if sent < len(data):
+                    wbuf[0] = data[sent:]
+                    self._wlen -= sent
+                    return
+                wbuf.popleft()
+                self._wlen -= sent
+            self._wbuf = None
+            self._wlen = 0
+            self._modify(self.events)
+
+    def begin_read(self):
+        # on the ioloop thread, True when the caller runs the callback.
+        with self._lock():
+            if self._reads:
+                self._reads = 2
+                return False
+            self._reads = 1
+            return True
+
+    def end_read(self):
+        # True when an EPOLLIN came during the callback, run it again.
+        with self._lock():
+            if self._reads == 2:
+                self._reads = 1
+                return True
+            self._reads = 0
+            return False
+
+    def set_events(self, events):
+        # EPOLLOUT stays armed while writes are queued.
+        self.events = events
+        self._modify(events | IOLoop._WRITE if self._wbuf else events)
+
+    def _lock(self):
+        return _WRITE_LOCKS[id(self) % 64]
+
+    def _modify(self, events):
+        ioloop = self.handler.ioloop
+        if ioloop is not None and not self.closed:
+            ioloop.modify(self.conn.fileno(), events | IOLoop._EPOLLET)
 
     def close(self):
+        # close only once, the ioloop and the owner of the
+        # transport may race on an error.
+        if self.closed:
+            return
+        self.closed = True
+        self._wbuf = None
+        self._wlen = 0
+        # a connection counted by the rate limiter of the server.
+        ioloop = self.handler.ioloop
+        if ioloop is not None and ioloop.limiter is not None:
+            ioloop.limiter.release(self.conn.fileno())
         # on close callback.
         if self.on_close_cb:
             try:
@@ -65,12 +297,20 @@ class Transport(object):
 class _Epoll(object):
     def __init__(self):
         self.epoller = select.epoll(flags=select.EPOLL_CLOEXEC)
+        # events per poll, -1: as many as are ready
+        self.maxevents = -1
 
     def register(self, fd, eventmask):
         self.epoller.register(fd, eventmask)
 
+    def modify(self, fd, eventmask):
+        self.epoller.modify(fd, eventmask)
+
+    def unregister(self, fd):
+        self.epoller.unregister(fd)
+
     def poll(self, timeout):
-        return self.epoller.poll(timeout)
+        return self.epoller.poll(timeout, self.maxevents)
 
     def close(self):
         self.epoller.close()
@@ -82,6 +322,7 @@ class _Kqueue(object):
 
     def __init__(self):
         self._kqueue = select.kqueue()
+        self.maxevents = self.MAX_EVENTS
 
     def _control(self, fd, mode, flags):
         events = []
@@ -92,13 +333,31 @@ class _Kqueue(object):
         for e in events:
             self._kqueue.control([e], 0)
 
+    def _flags(self, eventmask):
+        # EV_CLEAR is kqueue's edge triggering.
+        if eventmask & IOLoop._EPOLLET:
+            return select.KQ_EV_ADD | select.KQ_EV_CLEAR
+        return select.KQ_EV_ADD
+
     def register(self, fd, eventmask):
-        self._control(fd, eventmask, select.KQ_EV_ADD | select.KQ_EV_CLEAR)
+        self._control(fd, eventmask, self._flags(eventmask))
+
+    def modify(self, fd, eventmask):
+        self._control(fd, eventmask, self._flags(eventmask))
+        if not eventmask & IOLoop._WRITE:
+            try:
+                self._control(fd, IOLoop._WRITE, select.KQ_EV_DELETE)
+            except OSError:
+                pass
+
+    def unregister(self, fd):
+        self._control(fd, IOLoop._READ | IOLoop._WRITE, select.KQ_EV_DELETE)
 
     def poll(self, timeout):
         if timeout < 0:
             timeout = None  # kqueue behaviour
-        events = self._kqueue.control(None, self.MAX_EVENTS, timeout)
+        maxevents = self.maxevents if self.maxevents > 0 else self.MAX_EVENTS
+        events = self._kqueue.control(None, maxevents, timeout)
         results = defaultdict(lambda: IOLoop._NONE)
         for e in events:
             fd = e.ident
@@ -118,6 +377,28 @@ class _Kqueue(object):
         self._kqueue.close()
 
 
+def _callback_name(callback):
+    # the class of the instance, not the one defining the method.
+    owner = getattr(callback, "__self__", None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__, callback.__name__)
+    return getattr(callback, "__qualname__", repr(callback))
+
+
+class _Timer(object):
+
+    """ A callback scheduled on the ioloop thread, see `IOLoop.call_later`. """
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.callback = None
+        self.args = None
+
+
 class IOLoop(object):
 
     # Global lock for creating global IOLoop instance
@@ -130,6 +411,7 @@ class IOLoop(object):
     _EPOLLERR = 0x008
     _EPOLLHUP = 0x010
     _EPOLLRDHUP = 0x2000
+    _EPOLLEXCLUSIVE = 1 << 28
     _EPOLLONESHOT = 1 << 30
     _EPOLLET = 1 << 31
 
@@ -138,6 +420,7 @@ class IOLoop(object):
     _READ = _EPOLLIN
     _WRITE = _EPOLLOUT
     _ERROR = _EPOLLERR | _EPOLLHUP
+    _HANGUP = _EPOLLRDHUP | _EPOLLHUP
 
     # Event dict for events string convertion.
     _EVENTS_DICT = {
@@ -147,6 +430,7 @@ class IOLoop(object):
         _EPOLLERR: "EPOLLERR",
         _EPOLLHUP: "EPOLLHUP",
         _EPOLLRDHUP: "EPOLLRDHUP",
+        _EPOLLEXCLUSIVE: "EPOLLEXCLUSIVE",
         _EPOLLONESHOT: "EPOLLONESHOT",
         _EPOLLET: "EPOLLET",
         (_EPOLLHUP | _EPOLLOUT): "EPOLLOUT | EPOLLHUP",
@@ -178,35 +462,245 @@ class IOLoop(object):
 
         # acceptor
         self.acceptor = None
+        self._acceptor_fd = None
+        self._accept_pending = False
 
-        # connections
-        self.connections = {}
+        # ratelimit.RateLimiter of the acceptor, see AsyncServer.set_limiter
+        self.limiter = None
 
-        # backends thread pool executor
-        self.executor = ThreadPoolExecutor(max_workers=num_backends)
+        # set by stop, start returns
+        self._stopped = False
 
-        # callbacks
-        self.connection_made_cb = None
-        self.on_write_cb = None
-        self.on_connection_cb = None
-        self.on_close_cb = None
+        # connections
+        self.connections = {}
 
-        # logger
-        self.logger = DefaultLogger()
+        # backends thread pool executor, see executor
+        self.num_backends = num_backends
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        # timers, a heap of (deadline, sequence, timer)
+        self._timers = []
+        self._timers_lock = threading.Lock()
+        self._timers_seq = itertools.count()
+
+        # callbacks from other threads and signal handlers, see
+        # add_callback, and the pipe waking the poll for them.
+        self._callbacks = deque()
+        self._waker = None
+        self._waker_fd = None
+
+        # logger, see logger
+        self._logger = None
+
+        # debug mode, see set_debug
+        self.slow_callback = None
+        self.slow_callbacks = 0
+
+        # poll settings, see tune
+        self.poll_timeout = 1
+        self.busy_poll = 0
+        self.exclusive_accept = False
+        # fds polled level triggered, see set_level_triggered
+        self._level = set()
+
+    @property
+    def executor(self):
+        """ The thread pool running the callbacks, made on first use: a
+        short-lived worker that never gets an event never imports
+        concurrent.futures.
+
+        """
+        executor = self._executor
+        if executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+
+                    # -1 and None: the executor's default size.
+                    workers = self.num_backends
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=workers if workers and workers > 0 else None
+                    )
+                executor = self._executor
+        return executor
+
+    @executor.setter
+    def executor(self, executor):
+        self._executor = executor
+
+    @property
+    def logger(self):
+        # servers usually set their own, the default one is made on first use.
+        if self._logger is None:
+            self._logger = DefaultLogger()
+        return self._logger
+
+    @logger.setter
+    def logger(self, logger):
+        self._logger = logger
+
+    def set_debug(self, slow_callback=0.1):
+        """ Times the callbacks and the loop iterations, logs those that
+        took `slow_callback` seconds or more. None turns it off.
+
+        """
+        self.slow_callback = slow_callback
+
+    def tune(self, maxevents=None, timeout=None, busy_poll=None, exclusive_accept=None):
+        """ Poll settings, None keeps the current one.
+
+        * `maxevents` : events taken per poll, -1 for all the ready ones
+          (1024 with kqueue). Fewer bound the work of an iteration,
+          timers and accepts run in between.
+        * `timeout` : seconds a poll blocks at most when no timer is due.
+        * `busy_poll` : seconds to keep polling without blocking after
+          events came, 0 blocks at once. The next event is seen without
+          the wakeup of a sleeping thread, a CPU spins meanwhile.
+        * `exclusive_accept` : EPOLLEXCLUSIVE on the listener, only one
+          of the processes polling a shared listening socket is woken
+          per connection (Linux 4.5+, epoll only).
+
+        """
+        if maxevents is not None:
+            self._impl.maxevents = maxevents
+        if timeout is not None:
+            self.poll_timeout = timeout
+        if busy_poll is not None:
+            self.busy_poll = busy_poll
+        if exclusive_accept is not None and exclusive_accept != self.exclusive_accept:
+            self.exclusive_accept = exclusive_accept
+            if self._acceptor_fd is not None:
+                # EPOLLEXCLUSIVE cannot be modified, only registered.
+                self._reregister(self._acceptor_fd, self._accept_events())
+
+    def set_level_triggered(self, fd, level=True):
+        """ Polls the registered `fd` level triggered, or edge triggered
+        again.
+
+        Level triggered events are reported on every poll while the fd
+        is readable: fit for the listener, accepted on the ioloop
+        thread, and for callbacks that may run concurrently, like a
+        DatagramEndpoint's. A Transport read by one callback at a time
+        must stay edge triggered.
+
+        """
+        if fd == self._acceptor_fd:
+            events = self._accept_events()
+        else:
+            transport = self.connections[fd]
+            events = transport.events | IOLoop._EPOLLET
+            if transport.pending:
+                events |= IOLoop._WRITE
+        if level:
+            self._reregister(fd, events & ~IOLoop._EPOLLET)
+            self._level.add(fd)
+        else:
+            self._reregister(fd, events)
+            self._level.discard(fd)
+
+    def _reregister(self, fd, eventmask):
+        try:
+            self._impl.unregister(fd)
+        except (OSError, ValueError, KeyError):
+            pass
+        self._impl.register(fd, eventmask)
 
-    def start(self, timeout=1):
-        while True:
+    def _accept_events(self):
+        events = IOLoop._READ
+        if self._acceptor_fd not in self._level:
+            events |= IOLoop._EPOLLET
+        if self.exclusive_accept:
+            events |= getattr(select, "EPOLLEXCLUSIVE", IOLoop._EPOLLEXCLUSIVE)
+        return events
+
+    def start(self, timeout=None):
+        if timeout is not None:
+            self.poll_timeout = timeout
+        self._open_waker()
+        try:
+            self._loop()
+        finally:
+            self._close_waker()
+
+    def _loop(self):
+        woke = None
+        # polls do not block until then, see tune
+        busy_until = 0
+        while not self._stopped:
+            if self._callbacks:
+                self._run_callbacks()
+            # wake up in time for the next timer
+            poll_timeout = self.poll_timeout
+            next_timer = self._run_timers()
+            if self._stopped:
+                break
+            if self._callbacks:
+                poll_timeout = 0
+            if next_timer is not None and next_timer < poll_timeout:
+                poll_timeout = next_timer
+            if busy_until and time.monotonic() < busy_until:
+                poll_timeout = 0
+            # the listen queue was not drained last time, edge
+            # triggered epoll will not tell again.
+            if self._accept_pending:
+                self._accept()
+                if self._accept_pending:
+                    poll_timeout = 0
+            if woke is not None:
+                self._check_iteration(woke)
             # epoll wait
-            revents = self._impl.poll(timeout)
+            try:
+                revents = self._impl.poll(poll_timeout)
+            except (OSError, ValueError):
+                # closed by stop() on another thread.
+                if self._stopped:
+                    break
+                raise
+            woke = time.monotonic() if self.slow_callback is not None else None
             if not revents:
-                self.logger.debug("Nothing happened...")
-            else:
-                # process
+                if poll_timeout:
+                    self.logger.debug("Nothing happened...")
+                continue
+            if self.busy_poll:
+                busy_until = time.monotonic() + self.busy_poll
+            # process
+            try:
                 self._process_events(revents)
+            except RuntimeError:
+                # the executor is shut down, at interpreter exit too
+                # when the loop runs on a daemon thread.
+                if self._executor_closed():
+                    break
+                raise
+
+    def _executor_closed(self):
+        # submit raises RuntimeError once the executor is shut down, by
+        # its owner or at interpreter exit.
+        if self._executor is None:
+            return False
+        try:
+            self._executor.submit(int)
+        except RuntimeError:
+            return True
+        return False
 
     def _process_events(self, revents):
+        # level checked once per wakeup, not formatted per event.
+        debug = self.logger.enabled(logging.DEBUG)
+        read = self.executor.submit
+        submit = read if self.slow_callback is None else self._submit_timed
+        # when the requests read by the callbacks arrived, see deadline.
+        now = time.monotonic()
         for fd, events in revents:
-            self.logger.debug("fd: %d, events: %s", fd, self.events_to_string(events))
+            if debug:
+                self.logger.debug(
+                    "fd: %d, events: %s", fd, self.events_to_string(events)
+                )
+            if fd == self._waker_fd:
+                # callbacks run by the next iteration.
+                self._drain_waker()
+                continue
             # active connection.
             connection = None
             try:
@@ -214,62 +708,258 @@ class IOLoop(object):
             except KeyError:
                 # Normally this will never happen.
                 continue
+            if fd == self._acceptor_fd:
+                # accept on the ioloop thread, no executor round trip.
+                self._accept()
+                continue
+            if events & self._HANGUP and connection.handler.on_hangup_cb is not None:
+                connection.handler.on_hangup_cb(connection)
             if events & self._READ:
-                # silence mode for threadpool executor
-                # if callbacks not available
-                # or callbacks not working correctly
-                # (with exception or programming error)
-                # ioloop will will not do or notify anything.
-                #
-                #
-                # connection.on_connection_cb(connection)
-                self.executor.submit(connection.on_connection_cb, connection)
+                connection.last_active = now
+                # one callback reading the transport at a time, see
+                # Transport.begin_read.
+                if connection.begin_read():
+                    read(self._read, connection, now)
             if events & self._WRITE:
-                self.executor.submit(connection.on_write_cb, connection)
+                if connection._wbuf:
+                    connection.flush()
+                # on write callback only if someone asked for EPOLLOUT.
+                if connection.events & self._WRITE:
+                    submit(connection.on_write_cb, connection)
             if events & self._ERROR:
-                self.logger.error(
-                    "fd: %d, events %s", fd, self.events_to_string(events)
-                )
-                self.logger.error("fd: %d, connection closed.", fd)
+                if self.logger.enabled(logging.ERROR):
+                    self.logger.error(
+                        "fd: %d, events %s", fd, self.events_to_string(events)
+                    )
+                    self.logger.error("fd: %d, connection closed.", fd)
+                self.connections.pop(fd, None)
                 connection.close()
-                del self.connections[fd]
+
+    def _read(self, connection, queued):
+        # the on connection callback of the handler of each run.
+        while True:
+            callback = connection.on_connection_cb
+            try:
+                if self.slow_callback is None:
+                    callback(connection)
+                else:
+                    self._timed(callback, connection, connection.conn.fileno(), queued)
+            except NotImplementedError:
+                pass
+            except Exception as e:
+                self.logger.error("%s failed: %r", _callback_name(callback), e)
+            if not connection.end_read():
+                return
+            queued = time.monotonic()
+
+    def _submit_timed(self, callback, connection):
+        return self.executor.submit(
+            self._timed,
+            callback,
+            connection,
+            connection.conn.fileno(),
+            time.monotonic(),
+        )
+
+    def _timed(self, callback, connection, fd, queued):
+        start = time.monotonic()
+        try:
+            return callback(connection)
+        finally:
+            elapsed = time.monotonic() - start
+            threshold = self.slow_callback
+            if threshold is not None and elapsed >= threshold:
+                self.slow_callbacks += 1
+                self.logger.warning(
+                    "slow callback %s on fd %d took %.1f ms, queued %.1f ms",
+                    _callback_name(callback),
+                    fd,
+                    elapsed * 1000,
+                    (start - queued) * 1000,
+                )
+
+    def _check_iteration(self, woke):
+        # the loop thread between two polls: events, accepts, timers.
+        elapsed = time.monotonic() - woke
+        threshold = self.slow_callback
+        if threshold is not None and elapsed >= threshold:
+            self.slow_callbacks += 1
+            self.logger.warning(
+                "ioloop blocked for %.1f ms between polls", elapsed * 1000
+            )
+
+    def _accept(self):
+        self._accept_pending = self.acceptor.on_accept_callback(None)
+
+    def add_callback(self, callback, *args):
+        """ Runs `callback(*args)` on the ioloop thread at its next
+        iteration. No lock is taken, unlike call_later: safe from any
+        thread and from signal handlers, which may interrupt the ioloop
+        thread while it holds one.
+
+        """
+        self._callbacks.append((callback, args))
+        waker = self._waker
+        if waker is not None:
+            try:
+                os.write(waker, b"x")
+            except OSError:
+                # full, a wakeup is pending anyway.
+                pass
+
+    def _run_callbacks(self):
+        callbacks = self._callbacks
+        for _ in range(len(callbacks)):
+            callback, args = callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.error("callback %r failed.", callback)
+
+    def _open_waker(self):
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        self._waker_fd = r
+        self._impl.register(r, IOLoop._READ | IOLoop._EPOLLET)
+        self._waker = w
+
+    def _drain_waker(self):
+        try:
+            while os.read(self._waker_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _close_waker(self):
+        # on the ioloop thread once start returns.
+        w, r = self._waker, self._waker_fd
+        self._waker = self._waker_fd = None
+        for fd in (w, r):
+            if fd is not None:
+                os.close(fd)
+
+    def call_later(self, delay, callback, *args):
+        # timers run on the ioloop thread, keep them short and
+        # submit anything heavy to the executor.
+        timer = _Timer(time.monotonic() + delay, callback, args)
+        with self._timers_lock:
+            heapq.heappush(
+                self._timers, (timer.deadline, next(self._timers_seq), timer)
+            )
+        return timer
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._timers_lock:
+            while self._timers and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)[2]
+                if timer.callback is not None:
+                    due.append(timer)
+        for timer in due:
+            callback, args = timer.callback, timer.args
+            if callback is None:
+                # cancelled by an earlier timer.
+                continue
+            timer.cancel()
+            threshold = self.slow_callback
+            start = time.monotonic() if threshold is not None else None
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.error("timer callback %r failed.", callback)
+            if start is not None and time.monotonic() - start >= threshold:
+                self.slow_callbacks += 1
+                self.logger.warning(
+                    "slow timer %s took %.1f ms",
+                    _callback_name(callback),
+                    (time.monotonic() - start) * 1000,
+                )
+        # timers may have been rescheduled by the callbacks above.
+        with self._timers_lock:
+            if not self._timers:
+                return None
+            next_deadline = self._timers[0][0]
+        return max(0, next_deadline - time.monotonic())
 
     def bind(self, address):
         self.acceptor.bind(address)
 
     def register(self, fd, eventmask):
+        # a new registration, a reused fd forgets the mode of the old one.
+        self._level.discard(fd)
         self._impl.register(fd, eventmask)
 
+    def modify(self, fd, eventmask):
+        if fd in self._level:
+            eventmask &= ~IOLoop._EPOLLET
+        try:
+            self._impl.modify(fd, eventmask)
+        except (OSError, ValueError):
+            # closed meanwhile.
+            pass
+
     def register_acceptor(self, acceptor):
         self.acceptor = acceptor
         self.acceptor.ioloop = self
+        self._acceptor_fd = acceptor.fileno()
         self.connections[acceptor.fileno()] = acceptor.transport()
         # register
-        self._impl.register(
-            self.acceptor.fileno(), eventmask=IOLoop._READ | IOLoop._EPOLLET
-        )
+        self._level.discard(self._acceptor_fd)
+        self._impl.register(self._acceptor_fd, self._accept_events())
 
     def register_connector(self, connector):
+        # the connector registers its fd to the poller once connecting.
         self.connections[connector.fileno()] = connector.transport
-        self._impl.register(connector.fileno(), eventmask=connector.transport.events)
+        connector.transport.handler.ioloop = self
         connector.ioloop = self
 
+    def register_datagram(self, endpoint):
+        transport = endpoint.transport
+        transport.handler.ioloop = self
+        self.connections[endpoint.fileno()] = transport
+        self.register(endpoint.fileno(), transport.events | IOLoop._EPOLLET)
+
+    def unregister(self, fd):
+        # forget the connection, the poller drops closed fds by itself.
+        self.connections.pop(fd, None)
+        self._level.discard(fd)
+        try:
+            self._impl.unregister(fd)
+        except (OSError, ValueError, KeyError):
+            pass
+
     def events_to_string(self, events):
         try:
             return self._EVENTS_DICT[events]
         except KeyError:
             return "Unknown(%d)" % events
 
+    def stop_accepting(self, unlink=True):
+        """ Closes the listening socket, a Unix socket file is kept
+        unless `unlink`.
+
+        """
+        if self._acceptor_fd is None:
+            return
+        self.unregister(self._acceptor_fd)
+        self._acceptor_fd = None
+        self._accept_pending = False
+        self.acceptor.close(unlink)
+
     def stop(self):
-        self._impl.close()
-        if self.acceptor:
-            self.acceptor.close()
-        for conn in self.connections:
-            conn.close()
+        """ Closes the listening socket and every connection at once,
+        `start` returns. See AsyncServer.shutdown for a graceful stop.
+
+        """
+        self._stopped = True
+        self.stop_accepting()
+        for transport in list(self.connections.values()):
             # on close callback.
-            # self.executor.submit(conn.on_close_cb)
-        # clear
+            transport.close()
         self.connections.clear()
+        self._impl.close()
 
     def setloglevel(self, loglevel):
         # default logger level: DEBUG
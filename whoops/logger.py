@@ -1,4 +1,29 @@
 import logging
+import sys
+import threading
+import time
+
+from collections import deque
+
+
+_handlers_lock = threading.Lock()
+
+
+def add_stream_handler(logger, format):
+    """ Attaches a stderr handler with `format` to `logger` unless one
+    is already attached, loops and servers sharing a logger print each
+    record once.
+
+    """
+    with _handlers_lock:
+        for handler in logger.handlers:
+            if getattr(handler, "whoops", False):
+                return handler
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(format))
+        handler.whoops = True
+        logger.addHandler(handler)
+        return handler
 
 
 class BaseLogger(object):
@@ -10,24 +35,127 @@ class BaseLogger(object):
     def setlevel(self, levelname):
         self.logger.setLevel(levelname)
 
+    def enabled(self, level):
+        # check before formatting anything on hot paths.
+        return self.logger.isEnabledFor(level)
+
     def warning(self, s, *args, **kwargs):
-        self.logger.warning(s, *args, extra=self.extra)
+        self.logger.warning(s, *args, extra=self.extra or None)
 
     def info(self, s, *args, **kwargs):
-        self.logger.info(s, *args, extra=self.extra)
+        self.logger.info(s, *args, extra=self.extra or None)
 
     def debug(self, s, *args, **kwargs):
-        self.logger.debug(s, *args, extra=self.extra)
+        self.logger.debug(s, *args, extra=self.extra or None)
 
     def error(self, s, *args, **kwargs):
-        self.logger.error(s, *args, extra=self.extra)
+        self.logger.error(s, *args, extra=self.extra or None)
 
 
 class DefaultLogger(BaseLogger):
     def __init__(self):
         super(DefaultLogger, self).__init__()
         self.FORMAT = "[%(levelname)s] %(asctime)-15s %(message)s"
-        ch = logging.StreamHandler()
-        formatter = logging.Formatter(self.FORMAT)
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
+        add_stream_handler(self.logger, self.FORMAT)
+
+
+class AccessLogger(object):
+
+    """ Access log off the request path.
+
+    `log` only appends a (timestamp, message) record to a bounded queue,
+    records are formatted and written in batches by a background thread.
+    When the queue is full, because the stream is slower than the
+    requests, new records are dropped and counted instead of blocking.
+
+    """
+
+    def __init__(self, address, stream=None, maxsize=8192, interval=0.1):
+        self.address = address
+        self.stream = stream
+        self.maxsize = maxsize
+        self.interval = interval
+
+        # deque append/popleft are atomic, no lock on the request path.
+        self.records = deque()
+
+        # counters
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._closed = False
+
+        # asctime cache, one strftime per second.
+        self._second = None
+        self._asctime = None
+
+    def log(self, message):
+        if len(self.records) >= self.maxsize:
+            self.dropped += 1
+            return
+        self.records.append((time.time(), message))
+        if self._writer is None:
+            self._start()
+
+    def _start(self):
+        with self._writer_lock:
+            if self._writer is None and not self._closed:
+                self._writer = threading.Thread(
+                    target=self._run, name="whoops access log", daemon=True
+                )
+                self._writer.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def asctime(self, timestamp):
+        second = int(timestamp)
+        if second != self._second:
+            self._asctime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+            self._second = second
+        return "%s,%03d" % (self._asctime, (timestamp - second) * 1000)
+
+    def flush(self):
+        records = self.records
+        lines = []
+        try:
+            while True:
+                timestamp, message = records.popleft()
+                lines.append(
+                    "%s %s %s\n" % (self.address, self.asctime(timestamp), message)
+                )
+        except IndexError:
+            pass
+        if not lines:
+            return
+        stream = self.stream or sys.stderr
+        try:
+            stream.write("".join(lines))
+            stream.flush()
+        except (OSError, ValueError):
+            self.dropped += len(lines)
+            return
+        self.written += len(lines)
+        self.batches += 1
+
+    def stats(self):
+        return {
+            "pending": len(self.records),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
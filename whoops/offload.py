@@ -0,0 +1,210 @@
+""" CPU-bound work in worker processes.
+
+Callbacks of the ioloop executor share the GIL: a handler crunching
+numbers for 200 ms stalls every other connection for as long. An
+`Offloader` runs such functions in a `ProcessPoolExecutor` instead and
+posts their results back to the ioloop executor.
+
+Arguments and results are pickled, except bytes-like ones of
+`threshold` bytes or more: those are copied once into a
+`multiprocessing.shared_memory` block and only its name crosses the
+pipe. Creating and unlinking a block costs about a millisecond, the
+default threshold of 512 KB is where it starts to beat the pipe.
+Large arguments reach the function as memoryviews of the block, valid
+until it returns; large results come back as bytes.
+
+The functions are pickled by reference, they must be importable from
+the worker: module level functions or static methods.
+
+"""
+
+import os
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+
+
+_BYTES = (bytes, bytearray, memoryview)
+
+
+class _Shared(object):
+
+    """ Pickled instead of a payload in a shared memory block. """
+
+    __slots__ = ("name", "size")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __getstate__(self):
+        return self.name, self.size
+
+    def __setstate__(self, state):
+        self.name, self.size = state
+
+
+def _nbytes(value):
+    return value.nbytes if isinstance(value, memoryview) else len(value)
+
+
+def _share(data):
+    size = _nbytes(data)
+    block = shared_memory.SharedMemory(create=True, size=max(1, size))
+    block.buf[:size] = data
+    return block
+
+
+def _forget(block):
+    # the other side unlinks the block, the resource tracker of this
+    # one must not.
+    try:
+        resource_tracker.unregister(block._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _attach(value, blocks, views):
+    if not isinstance(value, _Shared):
+        return value
+    block = shared_memory.SharedMemory(name=value.name)
+    _forget(block)
+    blocks.append(block)
+    view = block.buf[: value.size]
+    views.append(view)
+    return view
+
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:
+        # the function kept a view, the block goes with it.
+        pass
+
+
+def _run(fn, args, kwargs, threshold):
+    # in the worker process.
+    blocks = []
+    views = []
+    try:
+        args = [_attach(a, blocks, views) for a in args]
+        kwargs = {k: _attach(v, blocks, views) for k, v in kwargs.items()}
+        result = fn(*args, **kwargs)
+        if isinstance(result, _BYTES) and _nbytes(result) >= threshold:
+            block = _share(result)
+            _forget(block)
+            shared = _Shared(block.name, _nbytes(result))
+            _close(block)
+            return shared
+        return result
+    finally:
+        for view in views:
+            view.release()
+        for block in blocks:
+            _close(block)
+
+
+class Offloader(object):
+
+    """ Runs functions in a process pool, results go to the ioloop executor.
+
+    The pool is started on the first `submit`, or by `start` before the
+    server has threads of its own to fork.
+
+    """
+
+    def __init__(self, ioloop, max_workers=None, threshold=1 << 19, mp_context=None):
+        self.ioloop = ioloop
+        # None: one per CPU, the ProcessPoolExecutor default.
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.threshold = threshold
+        self.mp_context = mp_context
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+        # counters
+        self.submitted = 0
+        self.failed = 0
+        self.shared = 0
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.max_workers, self.mp_context)
+        return self._pool
+
+    def start(self):
+        """ Starts the workers now. """
+        pool = self.pool
+        for future in [pool.submit(int) for _ in range(self.max_workers)]:
+            future.result()
+
+    def submit(self, callback, fn, *args, **kwargs):
+        """ Runs `fn(*args, **kwargs)` in a worker and returns a Future of
+        its result. `callback(result, error)`, if any, is then called on
+        the ioloop executor, error is None or the exception raised.
+
+        """
+        blocks = []
+        try:
+            args = tuple(self._share(a, blocks) for a in args)
+            kwargs = {k: self._share(v, blocks) for k, v in kwargs.items()}
+            inner = self.pool.submit(_run, fn, args, kwargs, self.threshold)
+        except BaseException:
+            self._unlink(blocks)
+            raise
+        self.submitted += 1
+        future = Future()
+        inner.add_done_callback(partial(self._done, future, callback, blocks))
+        return future
+
+    def _share(self, value, blocks):
+        if not isinstance(value, _BYTES) or _nbytes(value) < self.threshold:
+            return value
+        block = _share(value)
+        blocks.append(block)
+        self.shared += 1
+        return _Shared(block.name, _nbytes(value))
+
+    def _unlink(self, blocks):
+        for block in blocks:
+            _close(block)
+            block.unlink()
+
+    def _done(self, future, callback, blocks, inner):
+        # pool thread, the work goes to the ioloop executor.
+        self._unlink(blocks)
+        result = error = None
+        try:
+            result = inner.result()
+            if isinstance(result, _Shared):
+                result = self._take(result)
+        except Exception as e:
+            self.failed += 1
+            error = e
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+        if callback is not None:
+            self.ioloop.executor.submit(callback, result, error)
+
+    def _take(self, shared):
+        block = shared_memory.SharedMemory(name=shared.name)
+        view = block.buf[: shared.size]
+        try:
+            return bytes(view)
+        finally:
+            view.release()
+            _close(block)
+            block.unlink()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
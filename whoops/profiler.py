@@ -0,0 +1,154 @@
+""" Sampling profiler for running servers.
+
+`sample` takes the stacks of all threads every `interval` seconds with
+`sys._current_frames` and counts them in the collapsed format of
+flamegraph.pl and speedscope, one line per distinct stack:
+
+    ThreadPoolExecutor-0;_worker (thread.py:69);on_connection (app.py:12) 42
+
+The root of each stack is the thread name with its index dropped, the
+threads of an executor are merged. Samples are wall clock, threads
+waiting on a lock or in `epoll` are counted too unless `idle` is false.
+
+Sampling is on demand: `install_signal` samples for a while when the
+process gets a signal and writes the stacks to a file,
+`HttpServer.debug_profile` serves them on `/debug/profile?seconds=N`.
+
+"""
+
+import os
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+
+
+# leaf functions of a thread with nothing to do.
+IDLE = frozenset(("poll", "wait", "select", "sleep", "_worker", "accept"))
+
+_INDEX = re.compile(r"[-_]\d+$")
+
+
+def _label(code):
+    name = getattr(code, "co_qualname", code.co_name)
+    return "%s (%s:%d)" % (
+        name.replace(";", ":"),
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+    )
+
+
+def _collapse(frame, thread):
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(_INDEX.sub("", thread).replace(";", ":").replace(" ", "_"))
+    labels.reverse()
+    return ";".join(labels)
+
+
+def sample(duration=1.0, interval=0.005, idle=True):
+    """ Samples the other threads for `duration` seconds, returns the
+    collapsed stacks, most frequent first.
+
+    """
+    me = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + duration
+    while True:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if not idle and frame.f_code.co_name in IDLE:
+                continue
+            counts[_collapse(frame, names.get(ident, str(ident)))] += 1
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    return "".join("%s %d\n" % item for item in counts.most_common())
+
+
+class SignalProfiler(object):
+
+    """ Samples for `duration` seconds when `signum` is received.
+
+    The stacks go to whoops-<pid>-<time>.collapsed in `directory`, the
+    temporary directory by default, and the path is logged. A signal
+    during a sampling is ignored.
+
+    The sampling thread is started here and waits on a pipe, the signal
+    handler only writes a byte to it: the handler may interrupt code
+    holding any lock, and a stalled ioloop is what is worth profiling.
+
+    """
+
+    def __init__(
+        self, ioloop, signum=signal.SIGUSR1, duration=5, interval=0.005, directory=None
+    ):
+        self.ioloop = ioloop
+        self.signum = signum
+        self.duration = duration
+        self.interval = interval
+        self.directory = directory or tempfile.gettempdir()
+        self._wakeup, self._waker = os.pipe()
+        os.set_blocking(self._waker, False)
+        threading.Thread(target=self._run, name="whoops profiler", daemon=True).start()
+        self._previous = signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        # the handler runs on the main thread between bytecodes.
+        try:
+            os.write(self._waker, b"x")
+        except OSError:
+            # full, a sampling is pending anyway.
+            pass
+
+    def _run(self):
+        try:
+            while self.wait():
+                self._profile()
+                # the signals received meanwhile.
+                os.set_blocking(self._wakeup, False)
+                try:
+                    while os.read(self._wakeup, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                os.set_blocking(self._wakeup, True)
+        finally:
+            os.close(self._wakeup)
+
+    def wait(self):
+        # until a signal, False once uninstalled. Named like the leaf
+        # functions of IDLE, samples taken meanwhile leave it out.
+        return bool(os.read(self._wakeup, 64))
+
+    def _profile(self):
+        try:
+            stacks = sample(self.duration, self.interval)
+            path = os.path.join(
+                self.directory, "whoops-%d-%d.collapsed" % (os.getpid(), time.time())
+            )
+            with open(path, "w") as f:
+                f.write(stacks)
+            self.ioloop.logger.warning("profile written to %s", path)
+        except Exception as e:
+            self.ioloop.logger.error("profile failed: %r", e)
+
+    def uninstall(self):
+        signal.signal(self.signum, self._previous)
+        # the sampling thread returns after the current sampling.
+        os.close(self._waker)
+
+
+def install_signal(
+    ioloop, signum=signal.SIGUSR1, duration=5, interval=0.005, directory=None
+):
+    """ Installs a `SignalProfiler`, call from the main thread. """
+    return SignalProfiler(ioloop, signum, duration, interval, directory)
@@ -0,0 +1,183 @@
+""" Per-client connection and request limits.
+
+A `RateLimiter` keeps three limits per client host, each one off when
+zero:
+
+* `max_connections` : connections open at once.
+* `connection_rate` : new connections per second, bursts of
+  `connection_burst`.
+* `request_rate` : HTTP requests per second, bursts of `request_burst`.
+
+The rates are token buckets refilled on use, a check is a few float
+operations under one lock. Clients are kept in a table of at most
+`max_clients` entries in least recently connected order, a flood of
+new addresses evicts the oldest ones instead of growing it; an evicted
+client starts over with full buckets. Connections are tracked by file
+descriptor until they close, so memory is bounded by `max_clients`
+plus the open connections.
+
+`AsyncServer.set_limiter` installs it: the acceptor closes refused
+connections with a reset as soon as they are accepted, `HttpServer`
+answers `429 Too Many Requests` right after reading a request, before
+its headers or body are parsed.
+
+"""
+
+import socket
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# SO_LINGER on, timeout 0: close sends a reset, no TIME_WAIT.
+_RESET = struct.pack("ii", 1, 0)
+
+
+class _Client(object):
+
+    __slots__ = ("connections", "conn_tokens", "conn_stamp", "req_tokens", "req_stamp")
+
+    def __init__(self, conn_tokens, req_tokens, now):
+        self.connections = 0
+        self.conn_tokens = conn_tokens
+        self.conn_stamp = now
+        self.req_tokens = req_tokens
+        self.req_stamp = now
+
+
+def client_host(address):
+    """ The default client key, the host of an IP address, None for Unix
+    sockets which are not limited.
+
+    """
+    if isinstance(address, tuple):
+        return address[0]
+    return None
+
+
+class RateLimiter(object):
+
+    """ Token bucket limits keyed by client address, see the module. """
+
+    def __init__(
+        self,
+        max_connections=0,
+        connection_rate=0,
+        connection_burst=None,
+        request_rate=0,
+        request_burst=None,
+        max_clients=65536,
+        exempt=(),
+        key=client_host,
+    ):
+        self.max_connections = max_connections
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst or max(1, connection_rate)
+        self.request_rate = request_rate
+        self.request_burst = request_burst or max(1, request_rate)
+        self.max_clients = max_clients
+        # hosts never limited, health checks and the like.
+        self.exempt = frozenset(exempt)
+        self.key = key
+
+        # key -> _Client, least recently connected first
+        self.clients = OrderedDict()
+        # fd -> _Client of the open connections
+        self._fds = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.refused_connections = 0
+        self.refused_requests = 0
+
+    def _client(self, key, now):
+        clients = self.clients
+        client = clients.get(key)
+        if client is None:
+            if len(clients) >= self.max_clients:
+                clients.popitem(last=False)
+            client = clients[key] = _Client(
+                self.connection_burst, self.request_burst, now
+            )
+        else:
+            clients.move_to_end(key)
+        return client
+
+    def accept(self, fd, address):
+        """ True if a new connection of `address` on `fd` is allowed, it
+        then counts until `release(fd)`.
+
+        """
+        key = self.key(address)
+        if key is None or key in self.exempt:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            client = self._client(key, now)
+            if self.max_connections and client.connections >= self.max_connections:
+                self.refused_connections += 1
+                return False
+            rate = self.connection_rate
+            if rate:
+                tokens = min(
+                    self.connection_burst,
+                    client.conn_tokens + (now - client.conn_stamp) * rate,
+                )
+                client.conn_stamp = now
+                if tokens < 1:
+                    client.conn_tokens = tokens
+                    self.refused_connections += 1
+                    return False
+                client.conn_tokens = tokens - 1
+            client.connections += 1
+            self._fds[fd] = client
+        return True
+
+    def request(self, fd):
+        """ Takes a request token of the client on `fd`, returns 0 if the
+        request is allowed, otherwise the seconds until it would be.
+
+        """
+        rate = self.request_rate
+        if not rate:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            client = self._fds.get(fd)
+            if client is None:
+                return 0
+            tokens = min(
+                self.request_burst, client.req_tokens + (now - client.req_stamp) * rate
+            )
+            client.req_stamp = now
+            if tokens < 1:
+                client.req_tokens = tokens
+                self.refused_requests += 1
+                return (1 - tokens) / rate
+            client.req_tokens = tokens - 1
+        return 0
+
+    def release(self, fd):
+        """ The connection on `fd` closed. """
+        with self._lock:
+            client = self._fds.pop(fd, None)
+            if client is not None:
+                client.connections -= 1
+
+    def refuse(self, conn):
+        """ Closes a refused socket with a reset. """
+        try:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _RESET)
+        except OSError:
+            pass
+        conn.close()
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "connections": len(self._fds),
+            "refused_connections": self.refused_connections,
+            "refused_requests": self.refused_requests,
+        }
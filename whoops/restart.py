@@ -0,0 +1,167 @@
+""" Graceful stop and zero downtime restart.
+
+`install_signals` makes SIGTERM a graceful stop, `AsyncServer.shutdown`:
+no new connections, idle keep-alive connections closed, requests in
+flight finished within `timeout` seconds.
+
+SIGHUP and SIGUSR2 restart: the same command line is executed again
+with the listening socket inherited, the new process serves it instead
+of binding and reports when it listens. Only then the old one drains
+the way SIGTERM does, the kernel queues new connections on the shared
+socket meanwhile, none is refused. A new process that fails to start
+is killed and the old one keeps serving.
+
+The new process is started by the old one and outlives it. A
+supervisor watching the old pid sees it exit, it has to follow a pid
+file written by the application instead (systemd: `Type=forking`,
+`PIDFile=`).
+
+"""
+
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+
+
+# {"fd": address} of the inherited listening sockets
+LISTEN_FDS = "WHOOPS_LISTEN_FDS"
+# pipe the new process writes "1" to once it listens
+READY_FD = "WHOOPS_READY_FD"
+
+
+def _address(address):
+    # as it survives a JSON round trip.
+    return list(address) if isinstance(address, tuple) else address
+
+
+def inherited(address):
+    """ The listening socket of `address` left by the previous process,
+    None when there is none.
+
+    """
+    fds = os.environ.get(LISTEN_FDS)
+    if fds is None:
+        return None
+    import json
+
+    try:
+        fds = json.loads(fds)
+    except ValueError:
+        return None
+    for fd, bound in fds.items():
+        if bound == _address(address):
+            sock = socket.socket(fileno=int(fd))
+            sock.setblocking(False)
+            return sock
+    return None
+
+
+def notify_ready():
+    """ Tells the previous process, if any, that this one listens. """
+    fd = os.environ.pop(READY_FD, None)
+    os.environ.pop(LISTEN_FDS, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except (OSError, ValueError):
+        pass
+
+
+class Restarter(object):
+
+    """ Starts `argv`, the command line of this process by default, with
+    the listening socket of `server` and hands over to it.
+
+    """
+
+    def __init__(self, server, timeout=30, ready_timeout=30, argv=None):
+        self.server = server
+        self.timeout = timeout
+        self.ready_timeout = ready_timeout
+        if argv is None:
+            argv = [sys.executable] + list(
+                sys.orig_argv[1:] if hasattr(sys, "orig_argv") else sys.argv
+            )
+        self.argv = argv
+        self._running = threading.Lock()
+
+    def restart(self):
+        """ Restarts in the background, once at a time. """
+        if self._running.acquire(blocking=False):
+            threading.Thread(
+                target=self._run, name="whoops restart", daemon=True
+            ).start()
+
+    def _run(self):
+        try:
+            # the listening socket is gone once draining.
+            if not self.server.draining and self.spawn() is not None:
+                self.server.shutdown(self.timeout, handoff=True)
+        finally:
+            self._running.release()
+
+    def spawn(self):
+        """ Starts the new process and waits until it listens, returns it
+        or None if it did not start.
+
+        """
+        import json
+        import subprocess
+
+        logger = self.server.ioloop.logger
+        acceptor = self.server.acceptor
+        fd = acceptor.fileno()
+        r, w = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FDS] = json.dumps({str(fd): _address(acceptor.address)})
+        env[READY_FD] = str(w)
+        try:
+            child = subprocess.Popen(self.argv, env=env, pass_fds=(fd, w))
+        except OSError as e:
+            os.close(r)
+            logger.error("restart failed: %r", e)
+            return None
+        finally:
+            os.close(w)
+        try:
+            # EOF without a byte: it died before listening.
+            ready, _, _ = select.select([r], [], [], self.ready_timeout)
+            ok = bool(ready) and os.read(r, 1) == b"1"
+        finally:
+            os.close(r)
+        if not ok:
+            if child.poll() is None:
+                child.kill()
+            child.wait()
+            logger.error("restart failed: process %d did not listen", child.pid)
+            return None
+        logger.warning("process %d listens, draining", child.pid)
+        return child
+
+
+def install_signals(
+    server,
+    timeout=30,
+    restart=(signal.SIGHUP, signal.SIGUSR2),
+    stop=(signal.SIGTERM,),
+    argv=None,
+):
+    """ Restarts `server` on the `restart` signals, stops it gracefully on
+    the `stop` ones. Call from the main thread; returns the Restarter.
+
+    """
+    restarter = Restarter(server, timeout, argv=argv)
+    # the handlers only queue work for the ioloop thread, starting a
+    # thread takes locks the interrupted code may hold.
+    for signum in restart:
+        signal.signal(
+            signum, lambda signum, frame: server.ioloop.add_callback(restarter.restart)
+        )
+    for signum in stop:
+        signal.signal(signum, lambda signum, frame: server.shutdown(timeout))
+    return restarter
@@ -0,0 +1,172 @@
+""" TLS for whoops transports.
+
+Handshakes run non-blocking: the socket is wrapped with
+`do_handshake_on_connect=False` and every EPOLLIN/EPOLLOUT drives one
+more `do_handshake()` step on the executor, so the handshake CPU work
+never runs on the ioloop thread. WANT_READ/WANT_WRITE just wait for the
+next event.
+
+Servers rely on OpenSSL's session cache and on session tickets (TLS 1.3
+tickets, `num_tickets`), clients keep the sessions they got in a
+`SessionCache` to resume them on the next connect.
+
+"""
+
+import ssl
+import threading
+
+from collections import OrderedDict
+
+from .ioloop import IOLoop, Handler, Transport
+
+
+def server_context(certfile, keyfile=None, num_tickets=2):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    # session tickets on, returning clients skip the full handshake.
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = num_tickets
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class TLSTransport(Transport):
+
+    """ Transport over an `ssl.SSLSocket`.
+
+    An SSL object must not be used by two threads at once, reads take
+    the same striped lock as writes and flushes.
+
+    """
+
+    __slots__ = ()
+
+    _retry = Transport._retry + (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+    def read(self, bytes=1024, buffer=b""):
+        with self._lock():
+            return Transport.read(self, bytes, buffer)
+
+
+def handshake(transport):
+    """ One handshake step, True once the handshake is complete. """
+    try:
+        transport.conn.do_handshake()
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        return False
+    return True
+
+
+class SessionCache(object):
+
+    """ Client side TLS sessions by remote address, least recently used
+    sessions are dropped past `maxsize`. """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, remote):
+        with self._lock:
+            session = self.sessions.get(remote)
+            if session is not None:
+                self.sessions.move_to_end(remote)
+            return session
+
+    def put(self, remote, session):
+        if session is None:
+            return
+        with self._lock:
+            self.sessions[remote] = session
+            self.sessions.move_to_end(remote)
+            while len(self.sessions) > self.maxsize:
+                self.sessions.popitem(last=False)
+
+
+class ServerHandshaker(object):
+
+    """ Drives server side handshakes for an `Acceptor`.
+
+    Handshaking transports use the handshaker's own handler, once the
+    handshake is done they are switched to the server handler.
+
+    """
+
+    def __init__(self, acceptor, ssl_context, timeout=10):
+        self.acceptor = acceptor
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+
+        self.handler = None
+
+        # counters
+        self.handshakes = 0
+        self.resumed = 0
+        self.failed = 0
+        self._stats_lock = threading.Lock()
+
+    def bind(self, ioloop):
+        self.handler = Handler(ioloop)
+        self.handler.on_connection_cb = self.on_handshake
+        self.handler.on_write_cb = self.on_handshake
+
+    def wrap(self, conn):
+        conn = self.ssl_context.wrap_socket(
+            conn, server_side=True, do_handshake_on_connect=False
+        )
+        transport = TLSTransport(conn, None, self.handler)
+        transport.events = IOLoop._READ | IOLoop._WRITE
+        if self.timeout:
+            self.handler.ioloop.call_later(
+                self.timeout, self.on_handshake_timeout, transport
+            )
+        return transport
+
+    def on_handshake(self, transport):
+        handler = self.acceptor.handler
+        with transport._lock():
+            if transport.closed or transport.handler is not self.handler:
+                return
+            try:
+                if not handshake(transport):
+                    return
+            except (ssl.SSLError, OSError) as e:
+                with self._stats_lock:
+                    self.failed += 1
+                self.handler.ioloop.logger.debug("TLS handshake failed: %s", e)
+                self.close(transport)
+                return
+            with self._stats_lock:
+                self.handshakes += 1
+                if transport.conn.session_reused:
+                    self.resumed += 1
+            transport.handler = handler
+            # EPOLL_CTL_MOD re-arms: data already in the kernel is reported.
+            transport.set_events(IOLoop._READ | IOLoop._EPOLLRDHUP)
+
+        if handler.connection_made_cb:
+            try:
+                handler.connection_made_cb()
+            except NotImplementedError:
+                pass
+        # records already decrypted by the handshake are not in the kernel.
+        if transport.conn.pending() and handler.on_connection_cb:
+            handler.on_connection_cb(transport)
+
+    def on_handshake_timeout(self, transport):
+        if transport.handler is self.handler and not transport.closed:
+            with self._stats_lock:
+                self.failed += 1
+            self.handler.ioloop.executor.submit(self.close, transport)
+
+    def close(self, transport):
+        self.handler.ioloop.unregister(transport.conn.fileno())
+        transport.close()
@@ -0,0 +1,136 @@
+""" Unix domain sockets.
+
+Anywhere an `(host, port)` address is accepted, a string is a Unix
+socket path. A leading NUL byte, or "@" as `ss` prints it, names a
+socket in the Linux abstract namespace: no file, no permissions, gone
+with the last socket.
+
+A listener's socket file is created with `mode`. A file left behind by
+a server that died is unlinked; one that still answers connections is
+an error. The file is removed again when the listener is closed.
+
+`send_fds`/`recv_fds` pass descriptors over a Unix socket with
+SCM_RIGHTS, `send_connection` hands a connection to another process
+which takes it over with `AsyncServer.adopt`, no byte proxied.
+
+"""
+
+import array
+import errno
+import os
+import socket
+import stat
+
+
+def is_unix_address(address):
+    return isinstance(address, (str, bytes))
+
+
+def address_family(address):
+    if is_unix_address(address):
+        return socket.AF_UNIX
+    return socket.AF_INET
+
+
+def sockaddr(address):
+    # "@name" is the printable form of an abstract address.
+    if isinstance(address, str) and address.startswith("@"):
+        return "\0" + address[1:]
+    return address
+
+
+def is_abstract(address):
+    address = sockaddr(address)
+    return address[:1] in ("\0", b"\0")
+
+
+def bind(sock, address, mode=None):
+    # returns the identity of the socket file, None when abstract.
+    address = sockaddr(address)
+    if is_abstract(address):
+        sock.bind(address)
+        return None
+    remove_stale(address)
+    sock.bind(address)
+    if mode is not None:
+        # the window between bind and chmod is the umask's.
+        os.chmod(address, mode)
+    st = os.stat(address)
+    return st.st_dev, st.st_ino
+
+
+def remove_stale(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST, "not a socket: %s" % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        # nobody listens anymore.
+        os.unlink(path)
+        return
+    except OSError:
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, "address already in use: %s" % path)
+
+
+def unlink(address, identity):
+    # only the file bound by us, not one a newer listener bound since.
+    if identity is None:
+        return
+    address = sockaddr(address)
+    try:
+        st = os.stat(address)
+        if (st.st_dev, st.st_ino) == identity:
+            os.unlink(address)
+    except OSError:
+        pass
+
+
+def send_fds(sock, fds, data=b"\0"):
+    # at least one byte of data, ancillary data alone is not sent.
+    return sock.sendmsg(
+        [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    )
+
+
+def recv_fds(sock, maxfds=16, bufsize=1024):
+    """ One message and the descriptors that came with it, raises
+    BlockingIOError on a non-blocking socket with nothing to read.
+
+    """
+    fds = array.array("i")
+    data, ancdata, flags, _ = sock.recvmsg(
+        bufsize, socket.CMSG_SPACE(maxfds * fds.itemsize)
+    )
+    for level, type_, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[: len(cdata) - len(cdata) % fds.itemsize])
+    fds = list(fds)
+    if flags & socket.MSG_CTRUNC:
+        # more descriptors than room for them.
+        for fd in fds:
+            os.close(fd)
+        raise OSError(errno.EMSGSIZE, "more than %d descriptors" % maxfds)
+    return data, fds
+
+
+def send_connection(ioloop, transport, channel, data=b"\0"):
+    """ Hands `transport`'s socket over `channel` and drops it here.
+
+    The descriptor is removed from the poller first: the receiving
+    process keeps the same open file, and epoll would keep reporting
+    it to this process after the local close. Plain transports only,
+    TLS state does not cross processes.
+
+    """
+    fd = transport.conn.fileno()
+    send_fds(channel, [fd], data)
+    ioloop.unregister(fd)
+    transport.close()
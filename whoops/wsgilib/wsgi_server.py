@@ -1,18 +1,25 @@
+import logging
 import sys
 
 from io import BytesIO
 
-from whoops.httplib.http_server import HttpServer
+from whoops.httplib.http_server import HttpServer, RequestState
 from whoops import ioloop
 
 
 class WSGIServer(HttpServer):
-    def __init__(self, ioloop, address):
-        super(WSGIServer, self).__init__(ioloop, address)
+
+    # per request state, see RequestState.
+    environ = RequestState("environ")
+    result = RequestState("result")
+    cgi_environ = RequestState("cgi_environ")
+    need_content_length = RequestState("need_content_length")
+
+    def __init__(self, ioloop, address, ssl_context=None, unix_mode=None):
+        super(WSGIServer, self).__init__(
+            ioloop, address, ssl_context=ssl_context, unix_mode=unix_mode
+        )
         self.app = None
-        self.environ = None
-        self.result = None
-        self.cgi_environ = None
         self.http_version = "HTTP/1.1"
         self.wsgi_version = (1, 0)
         self.wsgi_multithread = True
@@ -24,10 +31,28 @@ class WSGIServer(HttpServer):
 
     def on_connection(self, conn):
         self.connection = conn
-        self.parse_request()
-        self.setup_environ()
-        self.result = self.app(self.environ, self.start_response)
-        self.finish_response()
+        # when the ioloop saw the request, the read below moves it.
+        arrived = conn.last_active
+        self.enter(conn)
+        try:
+            if not self.parse_request():
+                if conn.at_eof():
+                    self.close()
+                return
+            self.start_deadline(arrived)
+            if self.deadline.expired:
+                self.deadline_exceeded()
+                return
+            self.setup_environ()
+            self.result = self.app(self.environ, self.start_response)
+            try:
+                self.finish_response()
+            finally:
+                close = getattr(self.result, "close", None)
+                if close is not None:
+                    close()
+        finally:
+            self.leave(conn)
 
     def setup_cgi_environ(self):
         env = {}
@@ -63,21 +88,28 @@ class WSGIServer(HttpServer):
         env["wsgi.errors"] = sys.stdout
         env["wsgi.version"] = self.wsgi_version
         env["wsgi.run_once"] = self.wsgi_run_once
-        env["wsgi.url_scheme"] = "http"
+        env["wsgi.url_scheme"] = "https" if self.ssl_context else "http"
         env["wsgi.multithread"] = self.wsgi_multithread
         env["wsgi.wsgi_multiprocess"] = self.wsgi_multiprocess
+        # cancelled when the client hangs up, see whoops.deadline.
+        env["whoops.deadline"] = self.deadline
 
     def start_response(self, status, headers, exc_info=None):
         code = int(status[0:3])
         message = str(status[4:])
         self.send_response(code, message)
-        self.ioloop.logger.info(
-            self.cgi_environ["PATH_INFO"] + "  %s %d %s" % ("HTTP/1.1", code, message)
-        )
+        if self.ioloop.logger.enabled(logging.INFO):
+            self.access_logger.log(
+                "%s  HTTP/1.1 %d %s" % (self.cgi_environ["PATH_INFO"], code, message)
+            )
         self.need_content_length = True
+        draining = self.draining
         for name, val in headers:
             if name == "Content-Length":
                 self.need_content_length = False
+            elif draining and name.lower() == "connection":
+                # send_response sent Connection: close already.
+                continue
             self.send_header(name, val)
 
         self.send_header("Date", self.date_string())
@@ -93,11 +125,19 @@ class WSGIServer(HttpServer):
             self.send_header("Content-Length", content_length)
 
         self.end_headers()
+        deadline = self.deadline
         for data in self.result:
+            # the client is gone, stop producing the body.
+            if deadline.cancelled:
+                break
             self.send(data)
 
 
-def make_server(host, port, app):
-    server = WSGIServer(ioloop.IOLoop.instance(num_backends=1000), (host, port))
+def make_server(host, port, app, ssl_context=None, unix_mode=None):
+    # port None: host is a Unix socket path.
+    address = host if port is None else (host, port)
+    server = WSGIServer(
+        ioloop.IOLoop.instance(num_backends=1000), address, ssl_context, unix_mode
+    )
     server.set_app(app)
     return server